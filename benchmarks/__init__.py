@@ -0,0 +1,5 @@
+"""
+Бенчмарки бота. Каждый модуль запускается отдельно из корня репозитория, например:
+
+python -m benchmarks.database_journal
+"""
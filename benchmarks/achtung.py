@@ -0,0 +1,67 @@
+"""
+Рассылка /achtung по USERS людям через поддельный телеграм, который, как настоящий, принимает около
+30 сообщений в секунду. Меряется:
+- за сколько возвращается хэндлер /achtung (раньше он рассылал все сам и возвращался только в конце);
+- за сколько бот отвечает на /help, пока идет рассылка;
+- скорость рассылки;
+- через сколько после нажатия "Отменить" рассылка останавливается.
+
+python -m benchmarks.achtung
+"""
+from types import SimpleNamespace
+from threading import Thread
+import tempfile
+import time
+from telebot import apihelper, types
+import database
+from benchmarks.fake_telegram import FakeTelegram, make_update
+
+USERS = 1000
+OWNER = 1
+CANCEL_AFTER = 10  # секунды
+
+
+def main():
+    database.FILE_PATH = tempfile.mkdtemp(prefix='boris48bot-') + '/'
+    telegram = FakeTelegram(flood_rate=30).start()
+    apihelper.API_URL = telegram.api_url
+    from telegram import Bot
+    from global_variables import TELEGRAM_BOT
+    bot = TELEGRAM_BOT.value = Bot('1:benchmark')
+    for telegram_id in range(OWNER, OWNER + USERS):
+        bot.db.update_document(str(telegram_id), fields_with_content={'access_level': 1, 'is_bot': False})
+    bot.db.update_document(str(OWNER), fields_with_content={'access_level': 2})
+    bot.db.save_and_update()
+    from plugins import command_handlers, callback_handlers
+    from plugins.achtung_plugin import achtung
+    bot.load_command_plugins(list(command_handlers))
+    bot.load_callback_plugins(list(callback_handlers))
+    polling = Thread(target=bot.polling, kwargs={'non_stop': True, 'interval': 0, 'timeout': 1}, daemon=True)
+    polling.start()
+
+    message = types.Message.de_json(make_update(1, OWNER, '/achtung Проверка связи')['message'])
+    started = time.monotonic()
+    achtung.command(message)
+    print('хэндлер /achtung вернулся за {:.1f} мс'.format((time.monotonic() - started) * 1000))
+
+    time.sleep(2)
+    sent_before = len(telegram.sent)
+    pushed = time.monotonic()
+    telegram.push_update(OWNER + USERS + 1, '/help')
+    while not any(item['params'].get('chat_id') == str(OWNER + USERS + 1) for item in telegram.sent[sent_before:]):
+        time.sleep(0.01)
+    print('ответ на /help во время рассылки: {:.2f} с'.format(time.monotonic() - pushed))
+
+    time.sleep(max(0.0, CANCEL_AFTER - (time.monotonic() - started)))
+    cancelled = time.monotonic()
+    achtung.callback(SimpleNamespace(id='cancel'))
+    achtung._thread.join()
+    print('рассылка остановлена через {:.2f} с после отмены'.format(time.monotonic() - cancelled))
+    print('итог: ' + achtung._progress())
+    bot.stop_polling()
+    polling.join(5)
+    telegram.stop()
+
+
+if __name__ == '__main__':
+    main()
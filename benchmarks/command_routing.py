@@ -0,0 +1,76 @@
+"""
+Стоимость выбора обработчика для одного сообщения: как было (по обработчику на плагин, telebot перебирает их
+и для каждого вызывает _test_filter на фильтры commands и access_level) и как стало
+(таблица команд и один обработчик, Bot._match_command).
+
+Меряются три сообщения: последняя зарегистрированная команда (худший случай для перебора),
+неизвестная команда и обычный текст.
+
+python -m benchmarks.command_routing
+"""
+import re
+import timeit
+from telebot import types, util
+from telegram import Bot
+from benchmarks.fake_telegram import make_update
+
+COMMAND_COUNTS = [10, 500]
+NUMBER = 20000
+USER_ID = 1000
+
+
+def _legacy_test_filter(bot, message_filter, filter_value, message):
+    test_cases = {
+        'content_types': lambda msg: msg.content_type in filter_value,
+        'regexp': lambda msg: msg.content_type == 'text' and re.search(filter_value, msg.text, re.IGNORECASE),
+        'commands': lambda msg: msg.content_type == 'text' and util.extract_command(msg.text) in filter_value,
+        'func': lambda msg: filter_value(msg),
+        'access_level': lambda msg: bot._users[str(msg.from_user.id)]['access_level'] >= filter_value
+    }
+    return test_cases.get(message_filter, lambda msg: False)(message)
+
+
+def _legacy_dispatch(bot, handlers, message):
+    # Так telebot выбирает обработчик: первый, у которого прошли все фильтры
+    for handler in handlers:
+        if all(_legacy_test_filter(bot, name, value, message) for name, value in handler['filters'].items()):
+            return handler['function']
+    return None
+
+
+def _routed_dispatch(bot, message):
+    if bot._match_command(message):
+        return bot._routes[bot._command_name(message.text)][0]
+    return None
+
+
+def _make_bot(count):
+    bot = Bot.__new__(Bot)  # без сети и базы: нужны только таблица команд и пользователи
+    bot._users = {str(USER_ID): {'access_level': 1}}
+    bot._routes = {}
+    bot._regexps = {}
+    handlers = []
+    for number in range(count):
+        command = 'command{}'.format(number)
+        bot._routes[command] = (lambda message: None, 1)
+        handlers.append({'function': bot._routes[command][0],
+                         'filters': {'content_types': ['text'], 'commands': [command], 'access_level': 1}})
+    return bot, handlers
+
+
+def main():
+    print('{:>9} {:>16} {:>14} {:>14}'.format('commands', 'message', 'legacy, мкс', 'routed, мкс'))
+    for count in COMMAND_COUNTS:
+        bot, handlers = _make_bot(count)
+        messages = {'last command': '/command{}'.format(count - 1), 'unknown': '/nope', 'plain text': 'привет'}
+        for name, text in messages.items():
+            message = types.Message.de_json(make_update(1, USER_ID, text)['message'])
+            assert _legacy_dispatch(bot, handlers, message) is _routed_dispatch(bot, message)
+            legacy = timeit.timeit(lambda: _legacy_dispatch(bot, handlers, message), number=NUMBER // count * 10)
+            routed = timeit.timeit(lambda: _routed_dispatch(bot, message), number=NUMBER)
+            print('{:>9} {:>16} {:>14.2f} {:>14.2f}'.format(count, name, legacy / (NUMBER // count * 10) * 1e6,
+                                                          routed / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Сравнивает время сохранения одного измененного документа в обычном режиме Database и в режиме журнала
+на коллекциях разного размера. В режиме журнала время не должно зависеть от размера коллекции
+"""
+import tempfile
+import time
+import database
+from database import Database
+
+SIZES = [1000, 10000, 100000]
+WRITES = 200
+
+
+def _fill(collection: Database, size: int) -> None:
+    for number in range(size):
+        collection.update_document(str(number), fields_with_content={'username': 'user{}'.format(number),
+                                                                     'first_name': None, 'last_name': None,
+                                                                     'is_bot': False, 'access_level': 1})
+
+
+def _measure(collection: Database, size: int, writes: int) -> float:
+    started = time.perf_counter()
+    for number in range(writes):
+        collection.update_document(str(number % size), fields_with_content={'access_level': number % 3})
+        collection.save_and_update()
+    return (time.perf_counter() - started) / writes
+
+
+def main() -> None:
+    database.JOURNAL_LIMIT = float('inf')  # слияние журнала в фоне мерить не нужно
+    print('{:>8} {:>16} {:>16}'.format('docs', 'plain, ms/write', 'journal, ms/write'))
+    for size in SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            database.FILE_PATH = directory + '/'
+            plain = Database('plain')
+            _fill(plain, size)
+            plain.save_and_update()
+            plain_time = _measure(plain, size, max(1, WRITES * 1000 // size))
+            journal = Database('journal', journal=True)
+            _fill(journal, size)
+            journal.compact()
+            journal_time = _measure(journal, size, WRITES)
+        print('{:>8} {:>16.3f} {:>16.3f}'.format(size, plain_time * 1000, journal_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
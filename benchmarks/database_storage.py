@@ -0,0 +1,73 @@
+"""
+Сравнивает хранилища Database (BSON и SQLite) на коллекции пользователей разного размера: время открытия
+(то, что бот делает при старте), пиковый RSS процесса после открытия, первый поиск по индексу
+и время сохранения одного измененного документа.
+Каждое открытие делается в отдельном процессе, чтобы RSS относился только к нему
+"""
+import subprocess
+import sys
+import tempfile
+import time
+import database
+from database import Database, BSON, SQLITE, RANGE, EQUALITY, Equals
+from database import migrate
+
+SIZES = [1000, 10000, 100000]
+WRITES = 200
+INDEXES = {'access_level': RANGE, 'is_bot': EQUALITY}
+
+
+def _fill(path: str, size: int) -> None:
+    database.FILE_PATH = path
+    users = Database('users', journal=True)
+    for number in range(size):
+        users.update_document(str(number), fields_with_content={'username': 'user{}'.format(number),
+                                                                'first_name': None, 'last_name': None,
+                                                                'is_bot': number % 10 == 0, 'access_level': 1})
+    users.compact()
+    migrate.migrate('users')
+
+
+def _peak_rss() -> float:
+    # ru_maxrss дочерний процесс наследует от родителя, поэтому -- VmHWM, который exec сбрасывает
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _measure(path: str, storage: str) -> None:
+    database.FILE_PATH = path
+    started = time.perf_counter()
+    users = Database('users', journal=True, indexes=INDEXES, storage=storage)
+    opened = time.perf_counter() - started
+    rss = _peak_rss()
+    started = time.perf_counter()
+    users.get_document_names({'is_bot': Equals(False)})
+    query = time.perf_counter() - started
+    started = time.perf_counter()
+    for number in range(WRITES):
+        users.update_document(str(number), fields_with_content={'access_level': number % 3})
+        users.save_and_update()
+    write = (time.perf_counter() - started) / WRITES
+    print('{:>8} {:>10.2f} {:>10.1f} {:>12.2f} {:>12.3f}'.format(storage, opened, rss, query, write * 1000))
+
+
+def main() -> None:
+    if len(sys.argv) == 3:
+        _measure(sys.argv[1], sys.argv[2])
+        return
+    database.JOURNAL_LIMIT = float('inf')  # слияние журнала в фоне мерить не нужно
+    for size in SIZES:
+        print('{} документов'.format(size))
+        print('{:>8} {:>10} {:>10} {:>12} {:>12}'.format('storage', 'open, s', 'RSS, MB', 'query, s', 'ms/write'))
+        with tempfile.TemporaryDirectory() as directory:
+            _fill(directory + '/', size)
+            for storage in (BSON, SQLITE):
+                subprocess.run([sys.executable, '-m', 'benchmarks.database_storage', directory + '/', storage],
+                               check=True)
+
+
+if __name__ == '__main__':
+    main()
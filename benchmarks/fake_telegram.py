@@ -0,0 +1,150 @@
+"""
+Поддельный Bot API телеграма для бенчмарков.
+
+FakeTelegram -- HTTP-сервер, который понимает адреса вида /bot<токен>/<метод>:
+getUpdates -- long polling по очереди обновлений, которые бенчмарк добавляет через push_update
+любой другой метод -- запоминается в sent и получает в ответ правдоподобное сообщение
+
+Если задан flood_rate, сервер, как настоящий телеграм, отвечает 429 с retry_after на все, что сверх
+flood_rate отправок в секунду (отказы считаются в rejected)
+
+Чтобы telebot ходил сюда, а не в api.telegram.org:
+telebot.apihelper.API_URL = fake.api_url
+"""
+from typing import Any, Dict, List, Optional
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Condition, Lock
+from urllib.parse import urlparse, parse_qs
+import itertools
+import json
+import time
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> Dict[str, Any]:
+    """
+    :return: словарь обновления с текстовым сообщением от пользователя chat_id
+    """
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'user{}'.format(chat_id), 'username': None}
+    message = {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+               'from': user, 'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+class FakeTelegram:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, flood_rate: Optional[int] = None):
+        """
+        :param flood_rate: сколько отправок в секунду принимать, остальным отвечать 429; None -- без ограничения
+        """
+        self._flood_rate = flood_rate
+        self._window = 0
+        self._window_sends = 0
+        self.rejected = 0
+        self._updates: List[Dict[str, Any]] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._condition = Condition()
+        self._lock = Lock()
+        self.sent: List[Dict[str, Any]] = []
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def api_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/bot{{0}}/{{1}}'.format(host, port)
+
+    def start(self) -> 'FakeTelegram':
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, chat_id: int, text: str) -> Dict[str, Any]:
+        update = make_update(next(self._update_ids), chat_id, text)
+        with self._condition:
+            self._updates.append(update)
+            self._condition.notify_all()
+        return update
+
+    def _get_updates(self, params: Dict[str, str]) -> List[Dict[str, Any]]:
+        offset = int(params.get('offset', 0))
+        timeout = float(params.get('timeout', 0))
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                self._updates = [update for update in self._updates if update['update_id'] >= offset]
+                if self._updates or time.monotonic() >= deadline:
+                    return list(self._updates)
+                self._condition.wait(deadline - time.monotonic())
+
+    def _call(self, method: str, params: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        # Возвращает ответ Bot API или None для 404
+        if method == 'getUpdates':
+            return {'ok': True, 'result': self._get_updates(params)}
+        if method in ('deleteWebhook', 'setWebhook'):
+            return {'ok': True, 'result': True}
+        if method == 'getMe':
+            return {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'bot'}}
+        now = time.monotonic()
+        with self._lock:
+            if self._flood_rate is not None:
+                if int(now) != self._window:
+                    self._window = int(now)
+                    self._window_sends = 0
+                if self._window_sends >= self._flood_rate:
+                    self.rejected += 1
+                    return {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                            'parameters': {'retry_after': 1}}
+                self._window_sends += 1
+            self.sent.append({'method': method, 'params': params, 'time': now})
+        chat_id = int(params.get('chat_id', 0))
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        if method == 'sendPhoto':
+            file_id = 'photo-{}'.format(message['message_id'])
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1, 'height': 1}]
+        return {'ok': True, 'result': message}
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # иначе заголовки и тело уходят разными пакетами с задержкой ACK
+
+            def _handle(self):
+                url = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length and 'form-urlencoded' in (self.headers.get('Content-Type') or ''):
+                    body = parse_qs(self.rfile.read(length).decode())
+                    params.update({key: values[-1] for key, values in body.items()})
+                elif length:
+                    self.rfile.read(length)
+                response = fake._call(url.path.rsplit('/', 1)[-1], params)
+                if response is None:
+                    response = {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+                self._reply(response.get('error_code', 200), response)
+
+            def _reply(self, status, response):
+                body = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, *_):
+                pass
+
+        return Handler
+
+
+__all__ = ['FakeTelegram', 'make_update']
@@ -0,0 +1,168 @@
+"""
+Поддельный бэкенд Убежища для бенчмарков.
+
+FakeVault -- HTTP-сервер, отвечающий на те адреса, которые спрашивает vault_api:
+/stats/, /flow/diff, /node/<id>/comment, /tag/nodes и картинки из /static/.
+Ответы собираются из записанных образцов (benchmarks/fixtures/vault.json): каждый tick берет следующие
+posts_per_tick постов Течения и comments_per_tick комментариев Бориса по кругу, выдает им новые id и время
+по собственным часам (секунда на запись), так что прогон полностью повторяем.
+
+Чтобы vault_api ходил сюда:
+vault_api.TEST_URL = vault_api.MAIN_URL = fake.url
+"""
+from typing import Any, Dict, List, Optional
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from urllib.parse import urlparse, parse_qs
+import copy
+import datetime
+import itertools
+import json
+import os.path
+import time
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'vault.json')
+START = datetime.datetime(2021, 1, 1)
+BORIS_NODE = 696
+
+
+def _timestamp(seconds: int) -> str:
+    moment = START + datetime.timedelta(seconds=seconds)
+    return moment.isoformat(timespec='milliseconds') + 'Z'
+
+
+class FakeVault:
+    def __init__(self, fixtures: str = FIXTURES, posts_per_tick: int = 2, comments_per_tick: int = 3,
+                 host: str = '127.0.0.1', port: int = 0, latency: float = 0.0):
+        """
+        :param fixtures: файл с образцами ответов
+        :param posts_per_tick: сколько постов появляется в Течении за один tick
+        :param comments_per_tick: сколько комментариев появляется у Бориса за один tick
+        :param latency: сколько секунд думать над каждым ответом (медленное Убежище)
+        """
+        with open(fixtures, encoding='utf-8') as fixtures_file:
+            self._fixtures = json.load(fixtures_file)
+        self.posts_per_tick = posts_per_tick
+        self.latency = latency
+        self.comments_per_tick = comments_per_tick
+        self._flow_samples = itertools.cycle(self._fixtures['flow'])
+        self._comment_samples = itertools.cycle(self._fixtures['comments'])
+        self._ids = itertools.count(100000)
+        self._clock = 0
+        self._lock = Lock()
+        self._flow: List[Dict[str, Any]] = []  # от новых к старым
+        self._comments: Dict[int, List[Dict[str, Any]]] = {BORIS_NODE: []}
+        for node in self._fixtures['godnota']:
+            comment = copy.deepcopy(self._fixtures['comments'][0])
+            comment['id'] = next(self._ids)
+            self._comments[node['id']] = [comment]
+        self.requests = 0
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def start(self) -> 'FakeVault':
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _now(self) -> str:
+        self._clock += 1
+        return _timestamp(self._clock)
+
+    def tick(self) -> None:
+        """
+        Публикует следующую порцию постов и комментариев
+        """
+        with self._lock:
+            for _ in range(self.posts_per_tick):
+                post = copy.deepcopy(next(self._flow_samples))
+                post['id'] = next(self._ids)
+                post['created_at'] = self._now()
+                self._flow.insert(0, post)
+            for _ in range(self.comments_per_tick):
+                comment = copy.deepcopy(next(self._comment_samples))
+                comment['id'] = next(self._ids)
+                comment['created_at'] = comment['updated_at'] = self._now()
+                self._comments[BORIS_NODE].insert(0, comment)
+
+    def _stats(self) -> Dict[str, Any]:
+        flow = self._flow[0]['created_at'] if self._flow else _timestamp(0)
+        boris = self._comments[BORIS_NODE][0]['created_at'] if self._comments[BORIS_NODE] else _timestamp(0)
+        total = sum(map(len, self._comments.values()))
+        return {'users': {'total': 100, 'alive': 10},
+                'nodes': {'images': 0, 'audios': 0, 'videos': 0, 'texts': 0, 'total': len(self._flow)},
+                'comments': {'total': total}, 'files': {'count': 0, 'size': 0},
+                'timestamps': {'boris_last_comment': boris, 'flow_last_post': flow}}
+
+    def _diff(self, params: Dict[str, str]) -> Dict[str, Any]:
+        start = params.get('start', '')
+        before = [post for post in self._flow if post['created_at'] > start]
+        recent = self._fixtures['godnota'] if params.get('with_recent') == 'true' else []
+        return {'before': before, 'after': [], 'heroes': [], 'recent': recent, 'updated': [], 'valid': True}
+
+    def _page(self, node: int, params: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        comments = self._comments.get(node)
+        if comments is None:
+            return None
+        skip = int(params.get('skip', 0))
+        take = int(params.get('take', 10))
+        return {'comments': comments[skip:skip + take], 'comment_count': len(comments)}
+
+    def _call(self, path: str, params: Dict[str, str]) -> Optional[Any]:
+        # Возвращает JSON ответа или None для 404
+        with self._lock:
+            self.requests += 1
+            if path == '/stats/':
+                return self._stats()
+            if path == '/flow/diff':
+                return self._diff(params)
+            if path == '/tag/nodes':
+                return {'nodes': self._fixtures['godnota'], 'count': len(self._fixtures['godnota'])}
+            parts = path.strip('/').split('/')
+            if len(parts) == 3 and parts[0] == 'node' and parts[2] == 'comment' and parts[1].isdigit():
+                return self._page(int(parts[1]), params)
+        return None
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # иначе заголовки и тело уходят разными пакетами с задержкой ACK
+
+            def do_GET(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                url = urlparse(self.path)
+                if url.path.startswith('/static/'):
+                    self._reply(200, b'\xff\xd8\xff\xe0 fake jpeg ' + url.path.encode(), 'image/jpeg')
+                    return
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                response = fake._call(url.path, params)
+                if response is None:
+                    self._reply(404, b'{"error": "not found"}', 'application/json')
+                else:
+                    self._reply(200, json.dumps(response).encode(), 'application/json')
+
+            def _reply(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        return Handler
+
+
+__all__ = ['FakeVault']
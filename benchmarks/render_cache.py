@@ -0,0 +1,78 @@
+"""
+Время ответа на команды со сборкой ответа на каждый вызов (как было) и с готовыми ответами из render_cache.
+"Без кэша" -- кэш сбрасывается перед каждым вызовом, то есть справка и клавиатура собираются заново.
+
+Меряются обработчики целиком, вместе с сериализацией клавиатуры в JSON, только вместо отправки
+в телеграм -- пустая функция:
+/help -- справка для уровня доступа пользователя
+/sub -- клавиатура подписки (и начало разговора, которое пишется в журнал БД)
+кнопка -- перерисовка клавиатуры после нажатия кнопки меню /sub
+
+python -m benchmarks.render_cache
+"""
+from types import SimpleNamespace
+import tempfile
+import timeit
+from telebot import apihelper, types
+import database
+from benchmarks.fake_telegram import make_update
+
+GODNOTA_SIZES = [10, 100]
+NUMBER = 2000
+USER_ID = 1000
+
+
+def _make_bot():
+    from telegram import Bot
+    from telegram.conversations import Conversations
+    from telegram.render_cache import RenderCache
+    bot = Bot.__new__(Bot)  # без сети: нужны только пользователи, разговоры и кэш
+    bot._users = {str(USER_ID): {'access_level': 2}}
+    bot.conversations = Conversations()
+    bot.render_cache = RenderCache()
+
+    def send_message(chat_id, text, reply_markup=None, **kwargs):
+        apihelper._convert_markup(reply_markup)  # то, что telebot делает с клавиатурой перед отправкой
+        return SimpleNamespace(message_id=1)
+
+    bot.send_message = send_message
+    return bot
+
+
+def _measure(bot, function, cached: bool) -> float:
+    if cached:
+        function()  # первый вызов собирает ответ
+        return timeit.timeit(function, number=NUMBER) / NUMBER * 1e6
+
+    def uncached():
+        bot.render_cache.invalidate()
+        function()
+
+    return timeit.timeit(uncached, number=NUMBER) / NUMBER * 1e6
+
+
+def main():
+    database.FILE_PATH = tempfile.mkdtemp(prefix='boris48bot-') + '/'
+    from global_variables import TELEGRAM_BOT
+    bot = TELEGRAM_BOT.value = _make_bot()
+    from plugins import help_plugin
+    from plugins.vault_plugin import Vault
+    message = types.Message.de_json(make_update(1, USER_ID, '/help')['message'])
+    print('{:>8} {:>10} {:>16} {:>16}'.format('годнота', 'команда', 'без кэша, мкс', 'с кэшом, мкс'))
+    for size in GODNOTA_SIZES:
+        vault = Vault(True)
+        vault._godnota = {'Коллекция номер {}'.format(number): number for number in range(size)}
+        vault._last_updates['comments'] = {number: {'timestamp': None} for number in range(size)}
+        vault._ready.set()
+        vault._subscriptions.subscribe(USER_ID, ['flow', 0])
+        commands = {'/help': lambda: help_plugin.help_message(message),
+                    '/sub': lambda: vault.sub(message),
+                    'кнопка': lambda: apihelper._convert_markup(vault._menu(USER_ID, True))}
+        for name, function in commands.items():
+            print('{:>8} {:>10} {:>16.1f} {:>16.1f}'.format(size, name, _measure(bot, function, cached=False),
+                                                            _measure(bot, function, cached=True)))
+    print(bot.render_cache.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Шардированный режим (dispatcher/sharding.py) с разным числом процессов-воркеров: COMMANDS команд /help
+от разных пользователей сразу кладутся в поддельный телеграм, и меряется, за сколько бот ответил на все
+(и на каждую: p50/p99 от появления обновления до ответа) -- сначала от новых пользователей (каждый -- запись
+в общую БД), потом от тех же, уже знакомых. Поддельные телеграм и Убежище работают в своем
+процессе, чтобы не делить GIL с роутером. Заодно проверяется, что каждый получил ровно один ответ
+и что периодичные плагины крутит ровно один лидер.
+
+python -m benchmarks.sharding
+"""
+from threading import Thread
+import functools
+import glob
+import multiprocessing
+import os
+import tempfile
+import time
+from benchmarks.vault_throughput import _serve
+
+SHARDS = [1, 2, 4]
+COMMANDS = 2000
+FIRST_USER = 1000
+
+
+def _prepare(api_url: str, vault_url: str, directory: str) -> None:
+    # Вызывается в каждом воркере до импорта плагинов
+    import database
+    import vault_api
+    from telebot import apihelper
+    from utils import log
+    os.chdir(directory)  # логи воркеров -- туда же, где БД
+    database.FILE_PATH = directory + '/'
+    database.DATABASE_STORAGE = database.SQLITE
+    vault_api.TEST_URL = vault_api.MAIN_URL = vault_url
+    apihelper.API_URL = api_url
+    log.LOG_ECHO = False
+
+
+def _measure(shards: int, connection, api_url: str, vault_url: str) -> str:
+    import database
+    from config import BOT_OWNER_ID
+    from dispatcher import sharding
+    from telebot import apihelper
+    directory = tempfile.mkdtemp(prefix='boris48bot-')
+    database.DATABASE_STORAGE = database.SQLITE
+    apihelper.API_URL = api_url
+    sharding.POLL_TIMEOUT = 1
+    connection.send(('sent', 0))
+    first = len(connection.recv())
+    router = Thread(target=sharding.run, args=('1:benchmark', shards),
+                    kwargs={'prepare': functools.partial(_prepare, api_url, vault_url, directory)})
+    router.start()
+    connection.send(('push', BOT_OWNER_ID, '/help'))  # ждем, пока воркеры загрузятся
+    connection.recv()
+    while True:
+        connection.send(('sent', first))
+        if any(chat_id == BOT_OWNER_ID for _, chat_id in connection.recv()):
+            break
+        time.sleep(0.1)
+    rows = [_round(shards, 'новые', connection), _round(shards, 'знакомые', connection)]
+    time.sleep(2)  # логи воркеров пишутся раз в секунду; лидеров считаем до /stop, после него лидерство может перейти
+    leaders = 0
+    for filename in glob.glob(directory + '/logfile.shard*.log'):
+        with open(filename, encoding='utf-8') as log_file:
+            leaders += log_file.read().count('стал лидером')
+    connection.send(('push', BOT_OWNER_ID, '/stop'))
+    connection.recv()
+    router.join()
+    return '\n'.join(row + ' {:>7}'.format(leaders) for row in rows)
+
+
+def _round(shards: int, name: str, connection) -> str:
+    # Пользователи в первом раунде пишут боту впервые (каждый -- запись в общую БД), во втором -- уже нет
+    connection.send(('sent', 0))
+    first = len(connection.recv())
+    pushed = {}
+    for user in range(FIRST_USER, FIRST_USER + COMMANDS):
+        connection.send(('push', user, '/help'))
+        pushed[user] = connection.recv()
+    replies = {}
+    while len(replies) < COMMANDS:
+        time.sleep(0.05)
+        connection.send(('sent', first))
+        replies = {}
+        for moment, chat_id in connection.recv():
+            if chat_id in pushed:
+                replies.setdefault(chat_id, []).append(moment)
+    elapsed = max(moments[0] for moments in replies.values()) - min(pushed.values())
+    latencies = sorted(moments[0] - pushed[chat_id] for chat_id, moments in replies.items())
+    duplicates = sum(len(moments) - 1 for moments in replies.values())
+    return '{:>7} {:>9} {:>9.2f} {:>10.0f} {:>9.1f} {:>9.1f} {:>7}'.format(
+        shards, name, elapsed, COMMANDS / elapsed, latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000, duplicates)
+
+
+def main():
+    connection, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(child, None), daemon=True)
+    server.start()
+    vault_url, api_url = connection.recv()
+    print('{:>7} {:>9} {:>9} {:>10} {:>9} {:>9} {:>7} {:>7}'.format(
+        'воркеры', 'юзеры', 'время, с', 'команд/с', 'p50, мс', 'p99, мс', 'дублей', 'лидеров'))
+    for shards in SHARDS:
+        print(_measure(shards, connection, api_url, vault_url))
+    connection.send(('stop',))
+    connection.recv()
+
+
+if __name__ == '__main__':
+    main()
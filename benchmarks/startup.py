@@ -0,0 +1,86 @@
+"""
+Время старта бота: от начала запуска (до импорта плагинов) до первого обработанного обновления
+и до готовности vault_plugin, против медленного поддельного Убежища (LATENCY секунд на каждый ответ).
+Обновление /help лежит в поддельном телеграме еще до старта, так что первое обновление бот получает
+первым же getUpdates. Ответ на /sub до готовности vault_plugin -- просьба подождать.
+
+python -m benchmarks.startup
+"""
+from threading import Thread
+import multiprocessing
+import tempfile
+import time
+
+LATENCY = 0.5  # Столько думает Убежище над каждым запросом
+CHAT_ID = 1000
+
+
+def _serve(connection) -> None:
+    from benchmarks.fake_vault import FakeVault
+    from benchmarks.fake_telegram import FakeTelegram
+    vault = FakeVault(latency=LATENCY).start()
+    telegram = FakeTelegram().start()
+    vault.tick()
+    telegram.push_update(CHAT_ID, '/help')
+    telegram.push_update(CHAT_ID + 1, '/sub')
+    connection.send((vault.url, telegram.api_url))
+    while True:
+        command = connection.recv()
+        if command == 'sent':
+            connection.send([(item['time'], item['params'].get('text', '')) for item in telegram.sent])
+        elif command == 'stop':
+            vault.stop()
+            telegram.stop()
+            connection.send(None)
+            return
+
+
+def main() -> None:
+    connection, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(child,), daemon=True)
+    server.start()
+    vault_url, api_url = connection.recv()
+
+    started = time.monotonic()
+    import database
+    import vault_api
+    from telebot import apihelper
+    database.FILE_PATH = tempfile.mkdtemp(prefix='boris48bot-') + '/'
+    vault_api.TEST_URL = vault_api.MAIN_URL = vault_url
+    apihelper.API_URL = api_url
+    from telegram import Bot
+    from global_variables import TELEGRAM_BOT, RUNNING_FLAG
+    from dispatcher import Dispatcher
+    bot = Bot('1:benchmark', started=started)
+    TELEGRAM_BOT.value = bot
+    from plugins import command_handlers, scheduled_handlers, task_handlers, startup_handlers, callback_handlers
+    from plugins import vault_plugin
+    imported = time.monotonic() - started
+    dispatcher = Dispatcher(bot, command_handlers, scheduled_plugins=scheduled_handlers,
+                            task_handlers=task_handlers, startup_handlers=startup_handlers,
+                            callback_plugins=callback_handlers)
+    dispatcher.start()
+    polling = Thread(target=bot.polling, kwargs={'non_stop': True, 'interval': 0, 'timeout': 1}, daemon=True)
+    polling.start()
+    deadline = time.monotonic() + 60
+    while not vault_plugin.vault.ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+    ready = time.monotonic() - started
+    while bot.first_update_seconds is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    connection.send('sent')
+    sent = connection.recv()
+    RUNNING_FLAG.value = False
+    polling.join(5)
+    dispatcher.join(5)
+    print('импорт плагинов и создание бота: {:.2f} с'.format(imported))
+    print('первое обновление взято в обработку: {:.2f} с'.format(bot.first_update_seconds))
+    print('vault_plugin готов (Убежище отвечает за {} с): {:.2f} с'.format(LATENCY, ready))
+    print('ответов до готовности vault_plugin: {}'.format(sum(1 for moment, _ in sent if moment < started + ready)))
+    connection.send('stop')
+    connection.recv()
+    server.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Сравнивает задержку от появления обновления до вызова обработчика команды в режиме long polling
+и в режиме вебхука (telegram.webhook.WebhookServer).
+
+Long polling: обновления кладутся в поддельный Bot API (benchmarks.fake_telegram), бот забирает их getUpdates.
+Вебхук: поддельный отправитель POST-ит обновления прямо в WebhookServer, как это делает телеграм.
+
+python -m benchmarks.update_latency
+"""
+from threading import Thread, Lock, Event
+import json
+import time
+import requests
+import telebot
+from telebot import apihelper
+from telegram.webhook import WebhookServer
+from benchmarks.fake_telegram import FakeTelegram, make_update
+
+UPDATES = 500
+RATE = 100  # обновлений в секунду
+SECRET = 'benchmark-secret'
+
+
+class Recorder:
+    def __init__(self, expected: int):
+        self.latencies = []
+        self._expected = expected
+        self._lock = Lock()
+        self.done = Event()
+
+    def handler(self, message) -> None:
+        sent_at = float(message.text.split()[1])
+        with self._lock:
+            self.latencies.append(time.perf_counter() - sent_at)
+            if len(self.latencies) >= self._expected:
+                self.done.set()
+
+    def report(self, name: str) -> str:
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return '{:>8}: нет ни одного обработанного обновления'.format(name)
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return '{:>8}: обработано {}/{}, p50 {:.2f} мс, p99 {:.2f} мс'.format(
+            name, len(latencies), self._expected, p50 * 1000, p99 * 1000)
+
+
+def _make_bot(recorder: Recorder) -> telebot.TeleBot:
+    bot = telebot.TeleBot('1:benchmark', threaded=True, num_threads=4)
+    bot.message_handler(commands=['ping'])(recorder.handler)
+    return bot
+
+
+def _send_at_rate(send) -> None:
+    for number in range(UPDATES):
+        send(number, '/ping {}'.format(time.perf_counter()))
+        time.sleep(1 / RATE)
+
+
+def polling() -> Recorder:
+    fake = FakeTelegram().start()
+    apihelper.API_URL = fake.api_url
+    recorder = Recorder(UPDATES)
+    bot = _make_bot(recorder)
+    Thread(target=bot.polling, kwargs={'non_stop': True, 'interval': 0, 'timeout': 10}, daemon=True).start()
+    time.sleep(0.5)
+    _send_at_rate(lambda number, text: fake.push_update(1000 + number % 50, text))
+    recorder.done.wait(10)
+    bot.stop_polling()
+    fake.stop()
+    return recorder
+
+
+def webhook() -> Recorder:
+    recorder = Recorder(UPDATES)
+    bot = _make_bot(recorder)
+    server = WebhookServer(bot, port=0, path='/hook', secret_token=SECRET)
+    server.start()
+    session = requests.Session()
+    url = 'http://127.0.0.1:{}/hook'.format(server.port)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET, 'Content-Type': 'application/json'}
+
+    def send(number, text):
+        update = make_update(number + 1, 1000 + number % 50, text)
+        session.post(url, data=json.dumps(update), headers=headers)
+
+    _send_at_rate(send)
+    recorder.done.wait(10)
+    server.stop()
+    return recorder
+
+
+def main() -> None:
+    print(polling().report('polling'))
+    print(webhook().report('webhook'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Сквозной бенчмарк: бот целиком (Bot, Delivery, MediaCache, Vault, обработчики команд) против поддельных
+Убежища (benchmarks.fake_vault) и Bot API (benchmarks.fake_telegram, с 429 сверх FLOOD_RATE отправок в секунду).
+
+Рассылка: FakeVault публикует порцию постов и комментариев, Vault.scheduled находит их, задания отрабатывают
+обработчики из plugins.task_handlers, пока Delivery не опустеет. Задержка -- от вызова Vault.scheduled до того,
+как сообщение дошло до поддельного телеграма.
+Команды: поддельный телеграм отдает COMMANDS команд через getUpdates, задержка -- от появления обновления до ответа.
+
+Поддельные серверы работают в отдельном процессе, так что пиковый RSS -- это память одного бота.
+Каждый размер запускается в своем процессе:
+
+python -m benchmarks.vault_throughput              # 1000, 10000, 100000 подписчиков
+python -m benchmarks.vault_throughput 5000         # один размер
+"""
+from typing import List
+from threading import Thread
+import multiprocessing
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+SIZES = [1000, 10000, 100000]
+ROUNDS = 1
+POSTS_PER_TICK = 1
+COMMENTS_PER_TICK = 2
+COMMANDS = 200
+FLOOD_RATE = 500  # сколько отправок в секунду принимает поддельный телеграм (сам он на питоне тянет около 600)
+DELIVERY_RATE = 600  # собственный предел бота -- чуть выше, чтобы 429 тоже случались
+DELIVERY_WORKERS = 16
+FIRST_SUBSCRIBER = 10 ** 6
+
+
+def _serve(connection, flood_rate: int) -> None:
+    from benchmarks.fake_vault import FakeVault
+    from benchmarks.fake_telegram import FakeTelegram
+    vault = FakeVault(posts_per_tick=POSTS_PER_TICK, comments_per_tick=COMMENTS_PER_TICK).start()
+    telegram = FakeTelegram(flood_rate=flood_rate).start()
+    connection.send((vault.url, telegram.api_url))
+    while True:
+        command, *args = connection.recv()
+        if command == 'tick':
+            vault.tick()
+            connection.send(None)
+        elif command == 'push':
+            telegram.push_update(*args)
+            connection.send(time.monotonic())
+        elif command == 'sent':  # [(время, chat_id)...] начиная с номера args[0]
+            connection.send([(item['time'], int(item['params'].get('chat_id', 0)))
+                             for item in telegram.sent[args[0]:]])
+        elif command == 'stats':
+            connection.send({'rejected': telegram.rejected, 'vault_requests': vault.requests})
+        elif command == 'stop':
+            vault.stop()
+            telegram.stop()
+            connection.send(None)
+            return
+
+
+def _ask(connection, *command):
+    connection.send(command)
+    return connection.recv()
+
+
+def _percentiles(latencies: List[float]) -> str:
+    latencies = sorted(latencies)
+    if not latencies:
+        return 'p50 -, p99 -'
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return 'p50 {:.2f} с, p99 {:.2f} с'.format(p50, p99)
+
+
+def run(subscribers: int) -> None:
+    connection, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(child, FLOOD_RATE), daemon=True)
+    server.start()
+    vault_url, api_url = connection.recv()
+
+    # Все, что ходит в сеть или на диск, перенаправляется до импорта плагинов: vault_plugin создает Vault при импорте
+    # (а в Убежище Vault ходит уже в start)
+    import database
+    import vault_api
+    from telebot import apihelper
+    database.FILE_PATH = tempfile.mkdtemp(prefix='boris48bot-') + '/'
+    vault_api.TEST_URL = vault_api.MAIN_URL = vault_url
+    apihelper.API_URL = api_url
+    from telegram import Bot
+    from telegram.delivery import Delivery
+    from telegram.media import MediaCache
+    from global_variables import TELEGRAM_BOT
+    from dispatcher.tasks import Task
+    bot = Bot('1:benchmark')
+    bot.delivery = Delivery(bot, workers=DELIVERY_WORKERS, global_rate=DELIVERY_RATE)
+    bot.media = MediaCache(bot.delivery)
+    TELEGRAM_BOT.value = bot
+    from plugins import command_handlers, task_handlers, vault_plugin
+    vault = vault_plugin.vault
+    vault.start()
+    ids = list(range(FIRST_SUBSCRIBER, FIRST_SUBSCRIBER + subscribers))
+    vault._subscriptions.add_subscribers('flow', ids)
+    vault._subscriptions.add_subscribers('boris', ids)
+
+    latencies = []
+    sent = 0
+    elapsed = 0.0
+    for _ in range(ROUNDS):
+        _ask(connection, 'tick')
+        started = time.monotonic()
+        for task in Task.from_result(vault.scheduled() or []):
+            task_handlers[task.name](task)
+        while bot.delivery.queue_size():
+            time.sleep(0.01)
+        elapsed += time.monotonic() - started
+        round_sent = _ask(connection, 'sent', sent)
+        sent += len(round_sent)
+        latencies.extend(moment - started for moment, _ in round_sent)
+    stats = _ask(connection, 'stats')
+    print('{:>7} подписчиков: рассылка {} сообщ. за {:.1f} с, {:.0f} сообщ./сек, задержка {}, 429: {}'.format(
+        subscribers, len(latencies), elapsed, len(latencies) / elapsed if elapsed else 0.0,
+        _percentiles(latencies), stats['rejected']))
+    print('{:>7}  кэш картинок: {}'.format('', bot.media.report()))
+
+    bot.load_command_plugins(list(command_handlers))
+    polling = Thread(target=bot.polling, kwargs={'non_stop': True, 'interval': 0, 'timeout': 1}, daemon=True)
+    polling.start()
+    commands = ['/help', '/start', '/sub', '/digest']
+    pushed = {}
+    started = time.monotonic()
+    for number in range(COMMANDS):
+        pushed[number + 1] = _ask(connection, 'push', number + 1, commands[number % len(commands)])
+    answered = {}
+    deadline = time.monotonic() + 30
+    while len(answered) < COMMANDS and time.monotonic() < deadline:
+        for moment, chat_id in _ask(connection, 'sent', sent):
+            sent += 1
+            if chat_id in pushed and chat_id not in answered:
+                answered[chat_id] = moment - pushed[chat_id]
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+    bot.stop_polling()
+    polling.join(5)  # пусть последний getUpdates закончится до остановки серверов
+    print('{:>7}       команды: {}/{} за {:.1f} с, {:.0f} команд/сек, задержка ответа {}'.format(
+        '', len(answered), COMMANDS, elapsed, len(answered) / elapsed, _percentiles(list(answered.values()))))
+    print('{:>7}   пиковый RSS: {:.1f} МБ'.format('', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    _ask(connection, 'stop')
+    server.join()
+
+
+def main():
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+        return
+    for size in SIZES:
+        subprocess.run([sys.executable, '-m', 'benchmarks.vault_throughput', str(size)], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Сравнивает модели vault_api.types со старыми (словарными, с жадным разбором вложенных объектов)
+на ответе Бориса из 500 комментариев: время разбора и количество живых блоков памяти после разбора (tracemalloc).
+
+Два сценария:
+scan -- как Vault._update_comments: пройти комментарии до первого старого (здесь 20 новых) и взять автора
+full -- прочитать у всех комментариев текст, автора и ссылки на файлы
+"""
+import time
+import tracemalloc
+from vault_api import types
+
+COMMENTS = 500
+NEW_COMMENTS = 20
+ROUNDS = 200
+
+
+def _user(number):
+    return {'id': number, 'username': 'user{}'.format(number), 'photo': {'url': 'REMOTE_CURRENT://photo.jpg'},
+            'role': 'USER', 'fullname': 'Юзер', 'description': 'описание', 'last_seen': '2020-01-01T00:00:00.000Z',
+            'last_seen_messages': '2020-01-01T00:00:00.000Z', 'created_at': '2019-01-01T00:00:00.000Z',
+            'updated_at': '2019-01-01T00:00:00.000Z'}
+
+
+def _file(number):
+    return {'id': number, 'name': 'file.jpg', 'path': 'uploads/file.jpg', 'url': 'REMOTE_CURRENT://uploads/file.jpg',
+            'size': 1000, 'type': 'image', 'mime': 'image/jpeg', 'metadata': {'width': 100, 'height': 100},
+            'created_at': '2020-01-01T00:00:00.000Z', 'updated_at': '2020-01-01T00:00:00.000Z'}
+
+
+def payload():
+    comments = []
+    for number in range(COMMENTS):
+        timestamp = '2020-01-01T00:{:02d}:{:02d}.000Z'.format(59 - number // 60 % 60, 59 - number % 60)
+        comments.append({'id': number, 'text': 'комментарий ' * 20, 'files_order': None,
+                         'created_at': timestamp, 'updated_at': timestamp,
+                         'files': [_file(number)] if number % 5 == 0 else [], 'user': _user(number % 30)})
+    return {'comments': comments, 'comment_count': COMMENTS}
+
+
+class _EagerComment:
+    def __init__(self, dictionary):
+        self.id = dictionary['id']
+        self.text = dictionary['text']
+        files_order = dictionary['files_order']
+        self.files_order = [] if files_order is None else files_order
+        self.created_at = dictionary['created_at']
+        self.updated_at = dictionary['updated_at']
+        self.files = [_EagerFile(file) for file in dictionary['files']]
+        self.user = _EagerUser(dictionary['user'])
+
+
+class _EagerFile:
+    def __init__(self, dictionary):
+        self.id = dictionary['id']
+        self.name = dictionary['name']
+        self.path = dictionary['path']
+        self.url = dictionary['url'].replace('REMOTE_CURRENT://', types.URL)
+        self.size = dictionary['size']
+        self.type = dictionary['type']
+        self.mime = dictionary['mime']
+        self.metadata = dictionary['metadata']
+        self.created_at = dictionary['created_at']
+        self.updated_at = dictionary['updated_at']
+
+
+class _EagerUser:
+    def __init__(self, dictionary):
+        self.id = dictionary['id']
+        photo = dictionary['photo']
+        photo = photo['url'] if isinstance(photo, dict) else photo
+        self.photo = photo.replace('REMOTE_CURRENT://', types.URL) if photo is not None else ''
+        self.username = dictionary['username']
+        self.role = dictionary['role']
+        self.fullname = dictionary['fullname']
+        self.description = dictionary['description']
+        self.last_seen = dictionary['last_seen']
+        self.last_seen_messages = dictionary['last_seen_messages']
+        self.created_at = dictionary['created_at']
+        self.updated_at = dictionary['updated_at']
+
+
+class _EagerComments:
+    def __init__(self, dictionary):
+        self.comments = [_EagerComment(comment) for comment in dictionary['comments']]
+        self.comment_count = dictionary['comment_count']
+
+
+def scan(comments_class, data):
+    boundary = data['comments'][NEW_COMMENTS]['created_at']
+    found = []
+    for comment in comments_class(data).comments:
+        if comment.created_at <= boundary:
+            break
+        found.append((comment.user.username, comment.text))
+    return found
+
+
+def full(comments_class, data):
+    return [(comment.text, comment.user.username, [file.url for file in comment.files])
+            for comment in comments_class(data).comments]
+
+
+def measure(scenario, comments_class, data):
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        scenario(comments_class, data)
+    elapsed = (time.perf_counter() - started) / ROUNDS
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    result = scenario(comments_class, data)
+    snapshot_after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in snapshot_after.compare_to(snapshot_before, 'filename'))
+    del result
+    return elapsed, blocks
+
+
+def main():
+    types.URL = 'https://pig.vault48.org/static/'
+    data = payload()
+    print('{:>6} {:>8} {:>12} {:>12}'.format('', 'models', 'ms/parse', 'live blocks'))
+    for scenario in (scan, full):
+        for name, comments_class in (('eager', _EagerComments), ('lazy', types.Comments)):
+            elapsed, blocks = measure(scenario, comments_class, data)
+            print('{:>6} {:>8} {:>12.3f} {:>12}'.format(scenario.__name__, name, elapsed * 1000, blocks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+/who на коллекциях пользователей разного размера: как было (весь список одной строкой через += по копии
+всех документов) и как стало (страница из PAGE_SIZE пользователей). Меряются время ответа, пиковая память
+на ответ (tracemalloc) и длина сообщения, которое пришлось бы отправить (телеграм принимает до 4096 символов).
+"стало, 1-й" -- первый /who после того, как боту написал новый пользователь (список имен собирается заново),
+"стало" -- следующие страницы
+
+python -m benchmarks.who
+"""
+from types import SimpleNamespace
+import tempfile
+import time
+import tracemalloc
+import database
+from database import Database, RANGE, EQUALITY
+
+SIZES = [1000, 10000, 100000]
+OWNER = 1
+
+
+def _legacy_who(bot) -> str:
+    answer = "Вот кого я знаю:\n"
+    row_template = '{} {} {} ({}) {} {}\n'
+    users = {user_id: bot.db.get_document(user_id) for user_id in bot.db.get_document_names()}
+    for user_id, user_info in users.items():
+        is_bot = 'робот:   ' if user_info['is_bot'] else 'человек: '
+        answer += row_template.format(user_id, is_bot, user_info['first_name'] or '...',
+                                      user_info['username'] or '...', user_info['last_name'] or '...',
+                                      user_info['access_level'])
+    return answer
+
+
+def _measure(function) -> tuple:
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    from telegram import Bot
+    from telegram.render_cache import RenderCache
+    from global_variables import TELEGRAM_BOT
+    from plugins import who_plugin
+    print('{:>7} {:>12} {:>10} {:>12} {:>10}'.format('users', 'вариант', 'время, мс', 'память, КБ', 'символов'))
+    for size in SIZES:
+        database.FILE_PATH = tempfile.mkdtemp(prefix='boris48bot-') + '/'
+        bot = TELEGRAM_BOT.value = Bot.__new__(Bot)  # без сети: нужна только коллекция users
+        bot.db = Database('users', indexes={'access_level': RANGE, 'is_bot': EQUALITY})
+        bot.render_cache = RenderCache()
+        for number in range(OWNER, OWNER + size):
+            bot.db.update_document(str(number), fields_with_content={
+                'username': 'user{}'.format(number), 'first_name': 'Имя', 'last_name': None,
+                'is_bot': number % 10 == 0, 'access_level': 1})
+        sent = []
+        bot.send_message = lambda chat_id, text, **kwargs: sent.append(text)
+        message = SimpleNamespace(text='/who', from_user=SimpleNamespace(id=OWNER))
+        who_plugin.who(message)  # первый поиск строит индексы БД
+        bot.render_cache.invalidate()
+        humans = SimpleNamespace(text='/who люди', from_user=message.from_user)
+        variants = {'было': lambda: _legacy_who(bot),
+                    'стало, 1-й': lambda: who_plugin.who(message) or sent[-1],
+                    'стало': lambda: who_plugin.who(message) or sent[-1],
+                    'люди, 1-й': lambda: who_plugin.who(humans) or sent[-1],
+                    'люди': lambda: who_plugin.who(humans) or sent[-1]}
+        for name, function in variants.items():
+            text, elapsed, peak = _measure(function)
+            print('{:>7} {:>12} {:>10.1f} {:>12.0f} {:>10}'.format(size, name, elapsed * 1000, peak / 1024, len(text)))
+
+
+if __name__ == '__main__':
+    main()
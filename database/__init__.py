@@ -6,12 +6,56 @@
 Документ -- словарь вида {имя_поля: значение}. Имя_поля может быть только типа str, ибо нефиг. Значение -- любого типа
 Коллекция -- словарь вида {имя_документа: документ}. Имя_документа может быть только типов int и str,
 ибо, опять же, нефиг
+Журнал -- файл коллекция.journal рядом с коллекция.bson, в который дописываются только изменения документов
+(подряд идущие BSON-документы вида {'name': имя_документа, 'fields': {имя_поля: значение}}).
+Время от времени журнал сливается в коллекция.bson в отдельном треде
+
+Блокировки (см. database.locks): у каждого файла коллекции один threading.RLock на процесс.
+Если несколько процессов бота работают с одной папкой res/bsons, нужно выставить DATABASE_PROCESS_LOCKS = True
+в config.py -- тогда файлы еще и блокируются через fcntl.flock. Файлы коллекций всегда пишутся во временный файл
+и подменяются переименованием, так что читатель никогда не увидит недописанный файл.
+Статистику ожидания и удержания блокировок возвращает lock_stats()
+
+Индексы (см. database.indexes): на поля коллекции можно повесить индекс равенства или диапазона.
+Если в get_document_names условие для такого поля задано через Equals или Range, документы ищутся по индексу,
+а не перебором всей коллекции. Пример:
+db = Database('users', indexes={'access_level': RANGE, 'is_bot': EQUALITY})
+db.get_document_names({'is_bot': Equals(False), 'access_level': Range(low=1)})
+
+Хранилища: по умолчанию (BSON) коллекция целиком лежит в коллекция.bson и целиком читается в память при открытии.
+С DATABASE_STORAGE = 'sqlite' в config.py (или Database(..., storage=SQLITE)) коллекция лежит в коллекция.sqlite
+(см. database.sqlite_storage): при открытии читаются только имена документов, документы -- при первом обращении,
+а save_and_update пишет только измененные поля одной транзакцией. Журнал в этом режиме не нужен и не ведется.
+Перенести существующие .bson в SQLite: python -m database.migrate
+
+Изменения от других процессов (только SQLite): watch(функция) -- раз в WATCH_INTERVAL секунд фоновый тред
+смотрит, что в файл коллекции записали другие процессы (или другие объекты Database той же коллекции),
+перечитывает эти документы и вызывает функцию со словарем {имя_документа: {имя_поля...}}
 """
 
 import bson
+import copy
+import os
 import os.path
-import time
+from threading import Thread, Lock
 from typing import Any, Dict, List, Set, Union, Optional, Callable
+import time
+from .locks import LockManager
+from .indexes import Equals, Range, EQUALITY, RANGE, make_index, pick_index
+from .sqlite_storage import SqliteCollection
+from utils import log, metrics
+
+try:
+    from config import DATABASE_PROCESS_LOCKS
+except ImportError:
+    DATABASE_PROCESS_LOCKS = False
+try:
+    from config import DATABASE_STORAGE
+except ImportError:
+    DATABASE_STORAGE = 'bson'
+
+BSON = 'bson'
+SQLITE = 'sqlite'
 
 
 class Database:
@@ -24,21 +68,52 @@ class Database:
     get_document_names: возвращает имена всех документов в коллекции
     get_document_names_with_conditions: возвращает имена документов,
     в которых сработало условие для отдельных полей
+    compact: сливает журнал в файл коллекции (только в режиме журнала)
+    add_index: добавляет индекс на поле
+    watch: подписывает функцию на изменения, записанные другими процессами (только SQLite)
+    poll_changes: применяет изменения других процессов и оповещает подписчиков (watch делает это сам)
     """
-    file_lock = {}
 
-    def __init__(self, collection: str):
+    def __init__(self, collection: str, journal: bool = False, indexes: Optional[Dict[str, str]] = None,
+                 storage: Optional[str] = None):
         """
         Создание объекта коллекции. Если коллекция с названием из collection есть на диске -- будет загружена.
         Если нет -- будет создана в памяти.
+        В режиме журнала save_and_update не перезаписывает всю коллекцию, а дописывает в журнал только изменения.
+        Если после прошлого запуска остался журнал (например, бот упал), он будет применен к коллекции.
 
         :param collection: название для коллекции.
+        :param journal: включить режим журнала
+        :param indexes: словарь вида {имя_поля: EQUALITY или RANGE}
+        :param storage: BSON или SQLITE; по умолчанию -- DATABASE_STORAGE из config.py
         """
-        self._filename = FILE_PATH + collection + '.bson'
-        if self._filename not in self.__class__.file_lock:
-            self.__class__.file_lock[self._filename] = False
+        self._name = collection
+        self._storage = storage or DATABASE_STORAGE
+        if self._storage not in (BSON, SQLITE):
+            raise ValueError('database: неизвестное хранилище ' + str(self._storage))
+        if self._storage == SQLITE:
+            self._filename = FILE_PATH + collection + '.sqlite'
+            self._journal = None
+        else:
+            self._filename = FILE_PATH + collection + '.bson'
+            self._journal = FILE_PATH + collection + '.journal' if journal else None
+        self._lock = LOCKS.get(self._filename)
         self._collection = None
-        self._init_collection()
+        self._dirty: Dict[Union[str, int], dict] = {}
+        self._compactor: Optional[Thread] = None
+        self._compact_lock = Lock()
+        self._indexes = {field: make_index(field, kind) for field, kind in (indexes or {}).items()}
+        self._indexed = True  # В SQLite индексы строятся при первом поиске по условию, а не при открытии
+        self._watchers: List[Callable[[Dict[str, Set[str]]], None]] = []
+        self._watcher: Optional[Thread] = None
+        self._watch_lock = Lock()
+        self._seen = 0  # номер последнего просмотренного изменения в SQLite
+        with self._lock:
+            self._init_collection()
+            if self._journal is not None:
+                self._recover()
+        if self._storage == SQLITE:
+            self._seen = self._collection.last_change()
 
     def _load(self) -> Optional[Dict[Any, dict]]:
         if os.path.exists(self._filename):
@@ -49,11 +124,54 @@ class Database:
             return None
 
     def _init_collection(self) -> None:
+        if self._storage == SQLITE:
+            if self._collection is None:
+                self._collection = SqliteCollection(self._filename)
+                self._indexed = not self._indexes
+            return
         collection = self._load()
         if collection is None:
             self._collection = {}
         else:
             self._collection = collection
+        self._reindex()
+
+    def _reindex(self) -> None:
+        for index in self._indexes.values():
+            index.clear()
+        if self._indexes:
+            for name, document in self._collection.items():
+                for index in self._indexes.values():
+                    index.update(name, document)
+        self._indexed = True
+
+    def add_index(self, field: str, kind: str = EQUALITY) -> None:
+        """
+        Добавляет индекс на поле и заполняет его по текущей коллекции
+
+        :param field: имя поля
+        :param kind: EQUALITY -- для условий Equals, RANGE -- для Equals и Range
+        :return: None
+        """
+        index = make_index(field, kind)
+        with self._lock.memory:
+            for name, document in self._collection.items() if self._indexed else ():
+                index.update(name, document)
+            self._indexes[field] = index
+
+    def _save(self, data: bytes) -> None:
+        """
+        Атомарно записывает коллекцию в файл: сначала во временный файл, потом переименованием поверх старого
+
+        :param data: коллекция, уже сериализованная bson.dumps
+        :return: None
+        """
+        temporary = '{}.{}.tmp'.format(self._filename, os.getpid())
+        with open(temporary, 'wb') as collection_file:
+            collection_file.write(data)
+            collection_file.flush()
+            os.fsync(collection_file.fileno())
+        os.replace(temporary, self._filename)
 
     def save_and_update(self) -> None:
         """
@@ -62,18 +180,133 @@ class Database:
 
         :return: None
         """
-        while self.__class__.file_lock[self._filename]:  # Ожидает отпускания блокировки файла
-            time.sleep(0.01)
-        self.__class__.file_lock[self._filename] = True  # Выставляет блокировку файла
-        current_collection = self._collection  # Сохраняет текущую внутреннюю коллекцию во временный словарь
-        self._init_collection()  # Обновляет внутреннюю коллекцию на случай, если файл был кем-то перезаписан
-        for document in current_collection:  # Проход по документам текущей коллекции
-            if document not in self._collection:  # Если документ не присутствует в коллекции:
-                self._collection[document] = {}  # Создает его во внутренней коллекции как пустой словарь
-            self._collection[document].update(**current_collection[document])  # Обновляет документ
-        with open(self._filename, 'wb') as collection_file:  # Сохраняет изменения в файл
-            collection_file.write(bson.dumps(self._collection))
-        self.__class__.file_lock[self._filename] = False  # Отпускает блокировку
+        with SAVE_SECONDS.time(collection=self._name):
+            self._save_and_update()
+
+    def _save_and_update(self) -> None:
+        if self._journal is not None:
+            self._write_journal()
+            return
+        if self._storage == SQLITE:
+            with self._lock.memory:
+                if not self._dirty:
+                    return
+                dirty, self._dirty = self._dirty, {}
+            with self._lock:
+                self._collection.write(dirty)
+            return
+        with self._lock:  # Ожидает отпускания блокировки файла и выставляет свою
+            current_collection = self._collection  # Сохраняет текущую внутреннюю коллекцию во временный словарь
+            self._init_collection()  # Обновляет внутреннюю коллекцию на случай, если файл был кем-то перезаписан
+            for document in current_collection:  # Проход по документам текущей коллекции
+                if document not in self._collection:  # Если документ не присутствует в коллекции:
+                    self._collection[document] = {}  # Создает его во внутренней коллекции как пустой словарь
+                self._collection[document].update(**current_collection[document])  # Обновляет документ
+            self._reindex()
+            self._save(bson.dumps(self._collection))  # Сохраняет изменения в файл
+
+    def _write_journal(self) -> None:
+        """
+        Дописывает изменения документов с прошлого сохранения в журнал и дожидается их записи на диск.
+        Если журнал разросся -- запускает его слияние с коллекцией в отдельном треде
+
+        :return: None
+        """
+        with self._lock.memory:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            records = b''.join(bson.dumps({'name': name, 'fields': fields}) for name, fields in dirty.items())
+        with self._lock:
+            with open(self._journal, 'ab') as journal_file:
+                journal_file.write(records)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+                journal_size = journal_file.tell()
+        if journal_size > JOURNAL_LIMIT and (self._compactor is None or not self._compactor.is_alive()):
+            self._compactor = Thread(target=self.compact, daemon=True)
+            self._compactor.start()
+
+    def _replay(self, filename: str) -> int:
+        """
+        Применяет записи журнала к коллекции. Недописанная при падении последняя запись отбрасывается
+
+        :param filename: файл журнала
+        :return: количество примененных записей
+        """
+        if not os.path.exists(filename):
+            return 0
+        with open(filename, 'rb') as journal_file:
+            data = journal_file.read()
+        offset = 0
+        applied = 0
+        while offset + 4 <= len(data):
+            length = int.from_bytes(data[offset:offset + 4], 'little')
+            if length < 5 or offset + length > len(data):
+                break
+            try:
+                record = bson.loads(data[offset:offset + length])
+            except Exception:
+                break
+            document = self._collection.setdefault(record['name'], {})
+            document.update(record['fields'])
+            for index in self._indexes.values():
+                index.update(record['name'], document)
+            offset += length
+            applied += 1
+        return applied
+
+    def _recover(self) -> None:
+        """
+        Восстанавливает коллекцию после падения: применяет журнал, оставшийся от прерванного слияния,
+        потом текущий журнал, и сразу сливает все в файл коллекции
+
+        :return: None
+        """
+        applied = self._replay(self._journal + '.old') + self._replay(self._journal)
+        if applied or os.path.exists(self._journal + '.old'):
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Сливает журнал в файл коллекции: сериализует состояние коллекции и откладывает журнал в сторону под блокировкой,
+        а записывает на диск уже без нее. Коллекция пишется во временный файл и подменяет старую переименованием,
+        так что при падении на диске всегда есть целая коллекция и журнал к ней.
+        Если с коллекцией работают несколько процессов, состояние берется с диска (файл коллекции и журналы всех
+        процессов), а запись идет под блокировкой, чтобы снимки разных процессов не перетирали друг друга
+
+        :return: None
+        """
+        if self._journal is None:
+            return
+        with self._compact_lock, COMPACT_SECONDS.time(collection=self._name):
+            self._compact()
+
+    def _compact(self) -> None:
+        self._write_journal()
+        with self._lock:
+            if self._lock.process_wide:  # Другие процессы могли дописать в журнал свое
+                self._init_collection()
+                self._replay(self._journal + '.old')
+                self._replay(self._journal)
+            # Сериализуем здесь же: документы держат вложенные словари и списки, которые плагины меняют на месте
+            snapshot = bson.dumps(self._collection)
+            if os.path.exists(self._journal):
+                if os.path.exists(self._journal + '.old'):  # Прошлое слияние не закончилось -- склеиваем журналы
+                    with open(self._journal, 'rb') as journal_file, open(self._journal + '.old', 'ab') as old_file:
+                        old_file.write(journal_file.read())
+                    os.remove(self._journal)
+                else:
+                    os.replace(self._journal, self._journal + '.old')
+            if self._lock.process_wide:
+                self._finish_compaction(snapshot)
+                return
+        self._finish_compaction(snapshot)
+
+    def _finish_compaction(self, snapshot: bytes) -> None:
+        self._save(snapshot)
+        if os.path.exists(self._journal + '.old'):
+            os.remove(self._journal + '.old')
 
     def update_document(self, document_name: Union[str, int], fields: Optional[List[str]] = None,
                         fields_with_content: Optional[Dict[str, Any]] = None) -> None:
@@ -87,12 +320,68 @@ class Database:
         """
         if fields_with_content is None:
             fields_with_content = {}
+        # Копия: иначе коллекция делила бы вложенные словари и списки с плагином, который меняет их на месте,
+        # пока коллекция сериализуется
+        fields_with_content = copy.deepcopy(fields_with_content)
         if fields is not None:
             for field in fields:
                 fields_with_content[field] = None
-        if document_name not in self._collection:
-            self._collection[document_name] = {}
-        self._collection[document_name].update(fields_with_content)
+        with self._lock.memory:
+            if document_name not in self._collection:
+                self._collection[document_name] = {}
+            document = self._collection[document_name]
+            document.update(fields_with_content)
+            self._collection[document_name] = document  # SqliteCollection держит в памяти только измененные
+            for index in self._indexes.values() if self._indexed else ():
+                if index.field in fields_with_content:
+                    index.update(document_name, document)
+            if self._journal is not None or self._storage == SQLITE:
+                self._dirty.setdefault(document_name, {}).update(fields_with_content)
+
+    def watch(self, callback: Callable[[Dict[str, Set[str]]], None]) -> None:
+        """
+        Подписывает функцию на изменения коллекции, записанные другими. Функция вызывается из фонового треда,
+        когда измененные документы уже перечитаны. В BSON изменения других процессов не отслеживаются,
+        и функция не вызывается никогда
+
+        :param callback: функция, принимающая словарь вида {имя_документа: {имя_поля...}}
+        :return: None
+        """
+        if self._storage != SQLITE:
+            return
+        with self._watch_lock:
+            self._watchers.append(callback)
+            if self._watcher is None:
+                self._watcher = Thread(target=self._watch, name='database watch ' + self._name, daemon=True)
+                self._watcher.start()
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            try:
+                self.poll_changes()
+            except Exception as error:
+                log.error('database: ошибка при чтении изменений {}: {}'.format(self._name, error))
+
+    def poll_changes(self) -> Dict[str, Set[str]]:
+        """
+        :return: словарь вида {имя_документа: {имя_поля...}} -- что записали другие с прошлого вызова
+        """
+        if self._storage != SQLITE:
+            return {}
+        with self._watch_lock:
+            self._seen, changes = self._collection.changes(self._seen)
+            if not changes:
+                return changes
+            with self._lock.memory:
+                for name in changes:
+                    self._collection.refresh(name, self._dirty.get(name))
+                    for index in self._indexes.values() if self._indexed else ():
+                        index.update(name, self._collection[name])
+            watchers = list(self._watchers)
+        for callback in watchers:
+            callback(changes)
+        return changes
 
     def get_document(self, name: Union[str, int]) -> Optional[dict]:
         """
@@ -101,13 +390,15 @@ class Database:
         :param name: имя документа
         :return: документ, если таковой имеется, либо None
         """
-        if name in self._collection:
-            return self._collection[name].copy()
+        with self._lock.memory:
+            if name in self._collection:
+                return self._collection[name].copy()
 
     def get_document_names(self, conditions: Optional[Dict[str, Callable[[str], bool]]] = None) -> Set[Union[int, str]]:
         """
         Возвращает имена документов, поля которых удовлетворяют условию, если оно задано, иначе все имена.
-        Условие -- функция, принимающая в качестве аргумента содержимое поля и возвращающая булевое значение
+        Условие -- функция, принимающая в качестве аргумента содержимое поля и возвращающая булевое значение.
+        Если условие -- Equals или Range, а на поле есть подходящий индекс, перебора коллекции не будет
         Например:
         obj.get_document_names_with_condition({'id': lambda _: True})
         Вернет имена документов, в которых есть поле 'id'
@@ -117,26 +408,58 @@ class Database:
         :param conditions: словарь имен полей с функцией для проверки
         :return: Множество имен документов
         """
-        if conditions is None:
-            return set(self._collection.keys())
-        match = set()
-        total_conditions = len(conditions)
-        for document_name, content in self._collection.items():
-            matches = total_conditions
+        with self._lock.memory:
+            if conditions is None:
+                return set(self._collection.keys())
+            if not self._indexed:
+                self._reindex()
+            candidates = None
+            rest = {}
             for field, func in conditions.items():
-                if field in content:
-                    result = func(content[field])
-                    if isinstance(result, bool) and result:
-                        matches -= 1
-            if not matches:
-                match.add(document_name)
-        return match
+                index = pick_index(self._indexes, field, func)
+                if index is None:
+                    rest[field] = func
+                    continue
+                found = index.lookup(func, self._collection)
+                candidates = found if candidates is None else candidates & found
+            if candidates is not None:
+                documents = ((name, self._collection[name]) for name in candidates)
+                conditions = rest
+            else:
+                documents = self._collection.items()
+            match = set()
+            total_conditions = len(conditions)
+            for document_name, content in documents:
+                matches = total_conditions
+                for field, func in conditions.items():
+                    if field in content:
+                        result = func(content[field])
+                        if isinstance(result, bool) and result:
+                            matches -= 1
+                if not matches:
+                    match.add(document_name)
+            return match
+
+
+def lock_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Статистика блокировок коллекций: сколько раз захватывались, сколько секунд их ждали и держали (всего и максимум)
+
+    :return: словарь вида {файл_коллекции: {'acquisitions': ..., 'wait_total': ..., 'wait_max': ...,
+    'hold_total': ..., 'hold_max': ...}}
+    """
+    return LOCKS.stats()
 
 
 FILE_PATH = 'res/bsons/'
+JOURNAL_LIMIT = 1024 * 1024  # Размер журнала в байтах, после которого он сливается в файл коллекции
+WATCH_INTERVAL = 0.5  # Как часто (в секундах) watch проверяет изменения других процессов
+LOCKS = LockManager(process_locks=DATABASE_PROCESS_LOCKS)
+SAVE_SECONDS = metrics.histogram('database_save_seconds', 'Время save_and_update, секунды')
+COMPACT_SECONDS = metrics.histogram('database_compact_seconds', 'Время слияния журнала с коллекцией, секунды')
 
 
-__all__ = ['Database']
+__all__ = ['Database', 'lock_stats', 'Equals', 'Range', 'EQUALITY', 'RANGE', 'BSON', 'SQLITE']
 
 if __name__ == '__main__':
     FILE_PATH = ''
@@ -0,0 +1,212 @@
+"""
+Вторичные индексы коллекций и условия, которые умеют ими пользоваться
+
+Условия -- обычные функции для get_document_names (их можно вызвать от значения поля), но еще и описывают себя,
+поэтому Database может найти подходящие документы по индексу, а не перебирать всю коллекцию:
+Equals(значение) -- поле равно значению
+Range(low, high) -- low <= поле <= high (любую границу можно не указывать)
+
+Индексы:
+EqualityIndex -- словарь {значение: множество имен документов}, отвечает на Equals
+RangeIndex -- отсортированный список значений, отвечает на Equals и Range
+
+Значения, которые индекс не может принять (нехэшируемые для EqualityIndex, несравнимые для RangeIndex),
+складываются в отдельное множество и проверяются условием по одному
+"""
+from typing import Any, Dict, List, Optional, Set, Union
+from bisect import bisect_left, bisect_right
+
+EQUALITY = 'equality'
+RANGE = 'range'
+
+_MISSING = object()
+
+
+class Equals:
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __call__(self, value: Any) -> bool:
+        return value == self.value
+
+    def __repr__(self) -> str:
+        return 'Equals({!r})'.format(self.value)
+
+
+class Range:
+    def __init__(self, low: Any = None, high: Any = None):
+        """
+        :param low: нижняя граница включительно, None -- без границы
+        :param high: верхняя граница включительно, None -- без границы
+        """
+        self.low = low
+        self.high = high
+
+    def __call__(self, value: Any) -> bool:
+        try:
+            return (self.low is None or value >= self.low) and (self.high is None or value <= self.high)
+        except TypeError:
+            return False
+
+    def __repr__(self) -> str:
+        return 'Range({!r}, {!r})'.format(self.low, self.high)
+
+
+class _Index:
+    def __init__(self, field: str):
+        self.field = field
+        self._values: Dict[Union[str, int], Any] = {}  # имя документа -> проиндексированное значение
+        self._others: Set[Union[str, int]] = set()  # документы со значениями, которые индекс не принял
+
+    def update(self, name: Union[str, int], document: dict) -> None:
+        """
+        Приводит индекс в соответствие с документом после его изменения
+
+        :param name: имя документа
+        :param document: документ целиком
+        """
+        value = document.get(self.field, _MISSING)
+        old = self._values.get(name, _MISSING)
+        if old is not _MISSING:
+            if value is not _MISSING and type(value) is type(old) and value == old:
+                return
+            self._remove(name, old)
+            del self._values[name]
+        self._others.discard(name)
+        if value is _MISSING:
+            return
+        if self._add(name, value):
+            self._values[name] = value
+        else:
+            self._others.add(name)
+
+    def clear(self) -> None:
+        self._values.clear()
+        self._others.clear()
+        self._clear()
+
+    def supports(self, condition: Any) -> bool:
+        raise NotImplementedError
+
+    def lookup(self, condition: Any, collection: Dict[Union[str, int], dict]) -> Set[Union[str, int]]:
+        """
+        :param condition: условие, для которого supports() вернул True
+        :param collection: коллекция, чтобы проверить документы, не попавшие в индекс
+        :return: имена документов, у которых поле удовлетворяет условию
+        """
+        found = self._find(condition)
+        for name in self._others:
+            if condition(collection[name][self.field]) is True:
+                found.add(name)
+        return found
+
+    def _add(self, name: Union[str, int], value: Any) -> bool:
+        raise NotImplementedError
+
+    def _remove(self, name: Union[str, int], value: Any) -> None:
+        raise NotImplementedError
+
+    def _clear(self) -> None:
+        raise NotImplementedError
+
+    def _find(self, condition: Any) -> Set[Union[str, int]]:
+        raise NotImplementedError
+
+
+class EqualityIndex(_Index):
+    def __init__(self, field: str):
+        super().__init__(field)
+        self._buckets: Dict[Any, Set[Union[str, int]]] = {}
+
+    def supports(self, condition: Any) -> bool:
+        return isinstance(condition, Equals)
+
+    def _add(self, name: Union[str, int], value: Any) -> bool:
+        try:
+            self._buckets.setdefault(value, set()).add(name)
+        except TypeError:
+            return False
+        return True
+
+    def _remove(self, name: Union[str, int], value: Any) -> None:
+        bucket = self._buckets[value]
+        bucket.discard(name)
+        if not bucket:
+            del self._buckets[value]
+
+    def _clear(self) -> None:
+        self._buckets.clear()
+
+    def _find(self, condition: Equals) -> Set[Union[str, int]]:
+        try:
+            return set(self._buckets.get(condition.value, ()))
+        except TypeError:
+            return set()
+
+
+class RangeIndex(_Index):
+    def __init__(self, field: str):
+        super().__init__(field)
+        self._keys: List[Any] = []  # отсортированные значения
+        self._names: List[Union[str, int]] = []  # имена документов в том же порядке
+
+    def supports(self, condition: Any) -> bool:
+        return isinstance(condition, (Equals, Range))
+
+    def _add(self, name: Union[str, int], value: Any) -> bool:
+        if value is None or isinstance(value, (dict, list)):
+            return False
+        try:
+            position = bisect_right(self._keys, value)
+        except TypeError:
+            return False
+        self._keys.insert(position, value)
+        self._names.insert(position, name)
+        return True
+
+    def _remove(self, name: Union[str, int], value: Any) -> None:
+        position = bisect_left(self._keys, value)
+        while self._names[position] != name:
+            position += 1
+        del self._keys[position]
+        del self._names[position]
+
+    def _clear(self) -> None:
+        self._keys.clear()
+        self._names.clear()
+
+    def _find(self, condition: Union[Equals, Range]) -> Set[Union[str, int]]:
+        if isinstance(condition, Equals):
+            low = high = condition.value
+        else:
+            low, high = condition.low, condition.high
+        try:
+            start = 0 if low is None else bisect_left(self._keys, low)
+            stop = len(self._keys) if high is None else bisect_right(self._keys, high)
+        except TypeError:
+            return set()
+        return set(self._names[start:stop])
+
+
+INDEX_TYPES = {EQUALITY: EqualityIndex, RANGE: RangeIndex}
+
+
+def make_index(field: str, kind: str) -> _Index:
+    """
+    :param field: имя поля
+    :param kind: EQUALITY или RANGE
+    :return: пустой индекс
+    """
+    if kind not in INDEX_TYPES:
+        raise ValueError('database: неизвестный тип индекса ' + str(kind))
+    return INDEX_TYPES[kind](field)
+
+
+def pick_index(indexes: Dict[str, _Index], field: str, condition: Any) -> Optional[_Index]:
+    index = indexes.get(field)
+    if index is not None and index.supports(condition):
+        return index
+    return None
+
+
+__all__ = ['Equals', 'Range', 'EqualityIndex', 'RangeIndex', 'EQUALITY', 'RANGE', 'make_index', 'pick_index']
@@ -0,0 +1,137 @@
+"""
+Блокировки коллекций квази-базы данных
+
+CollectionLock -- блокировка одной коллекции: threading.RLock внутри процесса и, если нужно, fcntl.flock
+на файле коллекция.bson.lock между процессами. Считает время ожидания и удержания
+LockManager -- раздает по одной CollectionLock на файл коллекции и собирает их статистику
+"""
+from typing import Dict, Optional
+from threading import RLock, Lock
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессных блокировок не будет
+    fcntl = None
+
+
+class CollectionLock:
+    """
+    Реентерабельная блокировка коллекции, используется как контекстный менеджер:
+
+    with lock:
+        ...
+
+    Файловая блокировка берется только при внешнем входе и отпускается при внешнем выходе,
+    вложенные входы того же треда только увеличивают счетчик.
+    memory -- голый RLock без файловой блокировки и статистики, для быстрых изменений коллекции в памяти
+    """
+    def __init__(self, filename: str, process_lock: bool = False):
+        """
+        :param filename: файл коллекции
+        :param process_lock: блокировать ли еще и файл коллекция.bson.lock для других процессов
+        """
+        self.memory = RLock()
+        self._lock_filename = filename + '.lock' if process_lock and fcntl is not None else None
+        self._lock_file = None
+        self._depth = 0
+        self._acquired_at = 0.0
+        self._stats_lock = Lock()
+        self.acquisitions = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    def __enter__(self) -> 'CollectionLock':
+        started = time.perf_counter()
+        self.memory.acquire()
+        if self._depth == 0:
+            try:
+                if self._lock_filename is not None:
+                    self._lock_file = open(self._lock_filename, 'a')
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            except Exception:
+                self.memory.release()
+                raise
+            self._acquired_at = time.perf_counter()
+            self._register_wait(self._acquired_at - started)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *_) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            if self._lock_file is not None:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+                self._lock_file.close()
+                self._lock_file = None
+            self._register_hold(time.perf_counter() - self._acquired_at)
+        self.memory.release()
+
+    @property
+    def process_wide(self) -> bool:
+        """
+        :return: True, если коллекцию могут одновременно менять другие процессы
+        """
+        return self._lock_filename is not None
+
+    def _register_wait(self, wait: float) -> None:
+        with self._stats_lock:
+            self.acquisitions += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def _register_hold(self, hold: float) -> None:
+        with self._stats_lock:
+            self.hold_total += hold
+            self.hold_max = max(self.hold_max, hold)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: словарь со счетчиками: количество захватов, суммарное и максимальное время ожидания и удержания
+        """
+        with self._stats_lock:
+            return {'acquisitions': self.acquisitions,
+                    'wait_total': self.wait_total, 'wait_max': self.wait_max,
+                    'hold_total': self.hold_total, 'hold_max': self.hold_max}
+
+
+class LockManager:
+    """
+    Хранит по одной блокировке на файл коллекции, чтобы все объекты Database одной коллекции делили ее между собой
+    Методы:
+    get -- возвращает блокировку для файла коллекции
+    stats -- статистика всех блокировок
+    """
+    def __init__(self, process_locks: bool = False):
+        """
+        :param process_locks: создавать блокировки с fcntl.flock для работы нескольких процессов с одной папкой
+        """
+        self.process_locks = process_locks
+        self._locks: Dict[str, CollectionLock] = {}
+        self._lock = Lock()
+
+    def get(self, filename: str, process_lock: Optional[bool] = None) -> CollectionLock:
+        """
+        :param filename: файл коллекции
+        :param process_lock: переопределить self.process_locks для этой коллекции
+        :return: блокировка коллекции
+        """
+        with self._lock:
+            if filename not in self._locks:
+                if process_lock is None:
+                    process_lock = self.process_locks
+                self._locks[filename] = CollectionLock(filename, process_lock)
+            return self._locks[filename]
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: словарь вида {файл_коллекции: статистика блокировки}
+        """
+        with self._lock:
+            locks = dict(self._locks)
+        return {filename: lock.stats() for filename, lock in locks.items()}
+
+
+__all__ = ['CollectionLock', 'LockManager']
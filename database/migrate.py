@@ -0,0 +1,54 @@
+"""
+Перенос коллекций из .bson (вместе с недослитыми журналами) в SQLite
+
+python -m database.migrate                  # все коллекции из FILE_PATH
+python -m database.migrate users media      # только эти
+
+Исходные файлы не трогаются, так что откатиться можно, просто вернув DATABASE_STORAGE = 'bson'.
+Если коллекция.sqlite уже есть, она перезаписывается содержимым .bson
+"""
+from typing import List, Optional
+import os
+import sys
+import database
+from .sqlite_storage import SqliteCollection
+
+
+def collections(path: Optional[str] = None) -> List[str]:
+    """
+    :param path: папка с коллекциями, по умолчанию database.FILE_PATH
+    :return: имена коллекций, у которых есть .bson или журнал
+    """
+    path = database.FILE_PATH if path is None else path
+    names = set()
+    for filename in os.listdir(path or '.'):
+        for suffix in ('.bson', '.journal', '.journal.old'):
+            if filename.endswith(suffix):
+                names.add(filename[:-len(suffix)])
+    return sorted(names)
+
+
+def migrate(collection: str) -> int:
+    """
+    :param collection: имя коллекции
+    :return: сколько документов перенесено
+    """
+    # Открытие в режиме журнала применяет оставшийся журнал и сливает его в .bson
+    source = database.Database(collection, journal=True, storage=database.BSON)
+    documents = {name: source.get_document(name) for name in source.get_document_names()}
+    target = SqliteCollection(database.FILE_PATH + collection + '.sqlite')
+    try:
+        target.replace_all(documents)
+    finally:
+        target.close()
+    return len(documents)
+
+
+def main(names: List[str]) -> None:
+    for collection in names or collections():
+        print('{}: перенесено документов: {}'.format(collection, migrate(collection)))
+    print("Чтобы бот работал с SQLite, пропишите DATABASE_STORAGE = 'sqlite' в config.py")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,194 @@
+"""
+Хранение коллекции в SQLite
+
+SqliteCollection -- коллекция в файле коллекция.sqlite (таблица documents: имя документа и сам документ в BSON).
+Снаружи ведет себя как словарь {имя_документа: документ}, которым Database работает с коллекцией, но при открытии
+читает только имена документов, а каждый документ -- из файла при обращении к нему. В памяти остаются только
+документы, записанные через [] (Database так записывает измененные документы), перебор всей коллекции (items)
+идет по файлу кусками и прочитанное тоже не запоминает.
+
+Имена документов хранятся строками, как и в .bson: документ 123 после перезапуска станет документом '123'
+
+С одним файлом могут работать несколько процессов (см. dispatcher/sharding.py). Каждая запись, кроме самих
+документов, добавляет в таблицу changes строку (номер, кто записал, имя документа, имена полей), так что
+другие процессы узнают о ней через changes() и перечитывают документ через refresh()
+"""
+from typing import Any, Dict, Iterator, Optional, Set, Tuple, Union
+from threading import Lock
+import os
+import sqlite3
+import bson
+
+SCAN_CHUNK = 1000  # Сколько документов читать за раз при переборе коллекции
+CHANGES_KEEP = 10000  # Сколько последних изменений хранить в таблице changes
+
+
+class SqliteCollection:
+    """
+    Методы, которых нет у словаря:
+    write -- дописывает изменения документов в файл одной транзакцией
+    replace_all -- заменяет содержимое файла целой коллекцией
+    last_change -- номер последнего изменения в файле
+    changes -- изменения, которые записали другие (после данного номера)
+    refresh -- перечитывает документ, измененный другими
+    close -- закрывает файл
+    """
+    def __init__(self, filename: str):
+        """
+        :param filename: файл коллекции; если его нет, будет создан
+        """
+        self._lock = Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=FULL')  # как fsync журнала Database
+        self._connection.execute('CREATE TABLE IF NOT EXISTS documents (name TEXT PRIMARY KEY, body BLOB NOT NULL)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                 'origin TEXT NOT NULL, name TEXT NOT NULL, fields BLOB NOT NULL)')
+        self._origin = '{}-{}'.format(os.getpid(), id(self))  # свои изменения changes() не возвращает
+        self._names = {name for (name,) in self._connection.execute('SELECT name FROM documents')}
+        self._cache: Dict[Union[str, int], dict] = {}
+
+    def _fetch(self, name: Union[str, int]) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute('SELECT body FROM documents WHERE name = ?', (str(name),)).fetchone()
+        return bson.loads(row[0]) if row is not None else None
+
+    def __contains__(self, name: Union[str, int]) -> bool:
+        return name in self._names
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __iter__(self) -> Iterator[Union[str, int]]:
+        return iter(list(self._names))
+
+    def keys(self) -> Iterator[Union[str, int]]:
+        return iter(self)
+
+    def __getitem__(self, name: Union[str, int]) -> dict:
+        document = self._cache.get(name)
+        if document is None:
+            if name not in self._names:
+                raise KeyError(name)
+            document = self._fetch(name) or {}
+        return document
+
+    def __setitem__(self, name: Union[str, int], document: dict) -> None:
+        self._names.add(name)
+        self._cache[name] = document
+
+    def get(self, name: Union[str, int], default: Any = None) -> Any:
+        return self[name] if name in self._names else default
+
+    def setdefault(self, name: Union[str, int], default: dict) -> dict:
+        if name not in self._names:
+            self[name] = default
+        return self[name]
+
+    def items(self) -> Iterator[Tuple[Union[str, int], dict]]:
+        """
+        Все документы: уже загруженные -- из памяти, остальные -- из файла, без сохранения в памяти
+        """
+        seen = set()
+        for name, document in list(self._cache.items()):
+            seen.add(str(name))
+            yield name, document
+        last = ''
+        while True:
+            with self._lock:
+                rows = self._connection.execute('SELECT name, body FROM documents WHERE name > ? ORDER BY name LIMIT ?',
+                                                (last, SCAN_CHUNK)).fetchall()
+            for name, body in rows:
+                if name not in seen and name in self._names:
+                    yield name, bson.loads(body)
+            if len(rows) < SCAN_CHUNK:
+                return
+            last = rows[-1][0]
+
+    def write(self, changes: Dict[Union[str, int], Dict[str, Any]]) -> None:
+        """
+        Дописывает измененные поля документов. Поля сливаются с тем, что лежит в файле, так что изменения
+        других процессов в других полях не теряются
+
+        :param changes: словарь вида {имя_документа: {имя_поля: значение}}
+        :return: None
+        """
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                for name, fields in changes.items():
+                    row = self._connection.execute('SELECT body FROM documents WHERE name = ?',
+                                                   (str(name),)).fetchone()
+                    document = bson.loads(row[0]) if row is not None else {}
+                    document.update(fields)
+                    self._connection.execute('INSERT OR REPLACE INTO documents (name, body) VALUES (?, ?)',
+                                             (str(name), bson.dumps(document)))
+                    self._connection.execute('INSERT INTO changes (origin, name, fields) VALUES (?, ?, ?)',
+                                             (self._origin, str(name), bson.dumps({'fields': list(fields)})))
+                self._connection.execute('DELETE FROM changes WHERE seq <= last_insert_rowid() - ?', (CHANGES_KEEP,))
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def replace_all(self, collection: Dict[Union[str, int], dict]) -> None:
+        """
+        Записывает коллекцию целиком вместо того, что лежит в файле (для миграции)
+
+        :param collection: словарь вида {имя_документа: документ}
+        :return: None
+        """
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._connection.execute('DELETE FROM documents')
+                self._connection.executemany('INSERT INTO documents (name, body) VALUES (?, ?)',
+                                             ((str(name), bson.dumps(document))
+                                              for name, document in collection.items()))
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+            self._names = {str(name) for name in collection}
+            self._cache.clear()
+
+    def last_change(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+
+    def changes(self, after: int) -> Tuple[int, Dict[str, Set[str]]]:
+        """
+        :param after: номер изменения, после которого искать
+        :return: (номер последнего просмотренного изменения, {имя_документа: {имя_поля...}}) -- только изменения,
+        записанные другими объектами (в том числе другими процессами)
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT seq, origin, name, fields FROM changes WHERE seq > ? ORDER BY seq',
+                                            (after,)).fetchall()
+        changed: Dict[str, Set[str]] = {}
+        for seq, origin, name, fields in rows:
+            after = seq
+            if origin != self._origin:
+                changed.setdefault(name, set()).update(bson.loads(fields)['fields'])
+        return after, changed
+
+    def refresh(self, name: str, local: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Узнает о документе, который изменили другие: если он держится в памяти, перечитывает его из файла
+
+        :param name: имя документа
+        :param local: свои поля, которые еще не записаны в файл, -- они остаются поверх прочитанного
+        :return: None
+        """
+        self._names.add(name)
+        if name in self._cache:
+            document = self._fetch(name) or {}
+            document.update(local or {})
+            self._cache[name] = document
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+__all__ = ['SqliteCollection']
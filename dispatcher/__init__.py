@@ -1,12 +1,16 @@
 """
-Модуль диспетчера с классом Dispatcher -- загружает плагины и рулит планировщиком
+Модуль диспетчера с классом Dispatcher -- загружает плагины, рулит планировщиком и очередью заданий
 """
-from typing import Optional, List
+from typing import Optional, List, Dict, Callable, Any
 from threading import Thread
-from datetime import datetime, timedelta
-from global_variables import RUNNING_FLAG
-from utils import log
 import time
+from global_variables import RUNNING_FLAG
+from utils import log, metrics
+from .scheduler import Scheduler, Job, FIXED_RATE, FIXED_DELAY, WORKERS
+from .tasks import Task, TaskQueue
+
+STOP_CHECK_INTERVAL = 1  # Как часто (в секундах) проверять RUNNING_FLAG, если до следующей задачи еще долго
+SCHEDULER_SECONDS = metrics.histogram('dispatcher_scheduler_seconds', 'Время одного прохода планировщика, секунды')
 
 
 class Dispatcher(Thread):
@@ -15,9 +19,15 @@ class Dispatcher(Thread):
     Методы:
     run -- запускает тред
     _scheduler -- запускает всякие обработчики в определенные промежутки времени
-    _task_handler -- пока не делает ничего. Задел на будущее
+    _task_handler -- ставит задания, которые вернули периодичные плагины, в очередь заданий
+    scheduler_stats -- статистика периодичных плагинов: запуски, пропуски, опоздание, время работы
+    task_stats -- статистика очереди заданий: глубина, выполненные, повторы, похороненные, задержка
+    _start_plugins -- в отдельном треде запускает долгую инициализацию плагинов
     """
-    def __init__(self, bot, plugins: List[dict], scheduled_plugins: Optional[List[dict]] = None):
+    def __init__(self, bot, plugins: List[dict], scheduled_plugins: Optional[List[dict]] = None,
+                 workers: int = WORKERS, task_handlers: Optional[Dict[str, Callable[[Task], Any]]] = None,
+                 startup_handlers: Optional[List[Callable[[], None]]] = None,
+                 callback_plugins: Optional[List[dict]] = None, leader: Optional[Callable[[], bool]] = None):
         """
         Принимает объект бота, и списки словарей плагинов
 
@@ -26,49 +36,97 @@ class Dispatcher(Thread):
         {'commands': ['комманда'...], 'handler': плагин.функция-обработчик}
         :param scheduled_plugins: список словарей периодичных плагинов вида
         {'handler': плагин.функция, 'minutes': периодичность срабатывания в минутах типа float или int}
+        и необязательными ключами 'mode' (FIXED_RATE -- по сетке, по умолчанию, или FIXED_DELAY -- через
+        'minutes' после окончания прошлого запуска) и 'jitter' (случайная добавка к каждому запуску в секундах)
+        :param workers: количество тредов, в которых выполняются периодичные плагины
+        :param task_handlers: словарь вида {'имя_задания': функция(task)} -- обработчики заданий,
+        которые периодичные плагины возвращают диспетчеру
+        :param startup_handlers: функции запуска плагинов (см. plugins/__init__.py), которые выполняются в фоне,
+        пока бот уже отвечает на команды
+        :param callback_plugins: список словарей плагинов, обрабатывающих нажатия inline-кнопок, вида
+        {'prefixes': ['префикс callback_data'...], 'handler': плагин.функция-обработчик, 'access_level': уровень}
+        :param leader: функция без аргументов, которая отвечает, лидер ли этот процесс (sharding.LeaderLock);
+        периодичные плагины запускаются только у лидера. None -- процесс один, он и лидер
         """
         super().__init__(daemon=True)
         self._plugins = plugins
         self._scheduled_plugins = scheduled_plugins
+        self._startup_handlers = startup_handlers or []
+        self._callback_plugins = callback_plugins or []
         self._bot = bot
-        self._tasks_stack = []
+        self._leader = leader
+        self._jobs = Scheduler(workers=workers, on_result=self._task_handler)
+        self._tasks = TaskQueue(task_handlers)
+        metrics.gauge('dispatcher_task_queue_depth', 'Заданий в очереди', lambda: self._tasks.stats()['depth'])
+        metrics.gauge('dispatcher_dead_tasks', 'Похороненных заданий', lambda: self._tasks.stats()['dead'])
 
     def run(self) -> None:
         """
         Запихивает список обработчиков комманд в объект бота, а потом запускает
-        бесконечный цикл который дергает периодичные плагины
+        бесконечный цикл который дергает периодичные плагины и спит до ближайшего из них
         Он будет крутиться, пока RUNNING_FLAG() не вернет false Подробнее в модуле globalobjects
 
         :return: None
         """
         if self._scheduled_plugins is None:
             self._scheduled_plugins = []
+        for plugin in self._scheduled_plugins:
+            self._jobs.add(Job(plugin['handler'], plugin['minutes'] * 60,
+                               mode=plugin.get('mode', FIXED_RATE), jitter=plugin.get('jitter', 0)))
+        self._tasks.start()
         self._bot.load_command_plugins(self._plugins)
+        if self._callback_plugins:
+            self._bot.load_callback_plugins(self._callback_plugins)
+        Thread(target=self._start_plugins, name='plugins startup', daemon=True).start()
         log.log('=== bot started ===')
         while RUNNING_FLAG.value:
-            self._scheduler()
-            while self._tasks_stack:
-                task = self._tasks_stack.pop()
-                self._task_handler(**task)
-            time.sleep(1)
+            timeout = self._scheduler() if self._leader is None or self._leader() else STOP_CHECK_INTERVAL
+            self._jobs.wait(min(timeout, STOP_CHECK_INTERVAL))
+        self._jobs.shutdown(wait=False)
         self._bot.stop_polling()
         log.log('=== bot stopped ===')
 
-    def _scheduler(self) -> None:
+    def _start_plugins(self) -> None:
+        started = time.monotonic()
+        for handler in self._startup_handlers:
+            try:
+                handler()
+            except Exception as error:
+                name = getattr(handler, '__qualname__', handler)
+                log.error('dispatcher: ошибка при запуске {}: {}'.format(name, error))
+        if self._startup_handlers:
+            log.log('dispatcher: плагины запущены за {:.1f} с'.format(time.monotonic() - started))
+
+    def _scheduler(self) -> float:
+        """
+        Отдает в пул тредов периодичные плагины, время которых пришло. То, что они вернут, уйдет в _task_handler
+
+        :return: сколько секунд до следующего запуска
         """
-        Запускает переодичные плагины в определенные промежутки времени
+        with SCHEDULER_SECONDS.time():
+            return self._jobs.run_pending()
 
+    def scheduler_stats(self) -> dict:
+        return self._jobs.stats()
+
+    def task_stats(self) -> dict:
+        return self._tasks.stats()
+
+    def _task_handler(self, result: Any) -> None:
+        """
+        Ставит в очередь задания, которые вернул периодичный плагин (Task, список Task
+        или словарь {'task': 'имя', ...})
+
+        :param result: то, что вернул плагин
         :return: None
         """
-        dt = datetime.utcnow()
-        for plugin in self._scheduled_plugins:
-            if 'next_time' not in plugin:
-                plugin['next_time'] = dt + timedelta(minutes=plugin['minutes'])
-            if plugin['next_time'] < dt:
-                plugin['next_time'] = dt + timedelta(minutes=plugin['minutes'])
-                task = plugin['handler']()
-                if task:
-                    self._tasks_stack.append(task)
+        try:
+            tasks = Task.from_result(result)
+        except (KeyError, TypeError) as error:
+            log.error('dispatcher: непонятное задание {!r}: {}'.format(result, error))
+            return
+        for task in tasks:
+            self._tasks.put(task)
+
 
-    def _task_handler(self, **kwargs):
-        pass
+__all__ = ['Dispatcher', 'FIXED_RATE', 'FIXED_DELAY']
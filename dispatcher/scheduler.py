@@ -0,0 +1,169 @@
+"""
+Планировщик периодичных плагинов
+
+Job -- периодичная задача: обработчик, период, режим, разброс и статистика запусков
+Scheduler -- куча задач, отсортированная по времени следующего запуска. Задачи выполняются в пуле тредов,
+так что долгий опрос Убежища не задерживает остальные
+
+Режимы:
+FIXED_RATE -- запуски привязаны к сетке: старт, старт + период, старт + 2 периода... Время работы обработчика
+на расписание не влияет. Если задача еще выполняется, когда подошло время следующего запуска, запуск пропускается
+FIXED_DELAY -- следующий запуск через период после окончания предыдущего
+"""
+from typing import Any, Callable, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Event
+import heapq
+import itertools
+import random
+import time
+from utils import log, metrics
+
+FIXED_RATE = 'fixed_rate'
+FIXED_DELAY = 'fixed_delay'
+WORKERS = 4
+LAG_SECONDS = metrics.histogram('scheduler_lag_seconds', 'Опоздание запуска периодичного плагина, секунды')
+RUNTIME_SECONDS = metrics.histogram('scheduler_runtime_seconds', 'Время работы периодичного плагина, секунды',
+                                    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+SKIPPED = metrics.counter('scheduler_skipped_total', 'Пропущенные запуски периодичных плагинов')
+ERRORS = metrics.counter('scheduler_errors_total', 'Исключения в периодичных плагинах')
+
+
+class Job:
+    def __init__(self, handler: Callable[[], Any], interval: float, mode: str = FIXED_RATE, jitter: float = 0.0):
+        """
+        :param handler: функция без аргументов
+        :param interval: период в секундах
+        :param mode: FIXED_RATE или FIXED_DELAY
+        :param jitter: к каждому запуску добавляется случайная задержка от 0 до jitter секунд
+        """
+        if mode not in (FIXED_RATE, FIXED_DELAY):
+            raise ValueError('dispatcher: неизвестный режим планировщика ' + str(mode))
+        self.handler = handler
+        self.name = getattr(handler, '__qualname__', repr(handler))
+        self.interval = interval
+        self.mode = mode
+        self.jitter = jitter
+        self.base = 0.0  # время запуска по сетке, без разброса
+        self.deadline = 0.0  # время запуска с разбросом
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.last_runtime = 0.0
+        self.max_runtime = 0.0
+        self.total_runtime = 0.0
+
+    def plan(self, base: float) -> None:
+        self.base = base
+        self.deadline = base + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'runs': self.runs, 'skipped': self.skipped, 'errors': self.errors,
+                'last_lag': self.last_lag, 'max_lag': self.max_lag,
+                'avg_lag': self.total_lag / self.runs if self.runs else 0.0,
+                'last_runtime': self.last_runtime, 'max_runtime': self.max_runtime,
+                'avg_runtime': self.total_runtime / self.runs if self.runs else 0.0}
+
+
+class Scheduler:
+    """
+    Методы:
+    add -- добавляет задачу, первый запуск через период
+    run_pending -- отдает в пул все задачи, время которых пришло, и возвращает, сколько секунд спать до следующей
+    wait -- спит до следующей задачи (или меньше, если добавилась более ранняя)
+    stats -- статистика по задачам: количество запусков и пропусков, опоздание и время работы
+    shutdown -- останавливает пул
+    """
+    def __init__(self, workers: int = WORKERS, on_result: Optional[Callable[[Any], None]] = None):
+        """
+        :param workers: количество тредов для выполнения задач
+        :param on_result: куда отдать непустой результат обработчика (например, задание для диспетчера)
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scheduled')
+        self._on_result = on_result
+        self._heap: List[tuple] = []
+        self._jobs: List[Job] = []
+        self._counter = itertools.count()  # чтобы куча не сравнивала сами задачи при равном времени
+        self._lock = Lock()
+        self._wakeup = Event()
+
+    def add(self, job: Job) -> Job:
+        job.plan(time.monotonic() + job.interval)
+        with self._lock:
+            self._jobs.append(job)
+            self._push(job)
+        return job
+
+    def _push(self, job: Job) -> None:
+        heapq.heappush(self._heap, (job.deadline, next(self._counter), job))
+        self._wakeup.set()
+
+    def run_pending(self) -> float:
+        """
+        :return: сколько секунд осталось до следующего запуска
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, job = heapq.heappop(self._heap)
+                if job.running:  # только FIXED_RATE: прошлый запуск еще не закончился
+                    job.skipped += 1
+                    SKIPPED.inc(job=job.name)
+                    log.log('dispatcher: {} еще работает, запуск пропущен'.format(job.name))
+                else:
+                    job.running = True
+                    self._executor.submit(self._execute, job, job.deadline)
+                if job.mode == FIXED_RATE:
+                    base = job.base + job.interval
+                    if base <= now:  # проспали несколько периодов -- догонять не нужно
+                        base += ((now - base) // job.interval + 1) * job.interval
+                    job.plan(base)
+                    self._push(job)
+            self._wakeup.clear()
+            return self._heap[0][0] - now if self._heap else float('inf')
+
+    def wait(self, timeout: float) -> None:
+        self._wakeup.wait(max(0.0, timeout))
+
+    def _execute(self, job: Job, deadline: float) -> None:
+        started = time.monotonic()
+        result = None
+        try:
+            result = job.handler()
+        except Exception as error:
+            job.errors += 1
+            ERRORS.inc(job=job.name)
+            log.error('dispatcher: ошибка в {}: {}'.format(job.name, error), job=job.name)
+        finished = time.monotonic()
+        with self._lock:
+            lag = started - deadline
+            runtime = finished - started
+            job.runs += 1
+            job.last_lag = lag
+            job.max_lag = max(job.max_lag, lag)
+            job.total_lag += lag
+            job.last_runtime = runtime
+            job.max_runtime = max(job.max_runtime, runtime)
+            job.total_runtime += runtime
+            job.running = False
+            if job.mode == FIXED_DELAY:
+                job.plan(finished + job.interval)
+                self._push(job)
+        LAG_SECONDS.observe(lag, job=job.name)
+        RUNTIME_SECONDS.observe(runtime, job=job.name)
+        if result and self._on_result is not None:
+            self._on_result(result)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {job.name: job.stats() for job in self._jobs}
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+__all__ = ['Job', 'Scheduler', 'FIXED_RATE', 'FIXED_DELAY']
@@ -0,0 +1,249 @@
+"""
+Шардированный режим: бот в нескольких процессах (SHARDS = N в config.py, python start.py)
+
+Главный процесс (run) только забирает обновления из телеграма (getUpdates -- его может делать только кто-то один)
+и раскладывает их по N процессам-воркерам по хэшу id чата (shard_of), так что все обновления одного чата
+обрабатывает один и тот же воркер и порядок сообщений в чате сохраняется. Каждый воркер -- обычный бот
+со своими Bot, Dispatcher и плагинами, только без polling: обновления приходят в его очередь-ящик.
+
+Рассылки тоже делятся по хэшу: Delivery воркера (через ShardLink) оставляет себе своих адресатов,
+а остальных отправляет в ящики их воркеров. Предел телеграма в ~30 сообщений в секунду общий на бота,
+поэтому у каждого воркера он в N раз меньше.
+
+Убежище опрашивает только один воркер -- лидер (LeaderLock, fcntl.flock на файл leader.lock в папке БД):
+периодичные плагины работают только у него. Если лидер умрет, блокировку подхватит другой воркер.
+
+Общее состояние (пользователи, подписки, дайджесты...) лежит в SQLite (нужен DATABASE_STORAGE = 'sqlite'),
+а об изменениях, сделанных другими воркерами, плагины узнают через Database.watch.
+Если один воркер останавливается (например, по /stop), останавливаются все
+"""
+from typing import Any, Callable, Dict, Iterable, List, Optional
+import multiprocessing
+import queue
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: без блокировки лидером считает себя каждый воркер
+    fcntl = None
+
+POLL_TIMEOUT = 10  # Секунды long polling; заодно -- как быстро главный процесс заметит упавший воркер
+LEADER_RETRY = 5  # Как часто (в секундах) не-лидер пытается стать лидером
+STOP_CHECK_INTERVAL = 1  # Как часто воркер проверяет RUNNING_FLAG, если ящик пуст
+STOP_TIMEOUT = 30  # Сколько ждать остановки воркеров
+
+SHARD = 0  # Номер этого процесса и число процессов; в обычном режиме -- 0 и 1
+SHARDS = 1
+LEADER: Optional['LeaderLock'] = None  # Выбор лидера в воркере; в обычном режиме -- None
+
+
+def shard_of(chat_id: int, shards: Optional[int] = None) -> int:
+    """
+    :param chat_id: id чата
+    :param shards: число воркеров; по умолчанию -- текущее
+    :return: номер воркера, который занимается этим чатом
+    """
+    shards = SHARDS if shards is None else shards
+    return zlib.crc32(str(int(chat_id)).encode()) % shards
+
+
+def is_local(chat_id: int) -> bool:
+    """
+    :return: занимается ли чатом этот процесс (в обычном режиме -- всегда да)
+    """
+    return SHARDS == 1 or shard_of(chat_id) == SHARD
+
+
+def is_leader() -> bool:
+    """
+    :return: лидер ли этот процесс (в обычном режиме -- всегда да)
+    """
+    return LEADER is None or LEADER()
+
+
+class ShardLink:
+    """
+    Связь воркера с ящиками остальных воркеров
+    Методы:
+    forward -- отправляет чужих адресатов рассылки их воркерам и возвращает своих
+    """
+    def __init__(self, number: int, inboxes: List[Any]):
+        """
+        :param number: номер этого воркера
+        :param inboxes: очереди-ящики всех воркеров (multiprocessing.Queue)
+        """
+        self.number = number
+        self.shards = len(inboxes)
+        self._inboxes = inboxes
+
+    def forward(self, addressees: Iterable[int], method: str, args: tuple, kwargs: dict) -> List[int]:
+        """
+        :param addressees: id чатов
+        :param method: имя метода бота
+        :param args: его аргументы после id чата
+        :param kwargs: именованные аргументы для Delivery.broadcast (в том числе name и fallback)
+        :return: адресаты этого воркера
+        """
+        groups: Dict[int, List[int]] = {}
+        for addressee in addressees:
+            groups.setdefault(shard_of(addressee, self.shards), []).append(addressee)
+        for number, group in groups.items():
+            if number != self.number:
+                self._inboxes[number].put(('broadcast', group, method, args, kwargs))
+        return groups.get(self.number, [])
+
+
+class LeaderLock:
+    """
+    Выбор лидера среди воркеров: лидер тот, кто держит fcntl.flock на файле. Блокировка держится, пока жив
+    процесс, и отпускается ядром, когда он умирает. Объект вызывается без аргументов и отвечает, лидер ли этот процесс
+    """
+    def __init__(self, filename: str, retry: float = LEADER_RETRY):
+        self._filename = filename
+        self._retry = retry
+        self._file = None
+        self._tried = 0.0
+
+    def __call__(self) -> bool:
+        if self._file is not None or fcntl is None:
+            return True
+        now = time.monotonic()
+        if now - self._tried < self._retry:
+            return False
+        self._tried = now
+        lock_file = open(self._filename, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        from utils import log
+        log.log('sharding: воркер {} стал лидером'.format(SHARD))
+        return True
+
+
+def _chat_id(update: Dict[str, Any]) -> int:
+    """
+    :param update: обновление телеграма в виде словаря
+    :return: id чата (для нажатий кнопок, инлайн-запросов и т.п. -- id пользователя), 0 -- если его нет
+    """
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member',
+                'chat_member', 'chat_join_request'):
+        if key in update:
+            return update[key]['chat']['id']
+    for key in ('callback_query', 'inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+                'poll_answer'):
+        if key in update:
+            user = update[key].get('from') or update[key].get('user') or {}
+            return user.get('id', 0)
+    return 0
+
+
+def _worker(number: int, inboxes: List[Any], started: float, prepare: Optional[Callable[[], None]]) -> None:
+    """
+    Точка входа процесса-воркера: обычный бот, который берет обновления и чужие рассылки из своего ящика
+    """
+    global SHARD, SHARDS, LEADER
+    SHARD, SHARDS = number, len(inboxes)
+    if prepare is not None:
+        prepare()
+    from telebot import types
+    import database
+    from config import TOKEN
+    from global_variables import TELEGRAM_BOT, RUNNING_FLAG
+    from telegram import Bot
+    from utils import log, metrics
+    from dispatcher import Dispatcher
+    log.LOG_FILE = 'logfile.shard{}.log'.format(number)
+    LEADER = LeaderLock(database.FILE_PATH + 'leader.lock')
+    bot = Bot(TOKEN, started=started, link=ShardLink(number, inboxes))
+    TELEGRAM_BOT.value = bot
+    from plugins import command_handlers, scheduled_handlers, task_handlers, callback_handlers, startup_handlers
+    try:
+        from config import METRICS_PORT
+    except ImportError:
+        METRICS_PORT = 0
+    try:
+        from config import METRICS_HOST
+    except ImportError:
+        METRICS_HOST = '127.0.0.1'
+    if metrics.ENABLED and METRICS_PORT:
+        metrics.serve(METRICS_PORT + number, METRICS_HOST)
+    dispatcher = Dispatcher(bot, command_handlers, scheduled_plugins=scheduled_handlers, task_handlers=task_handlers,
+                            startup_handlers=startup_handlers, callback_plugins=callback_handlers,
+                            leader=LEADER)
+    dispatcher.start()
+    inbox = inboxes[number]
+    while RUNNING_FLAG.value:
+        try:
+            message = inbox.get(timeout=STOP_CHECK_INTERVAL)
+        except queue.Empty:
+            continue
+        try:
+            if message[0] == 'updates':
+                bot.process_new_updates([types.Update.de_json(update) for update in message[1]])
+            elif message[0] == 'broadcast':
+                _, addressees, method, args, kwargs = message
+                bot.delivery.broadcast(addressees, method, *args, **kwargs)
+            elif message[0] == 'stop':
+                RUNNING_FLAG.value = False
+        except Exception as error:  # одно кривое обновление не должно ронять воркер, а с ним и весь бот
+            log.error('sharding: воркер {}: ошибка при обработке {}: {}'.format(number, message[0], error))
+    dispatcher.join(STOP_TIMEOUT)
+    log.flush()
+
+
+def run(token: str, shards: int, started: Optional[float] = None,
+        prepare: Optional[Callable[[], None]] = None) -> None:
+    """
+    Запускает воркеры и раздает им обновления, пока все они живы
+
+    :param token: токен бота
+    :param shards: число воркеров
+    :param started: время старта (time.monotonic()), от которого воркеры считают время до первого обновления
+    :param prepare: функция без аргументов, которую каждый воркер вызовет первой, до импорта плагинов
+    (должна импортироваться по имени, например functools.partial от функции модуля)
+    :return: None
+    """
+    from telebot import apihelper
+    import database
+    from utils import log
+    if database.DATABASE_STORAGE != database.SQLITE:
+        raise ValueError("sharding: воркерам нужно общее хранилище, пропишите DATABASE_STORAGE = 'sqlite' в config.py")
+    context = multiprocessing.get_context('spawn')  # fork унаследовал бы треды и соединения с БД
+    inboxes = [context.Queue() for _ in range(shards)]
+    workers = [context.Process(target=_worker, args=(number, inboxes, started or time.monotonic(), prepare),
+                               name='shard-{}'.format(number)) for number in range(shards)]
+    for worker in workers:
+        worker.start()
+    log.log('sharding: запущено воркеров: {}'.format(shards))
+    apihelper.delete_webhook(token)
+    offset = None
+    try:
+        while all(worker.is_alive() for worker in workers):
+            try:
+                updates = apihelper.get_updates(token, offset, 100, timeout=POLL_TIMEOUT + 10,
+                                                long_polling_timeout=POLL_TIMEOUT)
+            except Exception as error:
+                log.warning('sharding: не удалось получить обновления: {}'.format(error))
+                time.sleep(1)
+                continue
+            batches: Dict[int, List[dict]] = {}
+            for update in updates:
+                offset = update['update_id'] + 1
+                batches.setdefault(shard_of(_chat_id(update), shards), []).append(update)
+            for number, batch in batches.items():
+                inboxes[number].put(('updates', batch))
+    finally:
+        for inbox in inboxes:
+            inbox.put(('stop',))
+        for worker in workers:
+            worker.join(STOP_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+        log.log('sharding: воркеры остановлены')
+
+
+__all__ = ['run', 'shard_of', 'is_local', 'is_leader', 'ShardLink', 'LeaderLock', 'SHARD', 'SHARDS']
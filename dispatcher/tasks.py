@@ -0,0 +1,156 @@
+"""
+Очередь заданий диспетчера
+
+Task -- задание: имя (по нему ищется обработчик), данные, приоритет и крайний срок
+TaskQueue -- потокобезопасная очередь с приоритетами и пулом воркеров. Упавшие задания повторяются
+с растущей задержкой, а после последней попытки (или если крайний срок прошел) откладываются в dead_letters
+"""
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+from collections import deque
+from threading import Thread, Lock, Timer
+import itertools
+import queue
+import time
+from utils import log
+
+WORKERS = 2
+MAX_ATTEMPTS = 3
+BACKOFF = 5  # Задержка перед первым повтором в секундах, дальше удваивается
+DEAD_LETTERS = 100  # Сколько последних похороненных заданий хранить
+
+
+class Task:
+    """
+    Задание для диспетчера.
+    Чем меньше priority, тем раньше задание будет выполнено; при равном приоритете -- в порядке поступления.
+    deadline -- время (time.time()), после которого выполнять задание уже бессмысленно, или None
+    """
+    def __init__(self, name: str, payload: Optional[Dict[str, Any]] = None, priority: int = 0,
+                 deadline: Optional[float] = None):
+        self.name = name
+        self.payload = payload if payload is not None else {}
+        self.priority = priority
+        self.deadline = deadline
+        self.attempts = 0
+        self.created = time.monotonic()
+        self.error: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return 'Task({!r}, priority={}, attempts={})'.format(self.name, self.priority, self.attempts)
+
+    @classmethod
+    def from_result(cls, result: Union['Task', dict, Iterable]) -> List['Task']:
+        """
+        Приводит то, что вернул периодичный плагин, к списку заданий.
+        Понимает Task, список Task и старый формат {'task': 'имя', 'аргумент': значение...}
+
+        :param result: результат плагина
+        :return: список заданий
+        """
+        if isinstance(result, Task):
+            return [result]
+        if isinstance(result, dict):
+            payload = dict(result)
+            return [cls(payload.pop('task'), payload)]
+        tasks = []
+        for item in result:
+            tasks.extend(cls.from_result(item))
+        return tasks
+
+
+class TaskQueue:
+    """
+    Методы:
+    register -- регистрирует обработчик для имени задания
+    put -- ставит задание в очередь
+    start -- запускает воркеры
+    stats -- глубина очереди, счетчики и задержки
+    """
+    def __init__(self, handlers: Optional[Dict[str, Callable[[Task], Any]]] = None, workers: int = WORKERS,
+                 max_attempts: int = MAX_ATTEMPTS, backoff: float = BACKOFF):
+        """
+        :param handlers: словарь вида {имя_задания: функция(task)}
+        :param workers: количество воркеров
+        :param max_attempts: сколько раз пытаться выполнить задание
+        :param backoff: задержка перед первым повтором в секундах, дальше удваивается
+        """
+        self._handlers: Dict[str, Callable[[Task], Any]] = dict(handlers or {})
+        self._workers_count = workers
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._workers: List[Thread] = []
+        self._lock = Lock()
+        self.dead_letters = deque(maxlen=DEAD_LETTERS)
+        self._stats = {'queued': 0, 'done': 0, 'retried': 0, 'dead': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+
+    def register(self, name: str, handler: Callable[[Task], Any]) -> None:
+        self._handlers[name] = handler
+
+    def start(self) -> None:
+        with self._lock:
+            if self._workers:
+                return
+            for number in range(self._workers_count):
+                worker = Thread(target=self._worker, name='tasks-{}'.format(number), daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def put(self, task: Task) -> None:
+        with self._lock:
+            self._stats['queued'] += 1
+        self._queue.put((task.priority, next(self._counter), task))
+
+    def _worker(self) -> None:
+        while True:
+            _, _, task = self._queue.get()
+            self._run(task)
+
+    def _run(self, task: Task) -> None:
+        if task.deadline is not None and time.time() > task.deadline:
+            self._bury(task, 'крайний срок прошел')
+            return
+        handler = self._handlers.get(task.name)
+        if handler is None:
+            self._bury(task, 'нет обработчика')
+            return
+        task.attempts += 1
+        try:
+            handler(task)
+        except Exception as error:
+            task.error = str(error)
+            if task.attempts >= self._max_attempts:
+                self._bury(task, task.error)
+                return
+            delay = self._backoff * 2 ** (task.attempts - 1)
+            log.warning('dispatcher: задание {} упало ({}), повтор через {} с'.format(task.name, error, delay),
+                        task=task.name, attempt=task.attempts)
+            with self._lock:
+                self._stats['retried'] += 1
+            retry = Timer(delay, self._queue.put, args=((task.priority, next(self._counter), task),))
+            retry.daemon = True
+            retry.start()
+            return
+        latency = time.monotonic() - task.created
+        with self._lock:
+            self._stats['done'] += 1
+            self._stats['latency_total'] += latency
+            self._stats['latency_max'] = max(self._stats['latency_max'], latency)
+
+    def _bury(self, task: Task, reason: str) -> None:
+        task.error = reason
+        log.error('dispatcher: задание {} отложено в dead_letters: {}'.format(task.name, reason), task=task.name)
+        with self._lock:
+            self._stats['dead'] += 1
+            self.dead_letters.append(task)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['depth'] = self._queue.qsize()
+        stats['latency_avg'] = stats['latency_total'] / stats['done'] if stats['done'] else 0.0
+        return stats
+
+
+__all__ = ['Task', 'TaskQueue']
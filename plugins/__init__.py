@@ -18,8 +18,18 @@ def my_command_plugin(message):
     TELEGRAM_BOT.value.send_message(message.from_user.id, 'какое-то сообщение')
 
 3.2* Если функция должна срабатывать через определенные промежутки времени (далее scheduled handler),
-она может возвращать словарь с заданием для диспетчера (задел на будущее. Задания пока не реализованы):
-{'task': 'задание', 'some_arg_1': 'какой-то аргумент'...}
+она может вернуть диспетчеру задание (или список заданий), чтобы тяжелая работа (например, рассылка)
+выполнилась в очереди заданий, а сам плагин закончился побыстрее:
+
+from dispatcher.tasks import Task
+
+def my_scheduled_plugin():
+    return Task('my_task', {'some_arg_1': 'какой-то аргумент'}, priority=0, deadline=None)
+
+Старый формат {'task': 'my_task', 'some_arg_1': 'какой-то аргумент'...} тоже понимается.
+
+3.3* Обработчик задания принимает объект Task и читает данные из task.payload. Если он бросит исключение,
+задание будет повторено с растущей задержкой, а после нескольких неудач -- отложено в dead letters диспетчера.
 
 4* Импротировать плагин сюда. Пример:
 
@@ -35,10 +45,36 @@ from . import my_plugin
 Уровень доступа 2 присваиватся пользователю, ID которого указан в BOT_OWNER_ID модуля config.py
 Уровень доступа 0 присваивается всем ботам, которые пишут этому боту.
 
+5.1.1* Если плагин рисует inline-кнопки, обработчик нажатий (он принимает CallbackQuery) регистрируется
+в списке callback_handlers словарем вида:
+
+{'prefixes': ['префикс'...], 'handler': плагин.функция-обработчик, 'access_level': уровень доступа}
+
+Префикс -- часть callback_data кнопки до первого ':', например кнопка с callback_data 'vault:flow'
+попадет в обработчик с префиксом 'vault'. Если обработчику нужно помнить, на каком шаге пользователь,
+для этого есть TELEGRAM_BOT.value.conversations (см. telegram/conversations.py)
+
 5.2* Для scheduled handler'oв добавить в список scheduled_handler словарь вида:
 
 {'handler': плагин.функция, 'minutes': периодичность срабатывания в минутах типа float или int}
 
+Необязательные ключи:
+'mode': FIXED_RATE (по умолчанию) -- запуски по сетке, независимо от времени работы плагина; если прошлый запуск
+еще не закончился, очередной пропускается. FIXED_DELAY -- следующий запуск через 'minutes' после окончания прошлого.
+Оба импортируются из dispatcher (from dispatcher import FIXED_DELAY)
+'jitter': случайная добавка к каждому запуску в секундах, чтобы плагины не срабатывали все разом
+
+Периодичные плагины выполняются в пуле тредов диспетчера, поэтому могут работать одновременно друг с другом
+и с обработчиками команд.
+
+5.3* Для обработчиков заданий добавить в словарь task_handlers пару 'имя_задания': плагин.функция
+
+5.4* Если плагину нужна долгая инициализация (сеть, большие файлы), ее нельзя делать при импорте модуля:
+бот не начнет отвечать на команды, пока все плагины не импортируются. Жизненный цикл плагина такой:
+загрузка (импорт -- только дешевые вещи) -> запуск (функция из startup_handlers, диспетчер вызывает их
+в фоновом треде сразу после старта) -> готовность (плагин сам помнит, что запуск закончился, и до этого
+отвечает на свои команды "подождите"). Для этого добавить функцию запуска без аргументов в список startup_handlers
+
 6* Добавить в commands_list плагина help_plugins.py справку по комманде, если нужно.
 
 Если плагин должен уметь останавливать бота, нужно импортировать в него RUNNING_FLAG из global_variables.
@@ -53,6 +89,7 @@ from . import vault_plugin
 from . import stop_plugin
 from . import who_plugin
 from . import achtung_plugin
+from . import stats_plugin
 
 command_handlers: List[Dict[str, Union[List[str], Callable[[Any], None], int]]] = [
     {'commands': ['start'], 'handler': help_plugin.start_message, 'access_level': 1},
@@ -61,8 +98,11 @@ command_handlers: List[Dict[str, Union[List[str], Callable[[Any], None], int]]]
     {'commands': ['speak'], 'handler': speak_plugin.speak_message, 'access_level': 1},
     {'commands': ['sub'], 'handler': vault_plugin.vault.sub, 'access_level': 1},
     {'commands': ['unsub'], 'handler': vault_plugin.vault.unsub, 'access_level': 1},
+    {'commands': ['mysubs'], 'handler': vault_plugin.vault.subscriptions, 'access_level': 1},
+    {'commands': ['digest'], 'handler': vault_plugin.vault.digest, 'access_level': 1},
     {'commands': ['who'], 'handler': who_plugin.who, 'access_level': 2},
-    {'commands': ['achtung'], 'handler': achtung_plugin.achtung, 'access_level': 2},
+    {'commands': ['achtung'], 'handler': achtung_plugin.achtung.command, 'access_level': 2},
+    {'commands': ['stats'], 'handler': stats_plugin.stats, 'access_level': 2},
     {'commands': ['stop'], 'handler': stop_plugin.stop, 'access_level': 2}
 ]
 
@@ -70,4 +110,20 @@ scheduled_handlers: List[Dict[str, Union[Callable[[None], None], int, float]]] =
     {'handler': vault_plugin.vault.scheduled, 'minutes': 1}
 ]
 
-__all__ = ['command_handlers', 'scheduled_handlers']
+task_handlers: Dict[str, Callable[[Any], None]] = {
+    'vault_broadcast': vault_plugin.vault.broadcast,
+    'vault_digest': vault_plugin.vault.send_digests
+}
+
+callback_handlers: List[Dict[str, Union[List[str], Callable[[Any], None], int]]] = [
+    {'prefixes': ['vault'], 'handler': vault_plugin.vault.callback, 'access_level': 1},
+    {'prefixes': ['achtung'], 'handler': achtung_plugin.achtung.callback, 'access_level': 2},
+    {'prefixes': ['who'], 'handler': who_plugin.callback, 'access_level': 2}
+]
+
+startup_handlers: List[Callable[[], None]] = [
+    vault_plugin.vault.start,
+    achtung_plugin.achtung.start
+]
+
+__all__ = ['command_handlers', 'scheduled_handlers', 'task_handlers', 'callback_handlers', 'startup_handlers']
@@ -1,8 +1,226 @@
+"""
+Рассылка общего сообщения всем людям, которых знает бот (/achtung текст)
+
+Рассылка идет в своем треде, а сами сообщения отправляют воркеры TELEGRAM_BOT.value.delivery с его
+ограничениями частоты, так что бот продолжает отвечать на команды. Одновременно в очереди доставки лежит
+не больше WINDOW сообщений рассылки: остальные адресаты ждут в треде рассылки, поэтому ее можно
+остановить кнопкой "Отменить", а сообщения плагинов не стоят в очереди за всей рассылкой.
+
+Состояние хранится в коллекции 'achtung': документ 'job' -- текст, владелец и статус рассылки
+(running, done, cancelled или failed -- если ее прервала ошибка),
+документ 'recipients' -- по полю на адресата: 'pending', 'sent' или 'failed' (None -- не участвует).
+Результаты отправок сбрасываются в БД раз в CHECKPOINT_INTERVAL секунд, и после перезапуска бота
+рассылка продолжается с теми, кто еще 'pending' (получить сообщение второй раз могут только те,
+кому его отправили за последние CHECKPOINT_INTERVAL секунд перед падением).
+Владелец получает сообщение с ходом рассылки, которое обновляется раз в PROGRESS_INTERVAL секунд.
+В шардированном режиме рассылку ведет процесс, которому достались сообщения владельца (туда же приходит
+и нажатие "Отменить"), с его долей общего ограничения частоты
+"""
+from typing import Dict, List, Optional
+from threading import Event, Lock, Semaphore, Thread
+import time
+from telebot import types as markups
+from database import Database, Equals
+from dispatcher import sharding
 from global_variables import TELEGRAM_BOT
+from telegram.delivery import GLOBAL_RATE
+from utils import log
+
+WINDOW = 2 * GLOBAL_RATE  # Сколько сообщений рассылки может одновременно лежать в очереди доставки
+CHECKPOINT_INTERVAL = 1.0  # секунды
+PROGRESS_INTERVAL = 5.0  # секунды
+TICK = 0.5  # Как часто тред рассылки, ожидая воркеров, проверяет отмену и таймеры
+HEADER = '_Общее сообщение!_\n\n'
+
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class Achtung:
+    """
+    Методы:
+    command -- хэндлер команды /achtung
+    callback -- обработчик кнопки "Отменить" (callback_data 'achtung:cancel')
+    start -- продолжает рассылку, прерванную перезапуском бота
+    """
+    def __init__(self):
+        self._db = Database('achtung', journal=True)
+        self._lock = Lock()  # защищает _results и счетчики
+        self._thread: Optional[Thread] = None
+        self._cancelled = Event()
+        self._slots = Semaphore(WINDOW)
+        self._results: Dict[int, str] = {}  # еще не сброшенные в БД результаты отправок
+        self._sent = 0
+        self._failed = 0
+        self._total = 0
+        self._done_before = 0  # сколько адресатов обработано до перезапуска (для скорости)
+        self._started = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """
+        Вызывается диспетчером при старте бота: если рассылка была прервана, продолжает ее
+        """
+        job = self._db.get_document('job')
+        if job is None or job['status'] != RUNNING or self.running or not sharding.is_local(job['owner']):
+            return
+        log.log('achtung: продолжаю прерванную рассылку')
+        self._launch(job, resumed=True)
+
+    def command(self, message):
+        """
+        Хэндлер команды "/achtung текст" из телеграмма: начинает рассылку текста всем людям
+        :param message: объект сообщения из телеграмма
+        :return:
+        """
+        telegram_id = message.from_user.id
+        if self.running:
+            TELEGRAM_BOT.value.send_message(telegram_id, 'Уже идет рассылка. ' + self._progress())
+            return
+        text = message.text.replace('/achtung', '', 1).strip()
+        if not text:
+            TELEGRAM_BOT.value.send_message(telegram_id, 'Напишите текст сообщения после /achtung')
+            return
+        recipients = TELEGRAM_BOT.value.db.get_document_names({'is_bot': Equals(False)})
+        previous = self._db.get_document('recipients') or {}
+        fields = {name: None for name, state in previous.items() if state is not None}
+        fields.update({str(name): PENDING for name in recipients})
+        self._db.update_document('recipients', fields_with_content=fields)
+        job = {'text': HEADER + text, 'owner': telegram_id, 'status': RUNNING, 'total': len(recipients)}
+        self._db.update_document('job', fields_with_content=job)
+        self._db.save_and_update()
+        log.log('achtung: рассылка для {} адресатов'.format(len(recipients)))
+        self._launch(job, resumed=False)
+
+    def callback(self, call):
+        """
+        Обработчик кнопки "Отменить" под сообщением с ходом рассылки
+        :param call: объект CallbackQuery из телеграмма
+        :return:
+        """
+        if not self.running:
+            TELEGRAM_BOT.value.answer_callback_query(call.id, 'Рассылка уже закончилась')
+            return
+        self._cancelled.set()
+        TELEGRAM_BOT.value.answer_callback_query(call.id, 'Останавливаю рассылку')
+
+    def _launch(self, job: dict, resumed: bool) -> None:
+        recipients = self._db.get_document('recipients') or {}
+        pending = [int(name) for name, state in recipients.items() if state == PENDING]
+        with self._lock:
+            self._results.clear()
+            self._sent = sum(1 for state in recipients.values() if state == SENT)
+            self._failed = sum(1 for state in recipients.values() if state == FAILED)
+            self._total = job['total']
+            self._done_before = self._sent + self._failed
+            self._started = time.monotonic()
+        self._cancelled.clear()
+        self._thread = Thread(target=self._run, args=(job, pending, resumed), name='achtung', daemon=True)
+        self._thread.start()
+
+    def _run(self, job: dict, pending: List[int], resumed: bool) -> None:
+        """
+        Тред рассылки. Чем бы она ни кончилась, статус 'job' перестает быть RUNNING: иначе рассылка без треда
+        числилась бы идущей
+        """
+        header = 'Продолжаю рассылку после перезапуска. ' if resumed else ''
+        markup = markups.InlineKeyboardMarkup()
+        markup.add(markups.InlineKeyboardButton('Отменить', callback_data='achtung:cancel'))
+        progress_message = None
+        try:
+            progress_message = TELEGRAM_BOT.value.send_message(job['owner'], header + self._progress(),
+                                                               reply_markup=markup)
+        except Exception as error:  # владелец заблокировал бота, сеть... рассылка идет и без хода
+            log.warning('achtung: не удалось отправить владельцу ход рассылки: {}'.format(error))
+        try:
+            self._send_all(job, pending, progress_message, markup)
+            status = CANCELLED if self._cancelled.is_set() else DONE
+        except Exception as error:
+            log.error('achtung: рассылка прервана ошибкой: {}'.format(error))
+            status = FAILED
+        try:
+            self._checkpoint()
+        finally:
+            self._db.update_document('job', fields_with_content={'status': status})
+            self._db.save_and_update()
+        result = {DONE: 'Рассылка закончена. ', CANCELLED: 'Рассылка отменена. ', FAILED: 'Рассылка прервана. '}[status]
+        log.log('achtung: ' + result + self._progress())
+        self._edit(progress_message, result + self._progress())
+
+    def _send_all(self, job: dict, pending: List[int], progress_message, markup) -> None:
+        bot = TELEGRAM_BOT.value
+        checkpoint = progress = time.monotonic()
+        for telegram_id in pending:
+            acquired = False
+            while not acquired and not self._cancelled.is_set():
+                acquired = self._slots.acquire(timeout=TICK)
+                checkpoint, progress = self._tick(checkpoint, progress, progress_message, markup)
+            if self._cancelled.is_set():
+                if acquired:
+                    self._slots.release()
+                break
+            bot.delivery.broadcast([telegram_id], 'send_message', job['text'], parse_mode='Markdown',
+                                   name='achtung', on_result=self._on_result)
+        for _ in range(WINDOW):  # дожидаемся сообщений, которые уже в очереди доставки
+            while not self._slots.acquire(timeout=TICK):
+                checkpoint, progress = self._tick(checkpoint, progress, progress_message, markup)
+        for _ in range(WINDOW):
+            self._slots.release()
+
+    def _tick(self, checkpoint: float, progress: float, progress_message, markup) -> tuple:
+        now = time.monotonic()
+        if now - checkpoint >= CHECKPOINT_INTERVAL:
+            self._checkpoint()
+            checkpoint = now
+        if now - progress >= PROGRESS_INTERVAL:
+            self._edit(progress_message, self._progress(), markup)
+            progress = now
+        return checkpoint, progress
+
+    def _on_result(self, telegram_id: int, ok: bool) -> None:
+        with self._lock:
+            self._results[telegram_id] = SENT if ok else FAILED
+            if ok:
+                self._sent += 1
+            else:
+                self._failed += 1
+        self._slots.release()
+
+    def _checkpoint(self) -> None:
+        with self._lock:
+            results, self._results = self._results, {}
+        if results:
+            self._db.update_document('recipients',
+                                     fields_with_content={str(name): state for name, state in results.items()})
+            self._db.save_and_update()
+
+    def _progress(self) -> str:
+        with self._lock:
+            sent, failed = self._sent, self._failed
+            total, done_before = self._total, self._done_before
+            elapsed = time.monotonic() - self._started
+        rate = (sent + failed - done_before) / elapsed if elapsed else 0.0
+        return 'Отправлено {}, ошибок {}, осталось {} из {}, {:.1f} сообщ./сек'.format(
+            sent, failed, total - sent - failed, total, rate)
+
+    @staticmethod
+    def _edit(progress_message, text: str, markup=None) -> None:
+        if progress_message is None:  # сообщение с ходом отправить не удалось
+            return
+        try:
+            TELEGRAM_BOT.value.edit_message_text(text, progress_message.chat.id, progress_message.message_id,
+                                                 reply_markup=markup)
+        except Exception as error:  # например, текст не изменился или нет сети; рассылку это не касается
+            log.warning('achtung: не удалось обновить ход рассылки: {}'.format(error))
+
 
+achtung = Achtung()
 
-def achtung(message):
-    addressee = [user_id for user_id, user_info in TELEGRAM_BOT.value.get_users().items() if not user_info['is_bot']]
-    text = message.text.replace('/achtung', '_Общее сообщение!_\n\n')
-    for telegram_id in addressee:
-        TELEGRAM_BOT.value.send_message(telegram_id, text, parse_mode='Markdown')
+__all__ = ['achtung']
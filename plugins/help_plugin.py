@@ -2,6 +2,8 @@
 Плагин реакции на команды /start и /help
 
 commands_list -- список кортежей вида ('/команда: описание', уровень доступа)
+
+Готовый текст ответа для каждого уровня доступа хранится в TELEGRAM_BOT.value.render_cache (группа 'commands')
 """
 from global_variables import TELEGRAM_BOT
 
@@ -11,18 +13,26 @@ commands_list = [('/start: отправлять приветствие', 1),
                  ('/speak: говорить фразу, украденную из Убежища', 1),
                  ('/sub: подписывать на всякое новое в Убежище', 1),
                  ('/unsub: отписывать от всякого в Убежище', 1),
-                 ('/who: отправлять список всех, кого я знаю', 2),
+                 ('/mysubs: показать, на что вы подписаны', 1),
+                 ('/digest: присылать обновления Убежища дайджестом раз в N минут', 1),
+                 ('/who [люди|боты|уровень]: отправлять список всех, кого я знаю, по страницам', 2),
                  ('/achtung: отправить сообщение всем, кого я знаю', 2),
+                 ('/stats: прислать метрики бота', 2),
                  ('/stop: сушить весла!', 2)]
 
 
-def _generate_message(message, header_text, footer_text=""):
-    access_level = TELEGRAM_BOT.value.get_user_access_level(message.from_user.id)
+def _build_message(access_level, header_text, footer_text):
     commands = [command[0] for command in filter(lambda item: item[1] <= access_level, commands_list)]
     commands = '\n'.join(commands)
     return header_text + commands + footer_text
 
 
+def _generate_message(message, header_text, footer_text=""):
+    access_level = TELEGRAM_BOT.value.get_user_access_level(message.from_user.id)
+    return TELEGRAM_BOT.value.render_cache.get('commands', (access_level, header_text, footer_text),
+                                               lambda: _build_message(access_level, header_text, footer_text))
+
+
 def start_message(message):
     answer = _generate_message(message,
                                'Приветствую.\nЯ -- маленький бот сайта https://vault48.org\n\nВот что я умею:\n')
@@ -0,0 +1,45 @@
+"""
+Плагин команды /stats: присылает владельцу бота текущие метрики (см. utils.metrics)
+"""
+from global_variables import TELEGRAM_BOT
+from utils import metrics
+from utils.string_functions import split_message
+
+MESSAGE_LIMIT = 4096
+
+
+def _labels(key) -> str:
+    return '{' + ', '.join('{}={}'.format(name, value) for name, value in key) + '}' if key else ''
+
+
+def _describe(metric) -> list:
+    lines = []
+    if isinstance(metric, metrics.Counter):
+        for key, value in sorted(metric.values().items()):
+            lines.append('{}{} = {:g}'.format(metric.name, _labels(key), value))
+    elif isinstance(metric, metrics.Histogram):
+        for key, summary in sorted(metric.summary().items()):
+            template = '{}{}: {} шт., сред. {:.3f} с, p50 ≤ {:.3f} с, p99 ≤ {:.3f} с, макс. {:.3f} с'
+            lines.append(template.format(metric.name, _labels(key), summary['count'], summary['avg'],
+                                         summary['p50'], summary['p99'], summary['max']))
+    else:
+        value = metric.value()
+        lines.append('{} = {}'.format(metric.name, '?' if value is None else '{:g}'.format(value)))
+    return lines
+
+
+def stats(message):
+    bot = TELEGRAM_BOT.value
+    if not metrics.ENABLED:
+        bot.send_message(message.from_user.id, 'Метрики выключены. Включаются METRICS_ENABLED = True в config.py')
+        return
+    lines = []
+    for metric in metrics.collect():
+        lines.extend(_describe(metric))
+    lines.append('кэш картинок: ' + bot.media.report())
+    lines.append('кэш ответов: ' + bot.render_cache.report())
+    for part in split_message('\n'.join(lines), MESSAGE_LIMIT):
+        bot.send_message(message.from_user.id, part)
+
+
+__all__ = ['stats']
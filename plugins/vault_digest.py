@@ -0,0 +1,142 @@
+"""
+Дайджесты обновлений Убежища
+
+Подписчик может попросить присылать обновления не сразу, а раз в N минут. Тогда сообщения Течения, Бориса
+и годноты копятся в его дайджесте, а когда подходит срок, склеиваются в как можно меньшее число сообщений
+не длиннее MESSAGE_LIMIT.
+
+Дайджесты хранятся в документе 'digests' коллекции vault_plugin, по полю на подписчика:
+{'interval': минуты, 'due': время отправки (time.time()) или None, 'items': [markdown-текст...]},
+так что накопленное переживает перезапуск бота, а дайджесты, измененные другими процессами бота
+(шардированный режим), подхватываются через Database.watch
+"""
+from typing import Dict, List, Optional, Any, Set
+from threading import Lock
+import time
+from database import Database
+from utils import log
+from utils.string_functions import pack_messages
+
+MESSAGE_LIMIT = 4096  # Ограничение телеграма на длину сообщения
+MAX_INTERVAL = 24 * 60  # Реже раза в сутки дайджест не шлем
+MAX_ITEMS = 500  # Больше стольких сообщений в дайджесте не копим, старые выкидываем
+SEPARATOR = '\n\n〰〰〰\n\n'
+DOCUMENT = 'digests'
+
+
+class Digest:
+    """
+    Методы:
+    interval -- интервал доставки подписчика в минутах (0 -- дайджест выключен)
+    set_interval -- меняет интервал доставки
+    postpone -- складывает сообщение в дайджесты тех, кто их включил, и возвращает тех, кому слать сразу
+    due -- подписчики, чьи дайджесты пора отправлять
+    flush -- забирает накопленное у подписчика в виде готовых к отправке сообщений
+    """
+    def __init__(self, db: Database):
+        """
+        :param db: коллекция, в которой хранить дайджесты
+        """
+        self._db = db
+        self._lock = Lock()
+        saved = db.get_document(DOCUMENT) or {}
+        # В BSON ключи -- строки
+        self._digests: Dict[int, Dict[str, Any]] = {int(telegram_id): digest for telegram_id, digest in saved.items()}
+        db.watch(self._on_change)
+
+    def _on_change(self, changes: Dict[str, Set[str]]) -> None:
+        if DOCUMENT not in changes:
+            return
+        saved = self._db.get_document(DOCUMENT) or {}
+        with self._lock:
+            for field in changes[DOCUMENT]:
+                digest = saved.get(field)
+                if digest is None:
+                    self._digests.pop(int(field), None)
+                else:
+                    self._digests[int(field)] = {'interval': digest['interval'], 'due': digest['due'],
+                                                 'items': list(digest['items'])}
+
+    def _save(self, *telegram_ids: int) -> None:
+        fields = {}
+        for telegram_id in telegram_ids:
+            digest = self._digests[telegram_id]
+            fields[str(telegram_id)] = {'interval': digest['interval'], 'due': digest['due'],
+                                        'items': list(digest['items'])}
+        self._db.update_document(DOCUMENT, fields_with_content=fields)
+        self._db.save_and_update()
+
+    def interval(self, telegram_id: int) -> int:
+        with self._lock:
+            digest = self._digests.get(telegram_id)
+            return digest['interval'] if digest is not None else 0
+
+    def set_interval(self, telegram_id: int, minutes: int) -> None:
+        """
+        :param telegram_id: id подписчика
+        :param minutes: раз во сколько минут присылать дайджест; 0 -- присылать все сразу
+        (уже накопленное уйдет при следующей проверке)
+        """
+        if not 0 <= minutes <= MAX_INTERVAL:
+            raise ValueError('vault_digest: интервал должен быть от 0 до {} минут'.format(MAX_INTERVAL))
+        with self._lock:
+            digest = self._digests.setdefault(telegram_id, {'interval': 0, 'due': None, 'items': []})
+            digest['interval'] = minutes
+            if digest['items']:
+                new_due = time.time() + minutes * 60
+                digest['due'] = min(digest['due'], new_due) if digest['due'] is not None else new_due
+            self._save(telegram_id)
+
+    def postpone(self, subscribers: List[int], message: str) -> List[int]:
+        """
+        :param subscribers: подписчики, которым предназначено сообщение
+        :param message: сообщение в формате Markdown
+        :return: подписчики без дайджеста, которым сообщение надо отправить сейчас
+        """
+        now = time.time()
+        immediate = []
+        postponed = []
+        with self._lock:
+            for telegram_id in subscribers:
+                digest = self._digests.get(telegram_id)
+                if digest is None or not digest['interval']:
+                    immediate.append(telegram_id)
+                    continue
+                items = digest['items']
+                if not items:
+                    digest['due'] = now + digest['interval'] * 60
+                items.append(message)
+                if len(items) > MAX_ITEMS:
+                    del items[:len(items) - MAX_ITEMS]
+                    log.log('vault_digest: дайджест {} переполнен, старые сообщения выброшены'.format(telegram_id))
+                postponed.append(telegram_id)
+            if postponed:
+                self._save(*postponed)
+        return immediate
+
+    def due(self, now: Optional[float] = None) -> List[int]:
+        now = time.time() if now is None else now
+        with self._lock:
+            return [telegram_id for telegram_id, digest in self._digests.items()
+                    if digest['items'] and (not digest['interval'] or digest['due'] <= now)]
+
+    def flush(self, telegram_id: int) -> List[str]:
+        """
+        Забирает накопленные сообщения подписчика и очищает его дайджест
+
+        :param telegram_id: id подписчика
+        :return: сообщения не длиннее MESSAGE_LIMIT, первое начинается с заголовка дайджеста
+        """
+        with self._lock:
+            digest = self._digests.get(telegram_id)
+            if digest is None or not digest['items']:
+                return []
+            items = digest['items']
+            digest['items'] = []
+            digest['due'] = None
+            self._save(telegram_id)
+        header = '_Дайджест Убежища, обновлений: {}_'.format(len(items))
+        return pack_messages([header] + items, MESSAGE_LIMIT, SEPARATOR)
+
+
+__all__ = ['Digest', 'MESSAGE_LIMIT', 'MAX_INTERVAL']
@@ -1,115 +1,221 @@
-from typing import Union, Optional, Dict, List, Callable, Any
+from typing import Union, Optional, Dict, List, Set, Tuple, Callable, Any, Awaitable, Iterator
+from collections import deque
+import asyncio
+import copy
+import functools
+from threading import Event, Lock, RLock
 from telebot import types as markups
-from telebot import apihelper
+from telebot.apihelper import ApiException
 from database import Database
-from vault_api import Api
+from dispatcher import sharding
+from dispatcher.tasks import Task, MAX_ATTEMPTS
+from vault_api import Api, AsyncApi
 from vault_api.types import DiffPost, Comment
 from utils import log
-from utils.string_functions import de_markdown
-from global_variables import RUNNING_FLAG, TELEGRAM_BOT
+from utils.string_functions import de_markdown, de_markdown_shortened, split_message
+from global_variables import TELEGRAM_BOT
+from .vault_digest import Digest, MESSAGE_LIMIT, MAX_INTERVAL
+from .vault_subscriptions import Subscriptions, Topic
 from config import VAULT_TEST
 
+MAX_NEW_COMMENTS = 1000  # Больше комментариев за один раз рассылать не будем, даже после долгого простоя
+CAPTION_LIMIT = 1024  # Ограничение телеграма на длину подписи к фото
+ANSWER_LIMIT = 200  # и на длину всплывающего уведомления по нажатию кнопки
+MENU_ROW_WIDTH = 2  # Кнопок тем в ряду клавиатуры /sub
+
 
 class Vault:
     def __init__(self, testing):
+        self._testing = testing
         self._api = Api(testing=testing)
         self._flow_messages: List[DiffPost] = []
         self._boris_messages: List[Comment] = []
         self._godnota_updates: List[str] = []
-        self._db = Database('vault_plugin')
-        self._last_updates: Dict[str, Union[Dict[Union[str, int],
-                                                 Union[Optional[str],
-                                                       List[int],
-                                                       Dict[str,
-                                                            Union[str, List[int]]]]],
+        self._db = Database('vault_plugin', journal=True)
+        self._digest = Digest(self._db)
+        self._subscriptions = Subscriptions(self._db)
+        self._last_updates: Dict[str, Union[Dict[Union[str, int], Union[Optional[str], Dict[str, str]]],
                                             Optional[int]]] = \
-            {'flow': {'timestamp': None, 'subscribers': []},
-             'boris': {'timestamp': None, 'subscribers': []},
+            {'flow': {'timestamp': None},
+             'boris': {'timestamp': None},
              'comments': {}, 'comments_count': None}
         self._godnota: Optional[Dict[str, int]] = None
-        self._init_database()
+        self._ready = Event()
+        self._writer = False  # Инициализировался ли плагин лидером: только тогда он пишет last_updates
+        self._start_lock = Lock()
+        self._updates_lock = RLock()  # Подмена и изменение self._last_updates (_on_change против scheduled)
+        self._broadcasts = deque()  # payload'ы заданий 'vault_broadcast', еще не разосланные до конца, по порядку
+        self._broadcast_lock = Lock()  # Задания 'vault_broadcast' выполняются по одному
+        self._db.watch(self._on_change)
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start(self) -> None:
+        """
+        Медленная часть инициализации, которая ходит в Убежище: таймстемпы, годнота, первые комментарии.
+        Диспетчер вызывает ее в фоне при старте, а если тогда не получилось -- ее повторяет scheduled.
+        Пока она не закончилась, /sub и /unsub просят подождать, а рассылок нет.
+        В шардированном режиме воркер, ставший лидером, проходит ее заново, уже с записью last_updates
+        """
+        with self._start_lock:
+            if self.ready and (self._writer or not sharding.is_leader()):
+                return
+            if self._init_database():
+                self._ready.set()
 
     @staticmethod
     def _do_it_5_times(what_to_do: Callable[[Any], Any], *args: [Any], **kwargs: [Any]) -> Any:
+        """
+        Пробует сделать запрос к Убежищу пять раз. Неудача не смертельна: она только пишется в лог,
+        а start() повторит всю инициализацию при следующем запуске scheduled
+
+        :return: ответ или None, если все пять попыток не удались
+        """
         response = None
         try_counter = 5
         while response is None and try_counter:
             response = what_to_do(*args, **kwargs)
             try_counter -= 1
         if response is None:
-            RUNNING_FLAG.value = False
-            log.log('vault_plugin: ошибка при попытке сделать {} 5 раз'.format(what_to_do.__name__))
-            return
+            log.warning('vault_plugin: не удалось сделать {} 5 раз'.format(what_to_do.__name__))
         return response
 
-    def _init_database(self) -> None:
-        need_update_db = False
-        last_updates = self._db.get_document('last_updates')
-        if last_updates is None:
-            need_update_db = True
-            stats = self._do_it_5_times(self._api.get_stats)
-            if stats is None:
-                return
-            self._last_updates['comments_count'] = stats.comments_total
-            self._last_updates['flow']['timestamp'] = stats.timestamps_flow
-            self._last_updates['boris']['timestamp'] = stats.timestamps_boris
-        else:
-            tmp_dict = {}
-            for key in last_updates['comments']:
-                tmp_dict[int(key)] = last_updates['comments'][key]
-            del(last_updates['comments'])
-            last_updates['comments'] = tmp_dict
-            self._last_updates = last_updates
-        self._godnota = self._do_it_5_times(self._api.get_godnota)
-        if self._godnota is None:
-            log.log('vault_plugin: Не удалось получить годноту за пять попыток')
-            return
-        for title, post_id in self._godnota.items():
-            if post_id not in self._last_updates['comments']:
+    @staticmethod
+    async def _do_it_5_times_async(what_to_do: Callable[..., Awaitable[Any]], *args: Any) -> Any:
+        """
+        То же, что _do_it_5_times, для AsyncApi
+        """
+        response = None
+        try_counter = 5
+        while response is None and try_counter:
+            response = await what_to_do(*args)
+            try_counter -= 1
+        if response is None:
+            log.warning('vault_plugin: не удалось сделать {} 5 раз'.format(what_to_do.__name__))
+        return response
+
+    def _get_first_comments(self, nodes: List[int]) -> Dict[int, Any]:
+        """
+        Получает по одному последнему комментарию из каждой ноды. Если есть aiohttp -- параллельно,
+        иначе по очереди
+
+        :param nodes: id нод
+        :return: словарь вида {id ноды: Comments или None}
+        """
+        try:
+            api = AsyncApi(self._api.base_url)
+        except ImportError:
+            return {node: self._do_it_5_times(self._api.get_comments, node, 1) for node in nodes}
+
+        async def fetch_all():
+            async with api:
+                results = await asyncio.gather(*[self._do_it_5_times_async(api.get_comments, node, 1)
+                                                 for node in nodes])
+            return dict(zip(nodes, results))
+
+        return asyncio.run(fetch_all())
+
+    def _read_last_updates(self) -> Optional[dict]:
+        """
+        :return: копия last_updates из базы с int-ключами нод, или None, если их там еще нет
+        """
+        last_updates = copy.deepcopy(self._db.get_document('last_updates'))
+        if last_updates is not None:
+            last_updates['comments'] = {int(key): value for key, value in last_updates['comments'].items()}
+        return last_updates
+
+    def _init_database(self) -> bool:
+        """
+        :return: удалось ли инициализироваться (лидеру -- еще и записать last_updates)
+        """
+        with self._updates_lock:
+            writer = sharding.is_leader()
+            need_update_db = False
+            last_updates = self._read_last_updates()
+            if last_updates is None:
+                if writer:  # не-лидер ждет, пока их запишет лидер (см. _on_change)
+                    need_update_db = True
+                    stats = self._do_it_5_times(self._api.get_stats)
+                    if stats is None:
+                        return False
+                    self._last_updates['comments_count'] = stats.comments_total
+                    self._last_updates['flow']['timestamp'] = stats.timestamps_flow
+                    self._last_updates['boris']['timestamp'] = stats.timestamps_boris
+            else:
+                self._last_updates = last_updates
+                need_update_db = writer and self._migrate_subscribers()
+            self._godnota = self._do_it_5_times(self._api.get_godnota)
+            if self._godnota is None:
+                log.error('vault_plugin: Не удалось получить годноту за пять попыток')
+                return False
+            TELEGRAM_BOT.value.render_cache.invalidate('vault')  # клавиатуры и шаблоны собраны из старой годноты
+            if not writer:
+                return True
+            new_nodes = {title: post_id for title, post_id in self._godnota.items()
+                         if post_id not in self._last_updates['comments']}
+            first_comments = self._get_first_comments(list(new_nodes.values())) if new_nodes else {}
+            for title, post_id in new_nodes.items():
                 need_update_db = True
-                comments = self._do_it_5_times(self._api.get_comments, post_id, 1)
+                comments = first_comments[post_id]
                 if comments is None:
-                    log.log('vault_plugin: не удалось получить комментарии из {} за пять попыток'.format(title))
-                    return
-                self._last_updates['comments'][post_id]: Dict[str, Union[str, List[int]]] = {}
+                    log.error('vault_plugin: не удалось получить комментарии из {} за пять попыток'.format(title))
+                    return False
+                self._last_updates['comments'][post_id]: Dict[str, str] = {}
                 self._last_updates['comments'][post_id]['timestamp'] = comments.comments[0].created_at
-                self._last_updates['comments'][post_id]['subscribers'] = []
-        if need_update_db:
-            self._db.update_document('last_updates', fields_with_content=self._last_updates)
-            self._db.save_and_update()
+            if need_update_db:
+                self._db.update_document('last_updates', fields_with_content=self._last_updates)
+                self._db.save_and_update()
+            self._writer = True
+            return True
 
-    def _change_subscribers_list(self, target: Union[str, int], telegram_id: int, add: bool) -> bool:
-        need_update_db = False
-        if target in self._last_updates:
-            target = self._last_updates[target]['subscribers']
-            if add and telegram_id not in target:
-                need_update_db = True
-                target.append(telegram_id)
-            if not add and telegram_id in target:
-                need_update_db = True
-                target.remove(telegram_id)
-        elif target in self._last_updates['comments']:
-            target = self._last_updates['comments'][target]['subscribers']
-            if add and telegram_id not in target:
-                need_update_db = True
-                target.append(telegram_id)
-            if not add and telegram_id in target:
-                need_update_db = True
-                target.remove(telegram_id)
-        else:
+    def _on_change(self, changes: Dict[str, Set[str]]) -> None:
+        """
+        last_updates пишет только процесс-лидер (шардированный режим, см. dispatcher/sharding.py); остальные
+        подхватывают их, чтобы знать новые ноды годноты и, если станут лидером, не разослать старое заново
+        """
+        if 'last_updates' not in changes:
+            return
+        with self._updates_lock:
+            if self._writer:
+                return
+            last_updates = self._read_last_updates()
+            if last_updates is not None:
+                self._last_updates = last_updates
+
+    def _migrate_subscribers(self) -> bool:
+        """
+        Переносит подписчиков из списков в last_updates (так их хранили раньше) в индекс подписок
+
+        :return: нужно ли пересохранить last_updates
+        """
+        targets = [('flow', self._last_updates['flow']), ('boris', self._last_updates['boris'])]
+        targets.extend(self._last_updates['comments'].items())
+        found = False
+        for topic, target in targets:
+            if 'subscribers' in target:
+                found = True
+                self._subscriptions.add_subscribers(topic, target.pop('subscribers'))
+        return found
+
+    def _topics(self) -> List[Topic]:
+        return ['flow', 'boris', *self._last_updates['comments']]
+
+    def _change_subscribers_list(self, target: Topic, telegram_id: int, add: bool) -> bool:
+        if target not in self._last_updates and target not in self._last_updates['comments']:
             raise AssertionError('vault_plugin: ' + str(target) + 'отсутствует в базе')
-        if need_update_db:
-            self._db.update_document('last_updates', fields_with_content=self._last_updates)
-            self._db.save_and_update()
-        return need_update_db
+        if add:
+            return bool(self._subscriptions.subscribe(telegram_id, [target]))
+        return bool(self._subscriptions.unsubscribe(telegram_id, [target]))
 
     def _check_updates(self) -> None:
         stats = self._api.get_stats()
         if stats is not None:
             need_update_db = [self._update_flow(stats.timestamps_flow),
-                              self._update_boris(stats.timestamps_boris, stats.comments_total)]
+                              self._update_boris(stats.timestamps_boris)]
         else:
-            log.log('vault_plugin: не удалось получить stats Убежища.')
+            log.error('vault_plugin: не удалось получить stats Убежища.')
             return
         need_update_db.append(self._update_godnota())
         if stats.comments_total != self._last_updates['comments_count']:
@@ -130,11 +236,10 @@ class Vault:
             return True
         return False
 
-    def _update_boris(self, current_timestamp: str, current_comments_count: int) -> bool:
+    def _update_boris(self, current_timestamp: str) -> bool:
         last_timestamp = self._last_updates['boris']['timestamp']
-        comments_count = current_comments_count - self._last_updates['comments_count'] + 5
         if last_timestamp < current_timestamp:
-            comments = self._update_comments(self._api.boris_node, last_timestamp, comments_count)
+            comments = self._update_comments(self._api.boris_node, last_timestamp)
             if not comments:
                 return False
             self._last_updates['boris']['timestamp'] = current_timestamp
@@ -142,16 +247,17 @@ class Vault:
             return True
         return False
 
-    def _update_comments(self, node: int, last_timestamp: str, comments_count: int) -> List[Comment]:
-        comments_list = []
-        comments = self._api.get_comments(node, comments_count)
-        if comments is None:
-            return comments_list
-        for comment in comments.comments:
-            if comment.created_at <= last_timestamp:
-                break
-            comments_list.append(comment)
-        return comments_list
+    def _update_comments(self, node: int, last_timestamp: str) -> List[Comment]:
+        """
+        Возвращает комментарии новее last_timestamp, от новых к старым. Страницы запрашиваются, пока не встретится
+        комментарий старше last_timestamp, так что после простоя качается ровно столько, сколько написали
+
+        :param node: id ноды
+        :param last_timestamp: время последнего уже разосланного комментария
+        :return: список комментариев (пустой, если не удалось их получить)
+        """
+        comments = self._api.get_comments_since(node, last_timestamp, limit=MAX_NEW_COMMENTS)
+        return comments if comments is not None else []
 
     def _update_godnota(self) -> bool:
         # TODO протестировать, когда Григорий починит recent
@@ -165,111 +271,182 @@ class Vault:
                 current_timestamp = node.commented_at
                 current = self._last_updates['comments'][node_id]
                 last_timestamp = current['timestamp']
-                if current['subscribers'] and current_timestamp > last_timestamp:
+                if self._subscriptions.has_subscribers(node_id) and current_timestamp > last_timestamp:
                     need_update_db = True
                     current['timestamp'] = current_timestamp
                     self._godnota_updates.append(node.title)
         return need_update_db
 
+    def _answer_if_not_ready(self, telegram_id: int) -> bool:
+        """
+        :return: True, если плагин готов; иначе отвечает пользователю, что надо подождать, и возвращает False
+        """
+        if self.ready:
+            return True
+        TELEGRAM_BOT.value.send_message(telegram_id, 'Я еще загружаю данные Убежища, попробуйте через минуту')
+        return False
+
+    def _build_menu(self, add: bool) -> Tuple[List[Tuple[Topic, str, str]], str]:
+        """
+        Собирает неизменную часть клавиатуры /sub или /unsub уже в JSON: для каждой темы кнопку без галочки
+        и с галочкой, и последний ряд "На все"/"От всего" и "Закончить". callback_data кнопок --
+        'vault:тема', 'vault:all' и 'vault:done'
+
+        :return: ([(тема, кнопка, кнопка с галочкой)...], последний ряд)
+        """
+        titles = [('flow', 'Течение'), ('boris', 'Борис'), *[(node, title) for title, node in self._godnota.items()]]
+        buttons = []
+        for topic, title in titles:
+            data = 'vault:{}'.format(topic)
+            buttons.append((topic, markups.InlineKeyboardButton(title, callback_data=data).to_json(),
+                            markups.InlineKeyboardButton('✅ ' + title, callback_data=data).to_json()))
+        last_row = [markups.InlineKeyboardButton('На все' if add else 'От всего', callback_data='vault:all'),
+                    markups.InlineKeyboardButton('Закончить', callback_data='vault:done')]
+        return buttons, '[' + ', '.join(button.to_json() for button in last_row) + ']'
+
+    def _menu(self, telegram_id: int, add: bool) -> str:
+        """
+        Inline-клавиатура /sub или /unsub в JSON (его телеграм-клиент отправляет как есть): по кнопке на тему,
+        на что пользователь подписан -- с галочкой. Кнопки собраны заранее и лежат в render_cache бота
+        """
+        buttons, last_row = TELEGRAM_BOT.value.render_cache.get('vault', ('menu', add), lambda: self._build_menu(add))
+        subscribed = self._subscriptions.topics(telegram_id)
+        cells = [checked if topic in subscribed else button for topic, button, checked in buttons]
+        rows = ['[' + ', '.join(cells[number:number + MENU_ROW_WIDTH]) + ']'
+                for number in range(0, len(cells), MENU_ROW_WIDTH)]
+        rows.append(last_row)
+        return '{"inline_keyboard": [' + ', '.join(rows) + ']}'
+
+    def _open_menu(self, message, add: bool) -> None:
+        telegram_id = message.from_user.id
+        if not self._answer_if_not_ready(telegram_id):
+            return
+        text = 'На что хотите подписаться?' if add else 'От чего хотите отписаться?'
+        sent = TELEGRAM_BOT.value.send_message(telegram_id, text, reply_markup=self._menu(telegram_id, add))
+        TELEGRAM_BOT.value.conversations.begin(telegram_id, 'vault_sub' if add else 'vault_unsub',
+                                               message_id=sent.message_id)
+
     def sub(self, message):
         """
-        Хэндлер команды "/sub" из телеграмма. Рисует клавиатуру и регистрирует self.sub_next_step() как
-        обработчик следующего шага
+        Хэндлер команды "/sub" из телеграмма. Рисует inline-клавиатуру и начинает разговор 'vault_sub',
+        нажатия на кнопки обрабатывает self.callback()
         :param message: объект сообщения из телеграмма
         :return:
         """
-        telegram_id = message.from_user.id
-        markup = markups.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
-        markup.add(markups.KeyboardButton('Течение'), markups.KeyboardButton('Борис'),
-                   *[markups.KeyboardButton(target) for target in self._godnota],
-                   markups.KeyboardButton('Закончить'))
-        TELEGRAM_BOT.value.send_message(telegram_id, 'На что хотите подписаться?', reply_markup=markup)
-        TELEGRAM_BOT.value.register_next_step_handler(message, self.sub_next_step)
-
-    def sub_next_step(self, message):
-        """
-        Обработчик следующего шага от комманды "/sub" телеграмма. Добавляет подписчиков в базу и регистрирует сам
-        себя как обработчик следующего шага, пока пользователь не нажмет "Закончить"
-        :param message: объект соощения телеграмма
+        self._open_menu(message, add=True)
+
+    def unsub(self, message):
+        """
+        Хэндлер команды "/unsub" из телеграмма. Рисует inline-клавиатуру и начинает разговор 'vault_unsub',
+        нажатия на кнопки обрабатывает self.callback()
+        :param message: объект сообщения из телеграмма
         :return:
         """
-        text = message.text
-        telegram_id = message.from_user.id
-        if text == 'Течение':
-            result = self._change_subscribers_list('flow', telegram_id, add=True)
-            if result:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Теперь вы будете получать обновления Течения')
-            else:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Вы уже подписаны на Течение')
-        elif text == 'Борис':
-            result = self._change_subscribers_list('boris', telegram_id, add=True)
-            if result:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Теперь вы будете получать обновления Бориса')
-            else:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Вы уже подписаны на Бориса')
-        elif text in self._godnota:
-            result = self._change_subscribers_list(self._godnota[text], telegram_id, add=True)
-            if result:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Теперь вы будете получать обновления из ' + text)
-            else:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Вы уже подписаны на ' + text)
-        elif text == 'Закончить':
-            markup = markups.ReplyKeyboardRemove(selective=False)
-            TELEGRAM_BOT.value.send_message(message.from_user.id, 'Рад услужить', reply_markup=markup)
-            return
+        self._open_menu(message, add=False)
+
+    def _topic(self, data: str) -> Optional[Topic]:
+        if data in ('flow', 'boris'):
+            return data
+        try:
+            node = int(data)
+        except ValueError:
+            return None
+        return node if node in self._last_updates['comments'] else None
+
+    def _apply(self, telegram_id: int, data: str, add: bool) -> str:
+        """
+        Выполняет нажатие кнопки меню
+        :return: что ответить пользователю во всплывающем уведомлении
+        """
+        if data == 'all':  # списка тем во всплывающее уведомление не влезет, галочки на кнопках и так видно
+            if add:
+                added = self._subscriptions.subscribe(telegram_id, self._topics())
+                if added:
+                    return 'Теперь вы подписаны на все (новых подписок: {})'.format(len(added))
+                return 'Вы уже подписаны на все'
+            removed = self._subscriptions.unsubscribe(telegram_id)
+            if removed:
+                return 'Вы отписались от всего (было подписок: {})'.format(len(removed))
+            return 'Вы ни на что не были подписаны'
+        topic = self._topic(data)
+        if topic is None:
+            if add:
+                return 'Нельзя подписаться на то, чего для меня не существует. :3'
+            return 'Нельзя отписаться от того, чего не существует для меня. :3'
+        title = self._describe([topic])
+        changed = self._change_subscribers_list(topic, telegram_id, add=add)
+        if topic == 'flow':
+            title, whom = 'Течения', 'Течение'
+        elif topic == 'boris':
+            title, whom = 'Бориса', 'Бориса'
         else:
-            TELEGRAM_BOT.value.send_message(telegram_id, 'Нельзя подписаться на то, чего для меня не существует. :3')
-        TELEGRAM_BOT.value.register_next_step_handler(message, self.sub_next_step)
+            title, whom = 'из ' + title, title
+        if add:
+            return 'Теперь вы будете получать обновления ' + title if changed else 'Вы уже подписаны на ' + whom
+        return 'Теперь вы не будете получать обновления ' + title if changed else 'Вы не были подписаны на ' + whom
 
-    def unsub(self, message):
+    def callback(self, call):
         """
-        Хэндлер команды "/unsub" из телеграмма. Рисует клавиатуру и регистрирует self.unsub_next_step() как
-        обработчик следующего шага
-        :param message: объект сообщения из телеграмма
+        Обработчик нажатий на кнопки меню /sub и /unsub (callback_data 'vault:...'). Одно нажатие сразу
+        меняет подписку, отвечает всплывающим уведомлением и перерисовывает галочки в том же сообщении
+        :param call: объект CallbackQuery из телеграмма
         :return:
         """
-        telegram_id = message.from_user.id
-        markup = markups.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
-        markup.add(markups.KeyboardButton('Течение'), markups.KeyboardButton('Борис'),
-                   *[markups.KeyboardButton(target) for target in self._godnota],
-                   markups.KeyboardButton('Закончить'))
-        TELEGRAM_BOT.value.send_message(telegram_id, 'От чего хотите отписаться?', reply_markup=markup)
-        TELEGRAM_BOT.value.register_next_step_handler(message, self.unsub_next_step)
-
-    def unsub_next_step(self, message):
-        """
-        Обработчик следующего шага от комманды "/unsub" телеграмма. Добавляет подписчиков в базу и регистрирует сам
-        себя как обработчик следующего шага, пока пользователь не нажмет "Закончить"
-        :param message: объект соощения телеграмма
+        bot = TELEGRAM_BOT.value
+        telegram_id = call.from_user.id
+        message = call.message
+        data = call.data.split(':', 1)[1]
+        conversation = bot.conversations.get(telegram_id)
+        if (conversation is None or conversation['state'] not in ('vault_sub', 'vault_unsub')
+                or message is None or conversation['data'].get('message_id') != message.message_id):
+            bot.answer_callback_query(call.id, 'Это меню устарело, наберите /sub или /unsub еще раз')
+            if message is not None:
+                try:
+                    bot.edit_message_reply_markup(message.chat.id, message.message_id)
+                except ApiException:  # клавиатуру уже убрали
+                    pass
+            return
+        if not self.ready:
+            bot.answer_callback_query(call.id, 'Я еще загружаю данные Убежища, попробуйте через минуту')
+            return
+        if data == 'done':
+            bot.conversations.end(telegram_id)
+            bot.answer_callback_query(call.id)
+            bot.edit_message_text('Рад услужить', message.chat.id, message.message_id)
+            return
+        add = conversation['state'] == 'vault_sub'
+        before = self._subscriptions.topics(telegram_id)
+        answer = self._apply(telegram_id, data, add)
+        if len(answer) > ANSWER_LIMIT:  # например, очень длинное название ноды
+            answer = answer[:ANSWER_LIMIT - 1] + '…'
+        bot.answer_callback_query(call.id, answer)
+        bot.conversations.update(telegram_id)
+        if self._subscriptions.topics(telegram_id) != before:  # телеграм не дает "изменить" сообщение на такое же
+            bot.edit_message_reply_markup(message.chat.id, message.message_id,
+                                          reply_markup=self._menu(telegram_id, add))
+
+    def _describe(self, topics: List[Topic]) -> str:
+        """
+        Названия тем подписки через запятую в порядке клавиатуры /sub
+        """
+        titles = {'flow': 'Течение', 'boris': 'Борис'}
+        titles.update({node: title for title, node in (self._godnota or {}).items()})
+        order = {topic: number for number, topic in enumerate(self._topics())}
+        topics = sorted(topics, key=lambda topic: order.get(topic, len(order)))
+        return ', '.join(titles.get(topic, str(topic)) for topic in topics)
+
+    def subscriptions(self, message):
+        """
+        Хэндлер команды "/mysubs" из телеграмма: на что подписан пользователь
+        :param message: объект сообщения из телеграмма
         :return:
         """
         telegram_id = message.from_user.id
-        text = message.text
-        if text == 'Течение':
-            result = self._change_subscribers_list('flow', telegram_id, add=False)
-            if result:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Теперь вы не будете получать обновления Течения')
-            else:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Вы не были подписаны на Течение')
-        elif text == 'Борис':
-            result = self._change_subscribers_list('boris', telegram_id, add=False)
-            if result:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Теперь вы не будете получать обновления Бориса')
-            else:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Вы не были подписаны на Бориса')
-        elif text in self._godnota:
-            result = self._change_subscribers_list(self._godnota[text], telegram_id, add=False)
-            if result:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Теперь вы не будете получать обновления из ' + text)
-            else:
-                TELEGRAM_BOT.value.send_message(telegram_id, 'Вы не были подписаны на ' + text)
-        elif text == 'Закончить':
-            markup = markups.ReplyKeyboardRemove(selective=False)
-            TELEGRAM_BOT.value.send_message(message.from_user.id, 'Рад услужить', reply_markup=markup)
-            return
+        topics = self._subscriptions.topics(telegram_id)
+        if topics:
+            TELEGRAM_BOT.value.send_message(telegram_id, 'Вы подписаны на: ' + self._describe(list(topics)))
         else:
-            TELEGRAM_BOT.value.send_message(telegram_id, 'Нельзя отписаться от того, чего не существует для меня. :3')
-        TELEGRAM_BOT.value.register_next_step_handler(message, self.unsub_next_step)
+            TELEGRAM_BOT.value.send_message(telegram_id, 'Вы ни на что не подписаны. Подписаться -- /sub')
 
     def _send_image_message(self, post: DiffPost, link: str) -> None:
         user = self._generate_markdown_user_link(post.user.username)
@@ -277,50 +454,53 @@ class Vault:
         thumbnail = post.thumbnail
         template = '\n[{}]({})\n_Вот чем в Течении делится_ {} _(и, возможно, это еще не все)_'
         message = template.format(title, link, user)
+        # Подпись не длиннее CAPTION_LIMIT: урезается заголовок, а описанию достается то, что осталось
+        if post.title:
+            title = de_markdown_shortened(post.title, CAPTION_LIMIT - len(template.format('', link, user)))
+        caption = template.format(title, link, user)
         description = post.description
         if description:
-            message += '\n_да вдобавок пишет:_\n\n{}'.format(de_markdown(description))
-        try:
-            apihelper.CONNECT_TIMEOUT = 10
-            file_id = ''
-            for addressee in self._last_updates['flow']['subscribers']:
-                file_id = TELEGRAM_BOT.value.send_photo(addressee,
-                                                        file_id if file_id else thumbnail,
-                                                        caption=message,
-                                                        parse_mode='Markdown').photo[-1].file_id
-        except Exception as error:
-            error_message = 'vault_plugin: Ошибка при попытке отправить фото в телеграмм: ' + str(error)
-            log.log(error_message)
-        apihelper.CONNECT_TIMEOUT = 3.5
+            addition = '\n_да вдобавок пишет:_\n\n'
+            message += addition + de_markdown(description)
+            room = CAPTION_LIMIT - len(caption) - len(addition)
+            if room > 0:
+                caption += addition + de_markdown_shortened(description, room)
+        caption = split_message(caption, CAPTION_LIMIT)[0]  # если не влезает даже без заголовка
+        # В дайджест картинка не попадет, но заголовок все равно ведет на пост
+        subscribers = self._digest.postpone(self._subscriptions.subscribers('flow'), message)
+        if not subscribers:
+            return
+        if not thumbnail:
+            self._deliver(subscribers, message, 'flow')
+            return
+        # Кто не сможет получить картинку, получит пост текстом
+        TELEGRAM_BOT.value.media.send_photo(subscribers, thumbnail, caption, message, name='flow image',
+                                            parse_mode='Markdown')
 
     def _send_text_message(self, post: DiffPost, link: str) -> None:
         user = self._generate_markdown_user_link(post.user.username)
         template = '{} _делится мыслями в Течении:_\n\n[{}]({})\n{}'
         title = de_markdown(post.title) if post.title else "......."
         message = template.format(user, title, link, de_markdown(post.description))
-        for addressee in self._last_updates['flow']['subscribers']:
-            TELEGRAM_BOT.value.send_message(addressee, message, parse_mode='Markdown')
+        self._deliver(self._subscriptions.subscribers('flow'), message, 'flow')
 
     def _send_audio_message(self, post: DiffPost, link: str) -> None:
         user = self._generate_markdown_user_link(post.user.username)
         template = '{} _делится_ [аудиозаписью]({}) _в Течении (а может и не одной)._'
         message = template.format(user, link)
-        for addressee in self._last_updates['flow']['subscribers']:
-            TELEGRAM_BOT.value.send_message(addressee, message, parse_mode='Markdown')
+        self._deliver(self._subscriptions.subscribers('flow'), message, 'flow')
 
     def _send_video_message(self, post: DiffPost, link: str) -> None:
         user = self._generate_markdown_user_link(post.user.username)
         template = '{} _делится_ [видеозаписью]({}) _в Течении._'
         message = template.format(user, link)
-        for addressee in self._last_updates['flow']['subscribers']:
-            TELEGRAM_BOT.value.send_message(addressee, message, parse_mode='Markdown')
+        self._deliver(self._subscriptions.subscribers('flow'), message, 'flow')
 
     def _send_other_message(self, post: DiffPost, link: str) -> None:
         user = self._generate_markdown_user_link(post.user.username)
         template = '{} _делится чем-то_ [неординарным]({}) _в Течении._'
         message = template.format(user, link)
-        for addressee in self._last_updates['flow']['subscribers']:
-            TELEGRAM_BOT.value.send_message(addressee, message, parse_mode='Markdown')
+        self._deliver(self._subscriptions.subscribers('flow'), message, 'flow')
 
     def _send_boris_message(self, *comments):
         with_files = False
@@ -342,16 +522,36 @@ class Vault:
         else:
             with_files = ''
         message = template.format(user, link, text, with_files)
-        for addressee in self._last_updates['boris']['subscribers']:
-            TELEGRAM_BOT.value.send_message(addressee, message, parse_mode='Markdown')
+        self._deliver(self._subscriptions.subscribers('boris'), message, 'boris')
 
-    def _send_godnota_message(self, title: str, node: int) -> None:
+    def _build_godnota_message(self, title: str, node: int) -> str:
         template = '_В коллекции_ {} _появилось что-то новенькое_'
         url = '{}post{}'.format(self._api.url, node)
         link = '[{}]({})'.format(title, url)
-        message = template.format(link)
-        for addressee in self._last_updates['comments'][node]['subscribers']:
-            TELEGRAM_BOT.value.send_message(addressee, message, parse_mode='Markdown')
+        return template.format(link)
+
+    def _send_godnota_message(self, title: str, node: int) -> None:
+        message = TELEGRAM_BOT.value.render_cache.get('vault', ('godnota', node, title),
+                                                      lambda: self._build_godnota_message(title, node))
+        self._deliver(self._subscriptions.subscribers(node), message, 'godnota')
+
+    def _send_godnota_update(self, title: str) -> None:
+        self._send_godnota_message(title, self._godnota[title])
+
+    def _deliver(self, subscribers: List[int], message: str, name: str) -> None:
+        """
+        Рассылает сообщение тем, кто хочет получать обновления сразу (слишком длинное -- по частям),
+        а остальным складывает в дайджест
+        :param subscribers: подписчики
+        :param message: сообщение в формате Markdown
+        :param name: имя рассылки для статистики
+        :return: None
+        """
+        subscribers = self._digest.postpone(subscribers, message)
+        if not subscribers:
+            return
+        for part in split_message(message, MESSAGE_LIMIT):
+            TELEGRAM_BOT.value.broadcast(subscribers, 'send_message', part, parse_mode='Markdown', name=name)
 
     def _generate_markdown_user_link(self, username: str) -> str:
         """
@@ -361,30 +561,137 @@ class Vault:
         """
         return '[~{}]({}~{})'.format(username, self._api.url, username)
 
-    def scheduled(self):
+    def scheduled(self) -> List[Task]:
+        """
+        Запускается по таймеру: проверяет обновления и, если они есть, возвращает диспетчеру задание их разослать,
+        не дожидаясь самой рассылки. Если кому-то пора отправлять дайджест, добавляет и такое задание
+        """
+        self.start()  # Если плагин уже готов -- сразу возвращается
+        if not self.ready or not self._writer:
+            return []
+        with self._updates_lock:
+            self._check_updates()
+        tasks = []
+        flow, self._flow_messages = self._flow_messages, []
+        boris, self._boris_messages = self._boris_messages, []
+        godnota, self._godnota_updates = self._godnota_updates, []
+        if flow or boris or godnota:
+            payload = {'flow': flow, 'boris': boris, 'godnota': godnota}
+            self._broadcasts.append(payload)
+            tasks.append(Task('vault_broadcast', payload))
+        due = self._digest.due()
+        if due:
+            tasks.append(Task('vault_digest', {'subscribers': due}, priority=1))
+        return tasks
+
+    def send_digests(self, task: Task) -> None:
+        """
+        Обработчик задания 'vault_digest': отправляет подписчикам накопленные дайджесты
+
+        :param task: задание с payload вида {'subscribers': [telegram_id...]}
+        :return: None
+        """
+        for telegram_id in task.payload['subscribers']:
+            for message in self._digest.flush(telegram_id):
+                TELEGRAM_BOT.value.broadcast([telegram_id], 'send_message', message,
+                                             parse_mode='Markdown', name='digest')
+
+    def digest(self, message):
+        """
+        Хэндлер команды "/digest" из телеграмма. "/digest 60" -- присылать обновления раз в час одним дайджестом,
+        "/digest 0" -- присылать сразу, "/digest" -- показать текущую настройку
+        :param message: объект сообщения из телеграмма
+        :return:
+        """
+        telegram_id = message.from_user.id
+        arguments = message.text.split()[1:]
+        if not arguments:
+            minutes = self._digest.interval(telegram_id)
+            if minutes:
+                answer = 'Присылаю обновления дайджестом раз в {} мин.'.format(minutes)
+            else:
+                answer = 'Присылаю обновления сразу. Чтобы получать их дайджестом, напишите /digest <минуты>'
+            TELEGRAM_BOT.value.send_message(telegram_id, answer)
+            return
+        try:
+            minutes = int(arguments[0])
+            self._digest.set_interval(telegram_id, minutes)
+        except ValueError:
+            TELEGRAM_BOT.value.send_message(telegram_id, 'Нужно число минут от 0 до {}'.format(MAX_INTERVAL))
+            return
+        if minutes:
+            TELEGRAM_BOT.value.send_message(telegram_id, 'Буду присылать обновления раз в {} мин.'.format(minutes))
+        else:
+            TELEGRAM_BOT.value.send_message(telegram_id, 'Буду присылать обновления сразу')
+
+    def broadcast(self, task: Task) -> None:
+        """
+        Обработчик задания 'vault_broadcast': рассылает подписчикам посты Течения, комментарии Бориса
+        и обновления годноты, от старых к новым.
+        Задание рассылает не только свой payload, а все еще не разосланные по порядку (self._broadcasts):
+        если прошлое задание упало, следующее сначала дорассылает его, так что обновления не обгоняют друг друга
+        ни при повторах, ни при двух воркерах очереди, а сам повтор упавшего находит очередь уже пустой
+
+        :param task: задание с payload вида {'flow': [DiffPost...], 'boris': [Comment...], 'godnota': [название...]}
+        (списки -- от новых к старым)
+        :return: None
+        """
+        with self._broadcast_lock:
+            while self._broadcasts:
+                self._broadcast_payload(self._broadcasts[0])
+                self._broadcasts.popleft()
+
+    def _broadcast_payload(self, payload: Dict[str, Any]) -> None:
+        """
+        Рассылает один payload. Списки в нем не меняются, а сколько из них уже разослано, хранится
+        в payload['progress'], так что после ошибки рассылка продолжается с того, на чем упала.
+        Сообщение, которое не удалось разослать MAX_ATTEMPTS раз подряд, пропускается, чтобы не держать очередь
+        """
+        progress = payload.setdefault('progress', {'flow': 0, 'boris': 0, 'godnota': 0})
+        if self._subscriptions.has_subscribers('flow'):  # картинки качаются, пока рассылаются сообщения перед ними
+            TELEGRAM_BOT.value.media.prefetch(post.thumbnail for post in payload['flow'][::-1][progress['flow']:]
+                                              if post.type == 'image' and post.thumbnail)
+        for section, end, send in self._broadcast_steps(payload):
+            try:
+                send()
+            except Exception as error:
+                payload['failures'] = payload.get('failures', 0) + 1
+                if payload['failures'] < MAX_ATTEMPTS:
+                    raise
+                log.error('vault_plugin: не удалось разослать {} {} раз, пропускаю: {}'.format(
+                    section, MAX_ATTEMPTS, error))
+            payload['failures'] = 0
+            progress[section] = end
+
+    def _broadcast_steps(self, payload: Dict[str, Any]) -> Iterator[Tuple[str, int, Callable[[], None]]]:
         """
-        Запускает апдейт и рассылает сообщения по таймеру
+        :return: еще не разосланные сообщения payload по порядку: (раздел, его progress после отправки, отправка)
         """
+        progress = payload['progress']
         post_types: Dict[str, Callable[[DiffPost, str], None]] = {'image': self._send_image_message,
                                                                   'text': self._send_text_message,
                                                                   'audio': self._send_audio_message,
                                                                   'video': self._send_video_message,
                                                                   'other': self._send_other_message}
-        self._check_updates()
-        while self._flow_messages:
-            post = self._flow_messages.pop()
+        flow_messages = payload['flow'][::-1]
+        for index in range(progress['flow'], len(flow_messages)):
+            post = flow_messages[index]
             if post.type in post_types:
                 link = '{}post{}'.format(self._api.url, post.id)
-                post_types[post.type](post, link)
-        while self._boris_messages:
-            comments = [self._boris_messages.pop()]
-            while self._boris_messages and self._boris_messages[-1].user.username == comments[0].user.username:
-                comments.append(self._boris_messages.pop())
-            self._send_boris_message(*comments)
-        while self._godnota_updates:
-            title = self._godnota_updates.pop()
-            node = self._godnota[title]
-            self._send_godnota_message(title, node)
+                yield 'flow', index + 1, functools.partial(post_types[post.type], post, link)
+        boris_messages = payload['boris'][::-1]
+        index = progress['boris']
+        while index < len(boris_messages):
+            end = index + 1
+            username = boris_messages[index].user.username
+            while end < len(boris_messages) and boris_messages[end].user.username == username:
+                end += 1
+            yield 'boris', end, functools.partial(self._send_boris_message, *boris_messages[index:end])
+            index = end
+        godnota_updates = payload['godnota'][::-1]
+        for index in range(progress['godnota'], len(godnota_updates)):
+            title = godnota_updates[index]
+            yield 'godnota', index + 1, functools.partial(self._send_godnota_update, title)
 
 
 vault = Vault(VAULT_TEST)
@@ -0,0 +1,140 @@
+"""
+Подписки на обновления Убежища
+
+Тема подписки -- 'flow' (Течение), 'boris' (Борис) или id ноды годноты. Индекс держит оба направления:
+тема -> множество подписчиков и подписчик -> множество тем, так что и проверка/изменение подписки, и ответ на
+"на что я подписан" не требуют перебора. Для рассылки подписчики темы отдаются готовым списком, который
+пересобирается только после изменения подписок на эту тему.
+
+Подписки хранятся в документе 'subscriptions' коллекции vault_plugin, по полю на подписчика:
+{'telegram_id': [тема...]}. При изменении перезаписываются только поля тех, кого оно коснулось, так что
+в журнал БД уходит несколько байт, а не списки всех подписчиков. Подписки, измененные другими процессами
+бота (шардированный режим), индекс подхватывает через Database.watch
+"""
+from typing import Dict, Iterable, List, Optional, Set, Union
+from threading import Lock
+from database import Database
+
+Topic = Union[str, int]
+DOCUMENT = 'subscriptions'
+
+
+class Subscriptions:
+    """
+    Методы:
+    subscribe -- подписывает одного пользователя на несколько тем
+    unsubscribe -- отписывает одного пользователя от нескольких тем (по умолчанию -- от всех)
+    add_subscribers -- подписывает на одну тему многих пользователей
+    subscribers -- список подписчиков темы для рассылки
+    has_subscribers -- есть ли у темы хоть один подписчик
+    topics -- темы, на которые подписан пользователь
+    """
+    def __init__(self, db: Database):
+        """
+        :param db: коллекция, в которой хранить подписки
+        """
+        self._db = db
+        self._lock = Lock()
+        self._topics: Dict[Topic, Set[int]] = {}
+        self._users: Dict[int, Set[Topic]] = {}
+        self._snapshots: Dict[Topic, List[int]] = {}
+        saved = db.get_document(DOCUMENT) or {}
+        for telegram_id, topics in saved.items():  # В BSON ключи -- строки
+            self._add(int(telegram_id), topics)
+        db.watch(self._on_change)
+
+    def _add(self, telegram_id: int, topics: Iterable[Topic]) -> List[Topic]:
+        added = []
+        user_topics = self._users.setdefault(telegram_id, set())
+        for topic in topics:
+            if topic not in user_topics:
+                user_topics.add(topic)
+                self._topics.setdefault(topic, set()).add(telegram_id)
+                self._snapshots.pop(topic, None)
+                added.append(topic)
+        return added
+
+    def _remove(self, telegram_id: int, topics: Iterable[Topic]) -> List[Topic]:
+        user_topics = self._users.get(telegram_id, set())
+        removed = [topic for topic in topics if topic in user_topics]
+        for topic in removed:
+            user_topics.discard(topic)
+            self._topics[topic].discard(telegram_id)
+            self._snapshots.pop(topic, None)
+        return removed
+
+    def _on_change(self, changes: Dict[str, Set[str]]) -> None:
+        """
+        Подписки изменил другой процесс бота: приводим индекс к тому, что теперь лежит в БД
+        """
+        if DOCUMENT not in changes:
+            return
+        saved = self._db.get_document(DOCUMENT) or {}
+        with self._lock:
+            for field in changes[DOCUMENT]:
+                telegram_id = int(field)
+                topics = set(saved.get(field) or ())
+                self._remove(telegram_id, self._users.get(telegram_id, set()) - topics)
+                self._add(telegram_id, topics)
+
+    def _save(self, *telegram_ids: int) -> None:
+        fields = {str(telegram_id): sorted(self._users.get(telegram_id, ()), key=str) for telegram_id in telegram_ids}
+        self._db.update_document(DOCUMENT, fields_with_content=fields)
+        self._db.save_and_update()
+
+    def subscribe(self, telegram_id: int, topics: Iterable[Topic]) -> List[Topic]:
+        """
+        :param telegram_id: id пользователя
+        :param topics: темы
+        :return: темы, на которые он не был подписан раньше
+        """
+        with self._lock:
+            added = self._add(telegram_id, topics)
+            if added:
+                self._save(telegram_id)
+        return added
+
+    def unsubscribe(self, telegram_id: int, topics: Optional[Iterable[Topic]] = None) -> List[Topic]:
+        """
+        :param telegram_id: id пользователя
+        :param topics: темы; None -- все, на которые он подписан
+        :return: темы, на которые он был подписан
+        """
+        with self._lock:
+            removed = self._remove(telegram_id, list(self._users.get(telegram_id, ())) if topics is None else topics)
+            if removed:
+                self._save(telegram_id)
+        return removed
+
+    def add_subscribers(self, topic: Topic, telegram_ids: Iterable[int]) -> int:
+        """
+        :param topic: тема
+        :param telegram_ids: id пользователей
+        :return: сколько из них подписалось впервые
+        """
+        with self._lock:
+            added = [telegram_id for telegram_id in telegram_ids if self._add(telegram_id, [topic])]
+            if added:
+                self._save(*added)
+        return len(added)
+
+    def subscribers(self, topic: Topic) -> List[int]:
+        """
+        :return: подписчики темы; список общий для всех вызывающих до следующего изменения подписок, менять его нельзя
+        """
+        with self._lock:
+            snapshot = self._snapshots.get(topic)
+            if snapshot is None:
+                snapshot = self._snapshots[topic] = sorted(self._topics.get(topic, ()))
+            return snapshot
+
+    def has_subscribers(self, topic: Topic) -> bool:
+        with self._lock:
+            return bool(self._topics.get(topic))
+
+    def topics(self, telegram_id: int) -> Set[Topic]:
+        with self._lock:
+            return set(self._users.get(telegram_id, ()))
+
+
+__all__ = ['Subscriptions', 'Topic']
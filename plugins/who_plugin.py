@@ -1,24 +1,110 @@
 """
-Отправляет список всех пользователей, которых знает бот
+Отправляет список всех пользователей, которых знает бот, по страницам
+
+/who -- первая страница всех пользователей
+/who люди, /who боты, /who 2 -- только люди, только боты, только пользователи с уровнем доступа 2
+
+Под страницей -- inline-кнопки: листать назад/вперед и сменить фильтр. callback_data кнопок --
+'who:фильтр:страница', так что нажатие ничего не помнит между вызовами. Отсортированный по id список имен
+документов коллекции users для каждого фильтра (фильтр по is_bot и access_level идет по индексам БД) лежит
+в render_cache бота, пока боту не напишет новый пользователь, а сами документы читаются только
+для PAGE_SIZE пользователей на странице
 """
+from typing import Dict, List, Optional, Tuple
+from telebot import types as markups
+from database import Equals
 from global_variables import TELEGRAM_BOT
 
+PAGE_SIZE = 15  # Строка пользователя -- до ~250 символов, так что страница точно влезет в 4096
+FILTERS = {'all': 'Все', 'humans': 'Люди', 'bots': 'Боты', '1': 'Уровень 1', '2': 'Уровень 2'}
+ALIASES = {'все': 'all', 'люди': 'humans', 'боты': 'bots'}
+
+
+def _conditions(user_filter: str) -> Optional[Dict[str, Equals]]:
+    if user_filter == 'humans':
+        return {'is_bot': Equals(False)}
+    if user_filter == 'bots':
+        return {'is_bot': Equals(True)}
+    if user_filter.isdigit():
+        return {'access_level': Equals(int(user_filter))}
+    return None
+
+
+def _sort_key(name) -> Tuple[int, str]:
+    return len(str(name)), str(name)  # id -- неотрицательные числа, так быстрее, чем int()
+
+
+def _names(user_filter: str) -> List[str]:
+    names = TELEGRAM_BOT.value.db.get_document_names(_conditions(user_filter))
+    return sorted(names, key=_sort_key)
+
+
+def _row(user_id: str, user_info: dict) -> str:
+    is_bot = 'робот:   ' if user_info['is_bot'] else 'человек: '
+    return '{} {} {} ({}) {} {}'.format(user_id, is_bot, user_info.get('first_name') or '...',
+                                        user_info.get('username') or '...', user_info.get('last_name') or '...',
+                                        user_info['access_level'])
+
+
+def _page(user_filter: str, page: int) -> Tuple[str, markups.InlineKeyboardMarkup]:
+    """
+    :param user_filter: ключ FILTERS
+    :param page: номер страницы с нуля; если таких уже нет -- последняя
+    :return: (текст страницы, клавиатура)
+    """
+    names = TELEGRAM_BOT.value.render_cache.get('users', user_filter, lambda: _names(user_filter))
+    pages = max(1, (len(names) + PAGE_SIZE - 1) // PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    lines = ['Вот кого я знаю ({}, {} всего), страница {} из {}:'.format(FILTERS[user_filter].lower(), len(names),
+                                                                         page + 1, pages)]
+    for name in names[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]:
+        user_info = TELEGRAM_BOT.value.db.get_document(name)
+        if user_info is not None:
+            lines.append(_row(name, user_info))
+    markup = markups.InlineKeyboardMarkup(row_width=3)
+    navigation = []
+    if page > 0:
+        navigation.append(markups.InlineKeyboardButton('«', callback_data='who:{}:{}'.format(user_filter, page - 1)))
+    if page < pages - 1:
+        navigation.append(markups.InlineKeyboardButton('»', callback_data='who:{}:{}'.format(user_filter, page + 1)))
+    if navigation:
+        markup.row(*navigation)
+    markup.add(*[markups.InlineKeyboardButton(('• ' if key == user_filter else '') + title,
+                                              callback_data='who:{}:0'.format(key))
+                 for key, title in FILTERS.items()])
+    return '\n'.join(lines), markup
+
 
 def who(message):
-    answer = "Вот кого я знаю:\n"
-    row_template = '{} {} {} ({}) {} {}\n'
-    users = TELEGRAM_BOT.value.get_users()
-    for user_id, user_info in users.items():
-        is_bot = 'робот:   ' if user_info['is_bot'] else 'человек: '
-        access_level = user_info['access_level']
-        first_name = user_info['first_name']
-        first_name = first_name if first_name else '...'
-        username = user_info['username']
-        username = username if username else '...'
-        last_name = user_info['last_name']
-        last_name = last_name if last_name else '...'
-        answer += row_template.format(user_id, is_bot, first_name, username, last_name, access_level)
-    TELEGRAM_BOT.value.send_message(message.from_user.id, answer)
-
-
-__all__ = ['who']
+    """
+    Хэндлер команды "/who [фильтр]" из телеграмма
+    :param message: объект сообщения из телеграмма
+    :return:
+    """
+    arguments = message.text.split()[1:]
+    user_filter = ALIASES.get(arguments[0].lower(), arguments[0].lower()) if arguments else 'all'
+    if user_filter not in FILTERS:
+        TELEGRAM_BOT.value.send_message(message.from_user.id, 'Фильтры: ' + ', '.join(
+            list(ALIASES)[1:] + [key for key in FILTERS if key.isdigit()]))
+        return
+    text, markup = _page(user_filter, 0)
+    TELEGRAM_BOT.value.send_message(message.from_user.id, text, reply_markup=markup)
+
+
+def callback(call):
+    """
+    Обработчик кнопок под списком (callback_data 'who:фильтр:страница'): перерисовывает то же сообщение
+    :param call: объект CallbackQuery из телеграмма
+    :return:
+    """
+    _, user_filter, page = call.data.split(':')
+    TELEGRAM_BOT.value.answer_callback_query(call.id)
+    if user_filter not in FILTERS or not page.isdigit() or call.message is None:
+        return
+    text, markup = _page(user_filter, int(page))
+    if text == call.message.text:  # телеграм не дает "изменить" сообщение на такое же
+        return
+    TELEGRAM_BOT.value.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+
+__all__ = ['who', 'callback']
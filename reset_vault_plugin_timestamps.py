@@ -1,39 +1,32 @@
+"""
+Сбрасывает таймстемпы vault_plugin на текущее время, чтобы бот не разослал то, что появилось, пока он не работал.
+Работает через Database, поэтому подходит для любого хранилища (DATABASE_STORAGE в config.py).
+Запускать, когда бот остановлен: работающий бот перезапишет сброшенные значения своими
+"""
 import pprint
 from datetime import datetime
 
-import bson
+from database import Database
 
-VAULT_PLUGIN_FILEPATH = 'res/bsons/vault_plugin.bson'
-USERS_FILEPATH = 'res/bsons/users.bson'
 
-
-def open_file(filepath: str) -> dict:
-    with open(filepath, 'rb') as file:
-        db = bson.loads(file.read())
-    return db
-
-
-def save_file(filepath: str, db: dict) -> None:
-    db = bson.dumps(db)
-    with open(filepath, 'wb') as file:
-        file.write(db)
-
-
-def reset_timestamps(db: dict) -> None:
+def reset_timestamps(last_updates: dict) -> None:
     timestamp = datetime.utcnow().isoformat(timespec='milliseconds')[:-1] + 'Z'
-    db['last_updates']['boris']['timestamp'] = timestamp
-    db['last_updates']['flow']['timestamp'] = timestamp
-    for node_id in db['last_updates']['comments']:
-        db['last_updates']['comments'][node_id]['timestamp'] = timestamp
+    last_updates['boris']['timestamp'] = timestamp
+    last_updates['flow']['timestamp'] = timestamp
+    for node_id in last_updates['comments']:
+        last_updates['comments'][node_id]['timestamp'] = timestamp
 
 
 if __name__ == '__main__':
     pp = pprint.PrettyPrinter(indent=4)
-    db = open_file(VAULT_PLUGIN_FILEPATH)
+    db = Database('vault_plugin', journal=True)
+    last_updates = db.get_document('last_updates')
+    if last_updates is None:
+        raise SystemExit('В базе vault_plugin еще нет last_updates, сбрасывать нечего')
     print('=======BEFORE=======')
-    pp.pprint(db)
-    reset_timestamps(db)
+    pp.pprint(last_updates)
+    reset_timestamps(last_updates)
     print('\n=======AFTER=======')
-    pp.pprint(db)
-    save_file(VAULT_PLUGIN_FILEPATH, db)
-
+    pp.pprint(last_updates)
+    db.update_document('last_updates', fields_with_content=last_updates)
+    db.save_and_update()
@@ -1,18 +1,70 @@
 import time
-from dispatcher import Dispatcher
-from telegram import Bot
-from plugins import command_handlers, scheduled_handlers
+STARTED = time.monotonic()  # До импорта плагинов: время до первого обновления считается отсюда
 from config import TOKEN
-from global_variables import TELEGRAM_BOT
+from utils import metrics
 
+try:
+    from config import WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+except ImportError:  # Старый конфиг без настроек вебхука -- работаем через long polling
+    WEBHOOK_URL = ''
 
-bot = Bot(TOKEN)
-TELEGRAM_BOT.value = bot
-dp = Dispatcher(bot, command_handlers, scheduled_plugins=scheduled_handlers)
+try:
+    from config import METRICS_PORT
+except ImportError:
+    METRICS_PORT = 0
 
+try:
+    from config import METRICS_HOST
+except ImportError:
+    METRICS_HOST = '127.0.0.1'
 
-if __name__ == "__main__":
-    dp.start()
+try:
+    from config import SHARDS
+except ImportError:
+    SHARDS = 1
+
+
+def run_webhook(bot, dp) -> None:
+    from telegram.webhook import WebhookServer
+    server = WebhookServer(bot, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+    server.start()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+    dp.join()  # Диспетчер заканчивает работу, когда RUNNING_FLAG.value становится False
+    bot.remove_webhook()
+    server.stop()
+
+
+def run_polling(bot) -> None:
     bot.remove_webhook()
     time.sleep(0.5)
     bot.polling(none_stop=True)
+
+
+def run_single() -> None:
+    """
+    Обычный режим: один процесс -- один бот. Импорты здесь, а не наверху модуля: в шардированном режиме
+    воркеры (spawn) импортируют этот модуль заново, и плагины должны загружаться только в них
+    """
+    from dispatcher import Dispatcher
+    from telegram import Bot
+    from plugins import command_handlers, scheduled_handlers, task_handlers, callback_handlers, startup_handlers
+    from global_variables import TELEGRAM_BOT
+    bot = Bot(TOKEN, started=STARTED)
+    TELEGRAM_BOT.value = bot
+    dp = Dispatcher(bot, command_handlers, scheduled_plugins=scheduled_handlers, task_handlers=task_handlers,
+                    startup_handlers=startup_handlers, callback_plugins=callback_handlers)
+    if metrics.ENABLED and METRICS_PORT:
+        metrics.serve(METRICS_PORT, METRICS_HOST)
+    dp.start()
+    if WEBHOOK_URL:
+        run_webhook(bot, dp)
+    else:
+        run_polling(bot)
+
+
+if __name__ == "__main__":
+    if SHARDS > 1:  # Несколько процессов, обновления -- через long polling (см. dispatcher/sharding.py)
+        from dispatcher import sharding
+        sharding.run(TOKEN, SHARDS, STARTED)
+    else:
+        run_single()
@@ -1,52 +1,123 @@
 """
 Все что связано с телеграмом
 """
-from typing import Dict, List, Callable, Any, Union
+from typing import Dict, List, Callable, Any, Union, Tuple, Pattern, Optional
+import functools
 import re
+import time
 from telebot import TeleBot, util, apihelper
-from database import Database
+from database import Database, EQUALITY, RANGE
 from config import BOT_OWNER_ID
+from utils import log, metrics
+from .delivery import Delivery, Broadcast
+from .media import MediaCache
+from .conversations import Conversations
+from .render_cache import RenderCache
 
 apihelper.ENABLE_MIDDLEWARE = True
 
+REQUEST_SECONDS = metrics.histogram('telegram_request_seconds', 'Время запросов к Bot API, секунды')
+REQUEST_ERRORS = metrics.counter('telegram_request_errors_total', 'Неудачные запросы к Bot API')
+
+
+def _instrumented(make_request):
+    """
+    Все методы telebot (send_message, send_photo, getUpdates...) ходят в Bot API через apihelper._make_request,
+    так что время и ошибки каждого запроса меряются здесь, в одном месте
+    """
+    @functools.wraps(make_request)
+    def wrapper(token, method_name, *args, **kwargs):
+        if not metrics.ENABLED:
+            return make_request(token, method_name, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except Exception as error:
+            REQUEST_ERRORS.inc(method=method_name, code=getattr(error, 'error_code', 'network'))
+            raise
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, method=method_name)
+    return wrapper
+
+
+apihelper._make_request = _instrumented(apihelper._make_request)
+
 
 class Bot(TeleBot):
-    def __init__(self, token: str):
+    def __init__(self, token: str, started: Optional[float] = None, link=None):
         """
         :param token: токен телеграм-бота
+        :param started: время старта процесса (time.monotonic()), от которого считать время до первого обновления;
+        по умолчанию -- время создания бота
+        :param link: sharding.ShardLink, если бот -- один из процессов шардированного режима
         """
         super().__init__(token)
-        self.db = Database('users')
-        self._users = {}
+        self._started = started if started is not None else time.monotonic()
+        self.first_update_seconds: Optional[float] = None  # от старта до первого обработанного обновления
+        self.db = Database('users', journal=True, indexes={'access_level': RANGE, 'is_bot': EQUALITY})
+        self._users = {}  # уже прочитанные из БД пользователи
+        self._routes: Dict[str, Tuple[Callable[[Any], None], int]] = {}
+        self._callback_routes: Dict[str, Tuple[Callable[[Any], None], int]] = {}
+        self._regexps: Dict[str, Pattern] = {}
+        self.delivery = Delivery(self, link=link)
+        self.media = MediaCache(self.delivery)
+        self.conversations = Conversations()
+        self.render_cache = RenderCache()
+        metrics.gauge('delivery_queue_size', 'Сообщений в очереди рассылки', lambda: self.delivery.queue_size())
+        metrics.gauge('bot_first_update_seconds', 'От старта до первого обработанного обновления, секунды',
+                      lambda: self.first_update_seconds)
         self.default_middleware_handlers.append(self._middleware)
-        self._load_users()
+        self.db.watch(self._on_users_changed)
 
-    def _load_users(self):
+    def _on_users_changed(self, names: Dict[str, set]) -> None:
         """
-        Загружает список юзеров из БД
-        :return:
+        Пользователей изменил другой процесс бота (шардированный режим): забываем их, чтобы перечитать из БД
+        :param names: {имя документа: изменившиеся поля}
+        :return: None
         """
-        users = self.db.get_document_names()
-        for user_id in users:
-            self._users[user_id] = self.db.get_document(user_id)
+        for name in names:
+            self._users.pop(name, None)
+        self.render_cache.invalidate('users')
+
+    def _known_user(self, user_id: str) -> Optional[dict]:
+        """
+        Возвращает пользователя, при первом обращении читая его из БД. Всех пользователей при старте не грузим:
+        с хранилищем SQLite коллекция users читается по документу
+        :param user_id: id пользователя строкой
+        :return: документ пользователя или None, если он боту еще не писал
+        """
+        user = self._users.get(user_id)
+        if user is None:
+            user = self.db.get_document(user_id)
+            if user is not None:
+                self._users[user_id] = user
+        return user
 
     def _middleware(self, _, message):
         """
         Добавляет каждого впервые написавшего боту пользователя в список self._users и в БД коллекцию 'users'.
         (потому что данные -- это новое золото!)
         На самом деле нет. Это чтобы access_level'ы хранить в основном...
+        Пользователь берется из сообщения или из нажатия inline-кнопки, остальные обновления пропускаются
         :param _:
-        :param message:
+        :param message: обновление (Update)
         :return:
         """
-        message = message.message
+        if self.first_update_seconds is None:
+            self.first_update_seconds = time.monotonic() - self._started
+            template = 'bot: первое обновление взято в обработку через {:.2f} с после старта'
+            log.log(template.format(self.first_update_seconds))
+        message = message.message or message.callback_query
+        if message is None or message.from_user is None:
+            return
         user_info = {}
-        user_id = str(message.from_user.id)
-        is_bot = message.from_user.is_bot
-        if user_id not in self._users:
-            user_info['username'] = message.from_user.username
-            user_info['first_name'] = message.from_user.first_name
-            user_info['last_name'] = message.from_user.last_name
+        from_user = message.from_user
+        user_id = str(from_user.id)
+        is_bot = from_user.is_bot
+        if self._known_user(user_id) is None:
+            user_info['username'] = from_user.username
+            user_info['first_name'] = from_user.first_name
+            user_info['last_name'] = from_user.last_name
             user_info['is_bot'] = is_bot
             if is_bot:
                 user_info['access_level'] = 0
@@ -57,6 +128,7 @@ class Bot(TeleBot):
             self._users[user_id] = user_info
             self.db.update_document(user_id, fields_with_content=user_info)
             self.db.save_and_update()
+            self.render_cache.invalidate('users')
 
     def message_handler_method(self, handler, commands=None, regexp=None, func=None, content_types=None, **kwargs):
         """
@@ -85,39 +157,141 @@ class Bot(TeleBot):
 
     def load_command_plugins(self, plugins_list: List[Dict[str, Union[List[str], Callable[[Any], None], int]]]) -> None:
         """
-        Загрузка плагинов-обработчиков комманд из телеграма через self.message_handler()
+        Загрузка плагинов-обработчиков комманд из телеграма.
+        Вместо отдельного обработчика на каждый плагин (которые telebot перебирал бы по очереди, проверяя фильтры)
+        строится таблица {команда: (обработчик, уровень доступа)} и регистрируется один обработчик,
+        который находит команду в таблице за один поиск по словарю
 
         :param plugins_list: список словарей вида:
             [{'commands': ['команда'...], 'handler': функция-обработчик, 'access_level': уровень доступа}...]
         :return: None
         """
+        first_load = not self._routes
+        while plugins_list:
+            plugin = plugins_list.pop()
+            for command in plugin['commands']:
+                self._routes.setdefault(command, (plugin['handler'], plugin['access_level']))
+        if first_load:
+            self.message_handler_method(self._route_command, func=self._match_command)
+        self.render_cache.invalidate('commands')
+
+    @staticmethod
+    def _command_name(text: str) -> str:
+        """
+        То же, что util.extract_command, только без проверки на '/': '/help@boris48bot аргументы' -> 'help'
+        """
+        return text.split(maxsplit=1)[0].split('@', 1)[0][1:]
+
+    def _match_command(self, message) -> bool:
+        """
+        Фильтр единственного обработчика команд: есть ли команда в таблице и хватает ли пользователю доступа
+        """
+        text = message.text
+        if not text or text[0] != '/':  # Быстрый выход для обычного текста
+            return False
+        route = self._routes.get(self._command_name(text))
+        if route is None:
+            return False
+        user = self._known_user(str(message.from_user.id))
+        return user is not None and user['access_level'] >= route[1]
+
+    def _route_command(self, message) -> None:
+        self._routes[self._command_name(message.text)][0](message)
+
+    def load_callback_plugins(self, plugins_list: List[Dict[str, Union[List[str], Callable[[Any], None], int]]]) -> None:
+        """
+        Загрузка плагинов-обработчиков нажатий на inline-кнопки. Как и с командами, строится таблица
+        {префикс: (обработчик, уровень доступа)}, а префикс -- часть callback_data до первого ':'
+
+        :param plugins_list: список словарей вида:
+            [{'prefixes': ['префикс'...], 'handler': функция-обработчик, 'access_level': уровень доступа}...]
+        :return: None
+        """
+        first_load = not self._callback_routes
         while plugins_list:
             plugin = plugins_list.pop()
-            self.message_handler_method(plugin['handler'],
-                                        commands=plugin['commands'],
-                                        access_level=plugin['access_level'])
+            for prefix in plugin['prefixes']:
+                self._callback_routes.setdefault(prefix, (plugin['handler'], plugin['access_level']))
+        if first_load:
+            self.callback_query_handler(func=self._match_callback)(self._route_callback)
+
+    def _match_callback(self, call) -> bool:
+        route = self._callback_routes.get((call.data or '').split(':', 1)[0])
+        if route is None:
+            return False
+        user = self._known_user(str(call.from_user.id))
+        return user is not None and user['access_level'] >= route[1]
+
+    def _route_callback(self, call) -> None:
+        self._callback_routes[call.data.split(':', 1)[0]][0](call)
+
+    def get_commands(self) -> Dict[str, int]:
+        """
+        :return: словарь вида {команда: уровень доступа} для всех загруженных команд
+        """
+        return {command: route[1] for command, route in self._routes.items()}
 
     def _test_filter(self, message_filter, filter_value, message):
         """
         Test filters
-        Переопределен, чтобы добавить фильтр access_level
+        Переопределен, чтобы добавить фильтр access_level.
+        Проверки -- методы, выбираемые по словарю класса, а регулярные выражения компилируются один раз,
+        так что на каждое сообщение не создается ни одной новой функции
         :param message_filter:
         :param filter_value:
         :param message:
         :return:
         """
-        test_cases = {
-            'content_types': lambda msg: msg.content_type in filter_value,
-            'regexp': lambda msg: msg.content_type == 'text' and re.search(filter_value, msg.text, re.IGNORECASE),
-            'commands': lambda msg: msg.content_type == 'text' and util.extract_command(msg.text) in filter_value,
-            'func': lambda msg: filter_value(msg),
-            'access_level': lambda msg: self._users[str(msg.from_user.id)]['access_level'] >= filter_value
-        }
+        test = self._filter_tests.get(message_filter)
+        if test is None:
+            return False
+        return test(self, filter_value, message)
+
+    def _test_content_types(self, filter_value, message):
+        return message.content_type in filter_value
 
-        return test_cases.get(message_filter, lambda msg: False)(message)
+    def _test_regexp(self, filter_value, message):
+        if message.content_type != 'text':
+            return False
+        pattern = self._regexps.get(filter_value)
+        if pattern is None:
+            pattern = self._regexps[filter_value] = re.compile(filter_value, re.IGNORECASE)
+        return pattern.search(message.text)
+
+    def _test_commands(self, filter_value, message):
+        return message.content_type == 'text' and util.extract_command(message.text) in filter_value
+
+    def _test_func(self, filter_value, message):
+        return filter_value(message)
+
+    def _test_access_level(self, filter_value, message):
+        user = self._known_user(str(message.from_user.id)) if message.from_user is not None else None
+        return user is not None and user['access_level'] >= filter_value
+
+    _filter_tests = {'content_types': _test_content_types,
+                     'regexp': _test_regexp,
+                     'commands': _test_commands,
+                     'func': _test_func,
+                     'access_level': _test_access_level}
 
     def get_user_access_level(self, user_id: int) -> int:
-        return self._users[str(user_id)]['access_level']
+        """
+        :return: уровень доступа пользователя; 0 -- если он боту еще не писал
+        """
+        user = self._known_user(str(user_id))
+        return user['access_level'] if user is not None else 0
 
     def get_users(self) -> dict:
-        return self._users.copy()
+        return {user_id: self.db.get_document(user_id) for user_id in self.db.get_document_names()}
+
+    def broadcast(self, addressees, method: str, *args, **kwargs) -> Broadcast:
+        """
+        Рассылает одно и то же сообщение многим адресатам через пул воркеров self.delivery, не дожидаясь отправки.
+        Пример:
+        bot.broadcast(subscribers, 'send_message', 'текст', parse_mode='Markdown')
+
+        :param addressees: id чатов
+        :param method: имя метода бота для отправки ('send_message', 'send_photo'...)
+        :return: объект рассылки, у которого можно спросить статистику или дождаться окончания через wait()
+        """
+        return self.delivery.broadcast(addressees, method, *args, **kwargs)
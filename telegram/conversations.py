@@ -0,0 +1,130 @@
+"""
+Разговоры с пользователями, которые длятся дольше одного сообщения (например, меню /sub)
+
+Conversations хранит для каждого чата не больше одного разговора: состояние (строка, которую придумывает плагин,
+например 'vault_sub'), данные плагина и время, после которого разговор считается брошенным.
+Поиск по чату -- один поиск в словаре; брошенные разговоры выкидываются при обращении к ним
+и раз в ttl секунд проходом по всем.
+
+Разговоры хранятся в документе 'conversations' коллекции 'conversations', по полю на чат
+(закончившийся разговор -- None), так что после перезапуска бота открытые меню продолжают работать
+"""
+from typing import Any, Dict, Optional
+from threading import Lock
+import time
+from database import Database
+
+TTL = 15 * 60  # Сколько секунд разговор живет без действий пользователя
+DOCUMENT = 'conversations'
+
+
+def _copy(conversation: Dict[str, Any]) -> Dict[str, Any]:
+    return {'state': conversation['state'], 'data': dict(conversation['data']), 'expires': conversation['expires']}
+
+
+class Conversations:
+    """
+    Методы:
+    begin -- начинает разговор (прежний разговор в этом чате заканчивается)
+    get -- текущий разговор чата или None
+    update -- меняет состояние и/или данные разговора и продлевает его
+    end -- заканчивает разговор
+    sweep -- выкидывает брошенные разговоры
+    """
+    def __init__(self, db: Optional[Database] = None, ttl: float = TTL):
+        """
+        :param db: коллекция, в которой хранить разговоры (по умолчанию 'conversations')
+        :param ttl: сколько секунд разговор живет без действий пользователя
+        """
+        self._db = db if db is not None else Database('conversations', journal=True)
+        self._ttl = ttl
+        self._lock = Lock()
+        saved = self._db.get_document(DOCUMENT) or {}
+        # В BSON ключи -- строки
+        self._conversations: Dict[int, Dict[str, Any]] = {int(chat_id): conversation
+                                                          for chat_id, conversation in saved.items() if conversation}
+        self._swept = time.time()
+        self.sweep()
+
+    def _save(self, *chat_ids: int) -> None:
+        fields = {}
+        for chat_id in chat_ids:
+            conversation = self._conversations.get(chat_id)
+            fields[str(chat_id)] = _copy(conversation) if conversation is not None else None
+        self._db.update_document(DOCUMENT, fields_with_content=fields)
+        self._db.save_and_update()
+
+    def _maybe_sweep(self, now: float) -> None:
+        if now - self._swept > self._ttl:
+            self.sweep()
+
+    def begin(self, chat_id: int, state: str, **data: Any) -> Dict[str, Any]:
+        """
+        :param chat_id: id чата
+        :param state: начальное состояние
+        :param data: данные плагина, например message_id меню
+        :return: разговор {'state': ..., 'data': {...}, 'expires': time.time()...}
+        """
+        now = time.time()
+        self._maybe_sweep(now)
+        with self._lock:
+            conversation = self._conversations[chat_id] = {'state': state, 'data': data, 'expires': now + self._ttl}
+            self._save(chat_id)
+            return _copy(conversation)
+
+    def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            conversation = self._conversations.get(chat_id)
+            if conversation is None:
+                return None
+            if conversation['expires'] <= time.time():
+                del self._conversations[chat_id]
+                self._save(chat_id)
+                return None
+            return _copy(conversation)
+
+    def update(self, chat_id: int, state: Optional[str] = None, **data: Any) -> Optional[Dict[str, Any]]:
+        """
+        :param chat_id: id чата
+        :param state: новое состояние; None -- оставить прежнее
+        :param data: данные, которые дописать к данным разговора
+        :return: разговор или None, если его нет или он уже брошен
+        """
+        if self.get(chat_id) is None:
+            return None
+        with self._lock:
+            conversation = self._conversations.get(chat_id)
+            if conversation is None:
+                return None
+            if state is not None:
+                conversation['state'] = state
+            conversation['data'].update(data)
+            conversation['expires'] = time.time() + self._ttl
+            self._save(chat_id)
+            return _copy(conversation)
+
+    def end(self, chat_id: int) -> None:
+        with self._lock:
+            if self._conversations.pop(chat_id, None) is not None:
+                self._save(chat_id)
+
+    def sweep(self) -> int:
+        """
+        :return: сколько брошенных разговоров выкинуто
+        """
+        now = time.time()
+        with self._lock:
+            self._swept = now
+            expired = [chat_id for chat_id, conversation in self._conversations.items()
+                       if conversation['expires'] <= now]
+            for chat_id in expired:
+                del self._conversations[chat_id]
+            if expired:
+                self._save(*expired)
+        return len(expired)
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+
+__all__ = ['Conversations', 'TTL']
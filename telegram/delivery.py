@@ -0,0 +1,324 @@
+"""
+Модуль рассылки сообщений в телеграм
+
+TokenBucket -- ведро токенов для ограничения частоты отправки
+Broadcast -- одна рассылка: счетчики отправленного, задержки, итоговая статистика
+Delivery -- пул воркеров с общей очередью исходящих сообщений
+
+Сообщения для одного чата складываются в его личный почтовый ящик (deque), а в общую очередь попадает только id чата.
+Пока у чата есть неотправленные сообщения, его id лежит в очереди не больше одного раза,
+поэтому одним чатом в каждый момент занимается только один воркер и порядок сообщений в чате сохраняется.
+
+В шардированном режиме (dispatcher/sharding.py) у каждого процесса бота своя Delivery: рассылка оставляет себе
+адресатов своего процесса, а остальных отдает их процессам, и GLOBAL_RATE делится между процессами поровну.
+"""
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from collections import deque
+from threading import Thread, Lock, Event
+import queue
+import time
+import requests
+from utils import log, metrics
+
+GLOBAL_RATE = 30  # Телеграм разрешает боту около 30 сообщений в секунду на всех
+CHAT_RATE = 1  # и около одного сообщения в секунду в один чат
+CHAT_BURST = 3  # но короткие всплески в личку он прощает
+WORKERS = 8
+MAX_RETRIES = 3
+MESSAGES = metrics.counter('delivery_messages_total', 'Сообщения рассылок: sent, failed, retried, fallback')
+LATENCY_SECONDS = metrics.histogram('delivery_latency_seconds', 'От постановки в очередь до отправки, секунды',
+                                    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0))
+Fallback = Union[Tuple[str, tuple, dict], List[Tuple[str, tuple, dict]]]  # Запасной вызов или несколько подряд
+
+
+class TokenBucket:
+    """
+    Ведро токенов: пополняется со скоростью rate токенов в секунду, вмещает не больше capacity
+    Методы:
+    acquire -- забирает токен, если надо -- ждет его появления
+    pause -- запрещает выдачу токенов на seconds секунд (для 429 с retry_after)
+    is_full -- ведро полное, то есть ничем не отличается от нового
+    """
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self, now: float) -> None:
+        if now > self._updated:
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+    def acquire(self) -> float:
+        """
+        Забирает один токен. Если токенов нет -- спит ровно столько, сколько нужно до появления следующего
+
+        :return: сколько секунд пришлось ждать
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self._rate
+            wait += max(0.0, self._updated - now)  # если ведро на паузе, _updated лежит в будущем
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0)
+            self._updated = max(self._updated, time.monotonic() + seconds)
+
+    def is_full(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens >= self._capacity
+
+
+class Broadcast:
+    """
+    Рассылка одного и того же сообщения по списку адресатов.
+    Считает отправленные и неудачные сообщения, время от постановки в очередь до отправки,
+    а когда все сообщения обработаны -- пишет в лог пропускную способность и задержки
+    """
+    def __init__(self, name: str, total: int, keep_results: bool = False,
+                 on_result: Optional[Callable[[int, bool], None]] = None):
+        self.name = name
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.fallbacks = 0  # сколько адресатов получили запасное сообщение вместо основного
+        self.results: Dict[int, Any] = {}
+        self._keep_results = keep_results
+        self._on_result = on_result
+        self._latencies: List[float] = []
+        self._started = time.monotonic()
+        self._finished = None
+        self._lock = Lock()
+        self._done = Event()
+        if not total:
+            self._finish()
+
+    def _register(self, addressee: int, result: Any, latency: float, ok: bool, fallback: bool = False) -> None:
+        with self._lock:
+            if fallback:
+                self.fallbacks += 1
+            if ok:
+                self.sent += 1
+                if self._keep_results:
+                    self.results[addressee] = result
+            else:
+                self.failed += 1
+            self._latencies.append(latency)
+            if self.sent + self.failed == self.total:
+                self._finish()
+        if self._on_result is not None:
+            self._on_result(addressee, ok)
+
+    def _finish(self) -> None:
+        self._finished = time.monotonic()
+        self._done.set()
+        if self.total > 1:  # одиночные отправки в лог не пишутся, чтобы его не засорять
+            log.log('delivery: ' + self.report())
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    def report(self) -> str:
+        """
+        :return: строка со статистикой рассылки
+        """
+        elapsed = (self._finished or time.monotonic()) - self._started
+        latencies = sorted(self._latencies)
+        p50 = latencies[len(latencies) // 2] if latencies else 0.0
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0
+        rate = (self.sent + self.failed) / elapsed if elapsed else 0.0
+        template = '{}: отправлено {}/{}, ошибок {}, {:.1f} сообщ./сек, задержка p50 {:.2f} с, p99 {:.2f} с'
+        report = template.format(self.name, self.sent, self.total, self.failed, rate, p50, p99)
+        if self.fallbacks:
+            report += ', запасных сообщений {}'.format(self.fallbacks)
+        return report
+
+
+class Delivery:
+    """
+    Пул воркеров, рассылающих сообщения через методы бота с учетом ограничений телеграма
+    Методы:
+    start -- запускает воркеры (вызывается сам при первой рассылке)
+    broadcast -- ставит в очередь одно сообщение для многих адресатов и сразу возвращает Broadcast
+    send -- отправляет одно сообщение и дожидается результата
+    """
+    def __init__(self, bot, workers: int = WORKERS, global_rate: float = GLOBAL_RATE,
+                 chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST, max_retries: int = MAX_RETRIES,
+                 link=None):
+        """
+        :param bot: объект бота, методы которого будут вызываться для отправки
+        :param workers: количество воркеров
+        :param global_rate: сообщений в секунду на всех
+        :param chat_rate: сообщений в секунду в один чат
+        :param chat_burst: сколько сообщений подряд можно отправить в один чат без ожидания
+        :param max_retries: сколько раз повторять отправку после 429 или сетевой ошибки
+        :param link: sharding.ShardLink -- связь с другими процессами бота в шардированном режиме, иначе None
+        """
+        if link is not None:
+            global_rate /= link.shards
+        self._bot = bot
+        self._link = link
+        self._workers_count = workers
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._mailboxes: Dict[int, deque] = {}
+        self._queue = queue.Queue()
+        self._lock = Lock()
+        self._workers: List[Thread] = []
+
+    def start(self) -> None:
+        with self._lock:
+            if self._workers:
+                return
+            for number in range(self._workers_count):
+                worker = Thread(target=self._worker, name='delivery-{}'.format(number), daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def broadcast(self, addressees: Iterable[int], method: str, *args: Any,
+                  name: Optional[str] = None, keep_results: bool = False,
+                  fallback: Optional[Fallback] = None,
+                  on_result: Optional[Callable[[int, bool], None]] = None, **kwargs: Any) -> Broadcast:
+        """
+        Ставит в очередь вызов bot.method(адресат, *args, **kwargs) для каждого адресата
+
+        :param addressees: id чатов
+        :param method: имя метода бота, например 'send_message'
+        :param name: имя рассылки для статистики в логе
+        :param keep_results: сохранять ли в Broadcast.results то, что вернул метод бота
+        :param fallback: (метод, args, kwargs) или список таких вызовов -- что отправить адресату, если основное
+        сообщение отправить не удалось (например, текст вместо картинки, если он длинный -- по частям)
+        :param on_result: функция(адресат, отправлено ли), которую воркер вызывает после каждой отправки
+        (с keep_results или on_result в шардированном режиме рассылка целиком остается в этом процессе)
+        :return: объект рассылки; в шардированном режиме -- только по адресатам этого процесса
+        """
+        if self._link is not None and not keep_results and on_result is None:
+            addressees = self._link.forward(addressees, method, args, dict(kwargs, name=name, fallback=fallback))
+        addressees = list(addressees)
+        broadcast = Broadcast(name or method, len(addressees), keep_results, on_result)
+        if not addressees:
+            return broadcast
+        self.start()
+        self._prune_buckets()
+        enqueued = time.monotonic()
+        for addressee in addressees:
+            self._put(addressee, (broadcast, method, args, kwargs, enqueued, fallback))
+        return broadcast
+
+    def send(self, addressee: int, method: str, *args: Any, **kwargs: Any) -> Any:
+        """
+        Отправляет одно сообщение через общую очередь и ждет результата
+
+        :return: то, что вернул метод бота, или None, если отправить не удалось
+        """
+        broadcast = self.broadcast([addressee], method, *args, keep_results=True, **kwargs)
+        broadcast.wait()
+        return broadcast.results.get(addressee)
+
+    def queue_size(self) -> int:
+        with self._lock:
+            return sum(map(len, self._mailboxes.values()))
+
+    def _put(self, addressee: int, job: tuple) -> None:
+        with self._lock:
+            mailbox = self._mailboxes.get(addressee)
+            if mailbox is None:
+                self._mailboxes[addressee] = deque([job])
+                self._queue.put(addressee)
+            else:
+                mailbox.append(job)
+
+    def _prune_buckets(self) -> None:
+        with self._lock:
+            idle = [chat for chat, bucket in self._chat_buckets.items()
+                    if chat not in self._mailboxes and bucket.is_full()]
+            for chat in idle:
+                del self._chat_buckets[chat]
+
+    def _worker(self) -> None:
+        while True:
+            addressee = self._queue.get()
+            with self._lock:
+                mailbox = self._mailboxes[addressee]
+                job = mailbox[0]
+                bucket = self._chat_buckets.get(addressee)
+                if bucket is None:
+                    bucket = self._chat_buckets[addressee] = TokenBucket(self._chat_rate, self._chat_burst)
+            self._deliver(addressee, bucket, *job)
+            with self._lock:
+                mailbox.popleft()
+                if mailbox:
+                    self._queue.put(addressee)
+                else:
+                    del self._mailboxes[addressee]
+
+    def _deliver(self, addressee: int, bucket: TokenBucket, broadcast: Broadcast, method: str, args: tuple,
+                 kwargs: dict, enqueued: float, fallback: Optional[Fallback]) -> None:
+        calls = deque([(method, args, kwargs)])
+        attempt = 0
+        used_fallback = False
+        result = None
+        while calls:
+            method, args, kwargs = calls[0]
+            bucket.acquire()
+            self._global_bucket.acquire()
+            try:
+                result = getattr(self._bot, method)(addressee, *args, **kwargs)
+            except Exception as error:
+                retry_after = _retry_after(error)
+                if attempt < self._max_retries and retry_after is not None:
+                    attempt += 1
+                    MESSAGES.inc(result='retried', method=method)
+                    bucket.pause(retry_after)
+                    continue
+                log.warning('delivery: не удалось выполнить {} для {}: {}'.format(method, addressee, error),
+                            method=method, chat_id=addressee)
+                if fallback is not None:
+                    MESSAGES.inc(result='fallback', method=method)
+                    calls = deque(fallback if isinstance(fallback, list) else [fallback])
+                    fallback = None
+                    used_fallback = True
+                    attempt = 0
+                    continue
+                MESSAGES.inc(result='failed', method=method)
+                broadcast._register(addressee, None, time.monotonic() - enqueued, ok=False, fallback=used_fallback)
+                return
+            MESSAGES.inc(result='sent', method=method)
+            calls.popleft()
+            attempt = 0
+        latency = time.monotonic() - enqueued
+        LATENCY_SECONDS.observe(latency)
+        broadcast._register(addressee, result, latency, ok=True, fallback=used_fallback)
+
+
+def _retry_after(error: Exception) -> Optional[Union[int, float]]:
+    """
+    Разбирает исключение telebot и решает, имеет ли смысл повторить отправку
+
+    :return: через сколько секунд повторить, или None, если повторять бесполезно
+    """
+    error_code = getattr(error, 'error_code', None)
+    if error_code == 429:
+        result_json = getattr(error, 'result_json', None) or {}
+        return result_json.get('parameters', {}).get('retry_after', 1)
+    if error_code is not None:
+        return 1 if error_code >= 500 else None  # 4xx: бот заблокирован, чат не найден, кривая разметка и т.п.
+    if isinstance(error, requests.exceptions.RequestException):
+        return 1
+    return None
+
+
+__all__ = ['Delivery', 'Broadcast', 'TokenBucket']
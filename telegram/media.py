@@ -0,0 +1,246 @@
+"""
+Кэш загруженных в телеграм картинок
+
+Телеграм отдает на каждую отправленную картинку file_id, по которому ее можно отправлять снова без загрузки.
+MediaCache помнит два отображения: адрес картинки -> хэш содержимого и хэш содержимого -> file_id.
+Поэтому одна и та же картинка загружается в телеграм один раз, даже если приходит по разным адресам.
+
+Оба отображения -- LRU размером не больше max_entries. Они хранятся в документе 'media' коллекции 'media'
+одним списком [[адрес, хэш, file_id]...] от старых к новым и переписываются при каждой новой загрузке.
+
+prefetch заранее (в пуле тредов, пока рассылаются текстовые сообщения) скачивает картинки, а если в config.py
+задан MEDIA_STORAGE_CHAT_ID -- еще и загружает их в этот чат, так что рассылка сразу начинается с file_id.
+Адресаты, которым картинку отправить не удалось, получают вместо нее текст
+"""
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+import datetime
+import hashlib
+import requests
+from database import Database
+from utils import log
+from utils.string_functions import split_message
+
+try:
+    from config import MEDIA_STORAGE_CHAT_ID
+except ImportError:
+    MEDIA_STORAGE_CHAT_ID = None
+
+MAX_ENTRIES = 1000
+MAX_SIZE = 10 * 1024 * 1024  # Больше телеграм все равно не примет как фото
+WORKERS = 4
+MESSAGE_LIMIT = 4096  # Ограничение телеграма на длину сообщения (запасной текст длиннее отправляется по частям)
+UPLOAD_ATTEMPTS = 3  # Если картинку не удалось загрузить стольким адресатам подряд, остальным шлем текст
+TIMEOUT = (5, 30)
+DOCUMENT = 'media'
+
+
+class MediaCache:
+    """
+    Методы:
+    prefetch -- заранее скачивает (и, если есть чат-хранилище, загружает в телеграм) картинки в пуле тредов
+    send_photo -- рассылает картинку, по возможности через file_id из кэша
+    stats -- счетчики попаданий и загрузок
+    report -- то же строкой, с долей попаданий
+    """
+    def __init__(self, delivery, db: Optional[Database] = None, max_entries: int = MAX_ENTRIES,
+                 storage_chat: Optional[int] = MEDIA_STORAGE_CHAT_ID, workers: int = WORKERS):
+        """
+        :param delivery: объект telegram.delivery.Delivery, через который идет отправка
+        :param db: коллекция, в которой хранить кэш (по умолчанию 'media')
+        :param max_entries: сколько адресов и сколько file_id помнить
+        :param storage_chat: чат, в который загружать картинки заранее, или None
+        :param workers: сколько картинок качать одновременно
+        """
+        self._delivery = delivery
+        self._db = db if db is not None else Database('media', journal=True)
+        self._max_entries = max_entries
+        self._storage_chat = storage_chat
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media')
+        self._session = requests.Session()
+        self._lock = Lock()
+        self._urls: 'OrderedDict[str, str]' = OrderedDict()  # адрес -> хэш содержимого
+        self._files: 'OrderedDict[str, str]' = OrderedDict()  # хэш содержимого -> file_id
+        self._pending: Dict[str, Future] = {}  # адрес -> скачивание, запущенное prefetch
+        self._day = datetime.datetime.utcnow().date()
+        self._stats = self._empty_stats()
+        self._load()
+
+    @staticmethod
+    def _empty_stats() -> Dict[str, int]:
+        return {'url_hits': 0, 'content_hits': 0, 'misses': 0, 'uploads': 0, 'upload_errors': 0,
+                'downloads': 0, 'download_errors': 0}
+
+    def _load(self) -> None:
+        document = self._db.get_document(DOCUMENT) or {}
+        for url, digest, file_id in document.get('entries', []):
+            self._urls[url] = digest
+            self._files[digest] = file_id
+        self._trim()
+
+    def _save(self) -> None:
+        with self._lock:
+            entries = [[url, digest, self._files[digest]] for url, digest in self._urls.items()
+                       if digest in self._files]
+        self._db.update_document(DOCUMENT, fields_with_content={'entries': entries})
+        self._db.save_and_update()
+
+    def _trim(self) -> None:
+        for entries in (self._urls, self._files):
+            while len(entries) > self._max_entries:
+                entries.popitem(last=False)
+
+    def _remember(self, url: str, digest: str, file_id: str) -> None:
+        with self._lock:
+            self._urls[url] = digest
+            self._urls.move_to_end(url)
+            self._files[digest] = file_id
+            self._files.move_to_end(digest)
+            self._trim()
+        self._save()
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            today = datetime.datetime.utcnow().date()
+            if today != self._day:
+                log.log('media: кэш картинок за {}: {}'.format(self._day.isoformat(), self._report(self._stats)))
+                self._day = today
+                self._stats = self._empty_stats()
+            self._stats[counter] += 1
+
+    def _cached(self, url: str, digest: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            if digest is None:
+                digest = self._urls.get(url)
+            else:
+                self._urls[url] = digest
+                self._trim()
+            if digest is None or digest not in self._files:
+                return None
+            self._urls.move_to_end(url)
+            self._files.move_to_end(digest)
+            return self._files[digest]
+
+    def _download(self, url: str) -> Optional[bytes]:
+        try:
+            response = self._session.get(url, timeout=TIMEOUT, stream=True)
+            response.raise_for_status()
+            content = response.raw.read(MAX_SIZE + 1, decode_content=True)
+        except (requests.exceptions.RequestException, OSError) as error:
+            log.warning('media: не удалось скачать {}: {}'.format(url, error), url=url)
+            self._count('download_errors')
+            return None
+        if len(content) > MAX_SIZE:
+            log.warning('media: {} больше {} байт'.format(url, MAX_SIZE), url=url)
+            self._count('download_errors')
+            return None
+        self._count('downloads')
+        return content
+
+    def _warm(self, url: str) -> Tuple[Optional[bytes], Optional[str], bool]:
+        """
+        Скачивает картинку и, если она новая и есть чат-хранилище, загружает ее туда
+
+        :return: (содержимое или None, хэш или None, был ли file_id для такого содержимого уже известен)
+        """
+        content = self._download(url)
+        if content is None:
+            return None, None, False
+        digest = hashlib.sha1(content).hexdigest()
+        known = self._cached(url, digest) is not None
+        if self._storage_chat is not None and not known:
+            sent = self._delivery.send(self._storage_chat, 'send_photo', content, disable_notification=True)
+            if sent is not None:
+                self._count('uploads')
+                self._remember(url, digest, sent.photo[-1].file_id)
+            else:
+                self._count('upload_errors')
+        return content, digest, known
+
+    def prefetch(self, urls: Iterable[str]) -> None:
+        """
+        Запускает скачивание картинок, которых еще нет в кэше. send_photo дождется уже начатого скачивания
+
+        :param urls: адреса картинок
+        :return: None
+        """
+        with self._lock:
+            if len(self._pending) > self._max_entries:  # скачанное впрок, но так и не отправленное
+                self._pending = {url: future for url, future in self._pending.items() if not future.done()}
+            for url in urls:
+                if url in self._pending or self._urls.get(url) in self._files:
+                    continue
+                self._pending[url] = self._executor.submit(self._warm, url)
+
+    def send_photo(self, addressees: List[int], url: str, caption: str, text: str, name: str = 'photo',
+                   **kwargs: Any) -> None:
+        """
+        Рассылает картинку. Если file_id для адреса или для такого же содержимого уже известен -- сразу по нему,
+        иначе загружает картинку первому адресату и рассылает остальным полученный file_id.
+        Кому картинку отправить не удалось, тот получает text (длинный -- по частям)
+
+        :param addressees: id чатов
+        :param url: адрес картинки
+        :param caption: подпись к картинке
+        :param text: запасное сообщение вместо картинки
+        :param name: имя рассылки для статистики в логе
+        :param kwargs: остальные параметры send_photo/send_message, например parse_mode
+        :return: None
+        """
+        if not addressees:
+            return
+        fallback = [('send_message', (part,), kwargs) for part in split_message(text, MESSAGE_LIMIT)]
+        file_id = self._cached(url)
+        if file_id is not None:
+            self._count('url_hits')
+        else:
+            with self._lock:
+                future = self._pending.pop(url, None)
+            content, digest, known = future.result() if future is not None else self._warm(url)
+            file_id = self._cached(url, digest) if digest is not None else None
+            self._count('content_hits' if known else 'misses')
+        if file_id is not None:
+            self._delivery.broadcast(addressees, 'send_photo', file_id, caption=caption, name=name,
+                                     fallback=fallback, **kwargs)
+            return
+        photo = content if content is not None else url  # не скачалось -- пусть телеграм попробует сам
+        for number, addressee in enumerate(addressees):
+            if number == UPLOAD_ATTEMPTS:
+                break
+            sent = self._delivery.send(addressee, 'send_photo', photo, caption=caption, **kwargs)
+            if sent is not None:
+                self._count('uploads')
+                if digest is not None:
+                    self._remember(url, digest, sent.photo[-1].file_id)
+                self._delivery.broadcast(addressees[number + 1:], 'send_photo', sent.photo[-1].file_id,
+                                         caption=caption, name=name, fallback=fallback, **kwargs)
+                return
+            self._count('upload_errors')
+            for method, args, _ in fallback:
+                self._delivery.broadcast([addressee], method, *args, name=name, **kwargs)
+        log.warning('media: не удалось загрузить {} в телеграм, остальным отправляется текст'.format(url))
+        for method, args, _ in fallback:
+            self._delivery.broadcast(addressees[UPLOAD_ATTEMPTS:], method, *args, name=name, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._files)
+        return stats
+
+    def report(self) -> str:
+        return self._report(self.stats())
+
+    @staticmethod
+    def _report(stats: Dict[str, Any]) -> str:
+        lookups = stats['url_hits'] + stats['content_hits'] + stats['misses']
+        hit_rate = (stats['url_hits'] + stats['content_hits']) / lookups if lookups else 0.0
+        template = ('попаданий по адресу {url_hits}, по содержимому {content_hits}, промахов {misses} '
+                    '({hit_rate:.0%} попаданий), загрузок {uploads}, ошибок загрузки {upload_errors}, '
+                    'скачано {downloads}, ошибок скачивания {download_errors}')
+        return template.format(hit_rate=hit_rate, **stats)
+
+
+__all__ = ['MediaCache']
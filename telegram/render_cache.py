@@ -0,0 +1,83 @@
+"""
+Кэш готовых ответов бота: клавиатур, справки, шаблонов сообщений
+
+То, что бот присылает одинаковым для многих пользователей (справка для уровня доступа, клавиатура /sub),
+собирается один раз и хранится уже готовым к отправке -- строкой текста или JSON клавиатуры, который
+телеграм-клиент отправляет как есть. Записи разложены по группам, и группа сбрасывается целиком, когда
+меняется то, из чего она собрана: 'commands' -- при загрузке команд, 'vault' -- при смене годноты,
+'users' -- когда боту пишет новый пользователь.
+Больше ничем записи не вытесняются, так что ключи должны принимать немного значений
+"""
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+from threading import Lock
+from utils import metrics
+
+RENDERS = metrics.counter('render_cache_total', 'Обращения к кэшу готовых ответов: hit, miss')
+
+
+class RenderCache:
+    """
+    Методы:
+    get -- готовое значение из кэша или собранное build() и сохраненное
+    invalidate -- сбрасывает группу (или весь кэш)
+    stats -- попадания, промахи и число записей
+    report -- строка со статистикой для /stats
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._groups: Dict[str, Dict[Hashable, Any]] = {}
+        self._versions: Dict[str, int] = {}
+        self._generation = 0  # растет при сбросе всего кэша
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, group: str, key: Hashable, build: Callable[[], Any]) -> Any:
+        """
+        :param group: группа, которая сбрасывается вместе
+        :param key: ключ внутри группы, например уровень доступа
+        :param build: функция без аргументов, собирающая значение
+        :return: значение; оно общее для всех вызывающих, менять его нельзя
+        """
+        with self._lock:
+            entries = self._groups.get(group)
+            if entries is not None and key in entries:
+                self._hits += 1
+                RENDERS.inc(result='hit')
+                return entries[key]
+            self._misses += 1
+            version = self._generation, self._versions.get(group, 0)
+        RENDERS.inc(result='miss')
+        value = build()  # Собирается без блокировки: build может сам обращаться к кэшу
+        with self._lock:
+            if (self._generation, self._versions.get(group, 0)) == version:  # Группу не сбросили, пока собирали
+                self._groups.setdefault(group, {})[key] = value
+        return value
+
+    def invalidate(self, group: Optional[str] = None) -> None:
+        """
+        :param group: группа; None -- весь кэш
+        :return: None
+        """
+        with self._lock:
+            if group is None:
+                self._groups.clear()
+                self._generation += 1
+                return
+            self._groups.pop(group, None)
+            self._versions[group] = self._versions.get(group, 0) + 1
+
+    def stats(self) -> Tuple[int, int, int]:
+        """
+        :return: (попаданий, промахов, записей)
+        """
+        with self._lock:
+            return self._hits, self._misses, sum(len(entries) for entries in self._groups.values())
+
+    def report(self) -> str:
+        hits, misses, entries = self.stats()
+        total = hits + misses
+        return 'готовых ответов: {}, попаданий {} из {} ({:.0%})'.format(entries, hits, total,
+                                                                         hits / total if total else 0.0)
+
+
+__all__ = ['RenderCache']
@@ -0,0 +1,112 @@
+"""
+Прием обновлений телеграма через вебхук
+
+WebhookServer -- маленький HTTP-сервер на http.server. Проверяет путь и секретный токен
+(заголовок X-Telegram-Bot-Api-Secret-Token), кладет обновление в ограниченную очередь и сразу отвечает 200.
+Обновления из очереди разбирает пул воркеров через bot.process_new_updates.
+Если очередь переполнена, сервер отвечает 503 -- телеграм повторит доставку позже.
+
+HTTPS обычно делает reverse proxy (nginx и т.п.), который проксирует на host:port этого сервера
+"""
+from typing import List, Optional
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+import hmac
+import json
+import queue
+from telebot import types
+from utils import log
+
+WORKERS = 4
+QUEUE_SIZE = 1000
+MAX_BODY = 1024 * 1024  # Обновления телеграма сильно меньше, все что больше -- мусор
+
+
+class WebhookServer:
+    """
+    Методы:
+    start -- запускает сервер и воркеры в фоновых тредах
+    stop -- останавливает сервер
+    """
+    def __init__(self, bot, host: str = '127.0.0.1', port: int = 8443, path: str = '/',
+                 secret_token: Optional[str] = None, workers: int = WORKERS, queue_size: int = QUEUE_SIZE):
+        """
+        :param bot: объект бота, в который передаются обновления
+        :param host: адрес, на котором слушать
+        :param port: порт
+        :param path: путь вебхука (лучше сделать его неугадываемым)
+        :param secret_token: секрет, переданный в set_webhook; запросы без него отбрасываются
+        :param workers: количество воркеров, обрабатывающих обновления
+        :param queue_size: сколько обновлений может ждать обработки
+        """
+        self._bot = bot
+        self._path = path
+        self._secret_token = secret_token
+        self._workers_count = workers
+        self.updates = queue.Queue(maxsize=queue_size)
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._threads: List[Thread] = []
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.send_response(server._accept(self))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *_):
+                pass
+
+        return Handler
+
+    def _accept(self, request: BaseHTTPRequestHandler) -> int:
+        if request.path != self._path:
+            return 404
+        if self._secret_token is not None:
+            token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(token.encode(), self._secret_token.encode()):
+                return 403
+        length = int(request.headers.get('Content-Length') or 0)
+        if not 0 < length <= MAX_BODY:
+            return 400
+        try:
+            update = types.Update.de_json(json.loads(request.rfile.read(length)))
+        except Exception as error:
+            log.warning('webhook: не удалось разобрать обновление: ' + str(error))
+            return 400
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            return 503
+        return 200
+
+    def _worker(self) -> None:
+        while True:
+            update = self.updates.get()
+            try:
+                self._bot.process_new_updates([update])
+            except Exception as error:
+                log.error('webhook: ошибка при обработке обновления: ' + str(error))
+
+    def start(self) -> None:
+        for number in range(self._workers_count):
+            worker = Thread(target=self._worker, name='webhook-{}'.format(number), daemon=True)
+            worker.start()
+            self._threads.append(worker)
+        server_thread = Thread(target=self._server.serve_forever, name='webhook-server', daemon=True)
+        server_thread.start()
+        self._threads.append(server_thread)
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+__all__ = ['WebhookServer']
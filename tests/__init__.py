@@ -0,0 +1,6 @@
+"""
+Тесты, которые прогоняют обновления телеграма через настоящий Bot.process_new_updates (middleware, фильтры,
+обработчики плагинов) против поддельного Bot API из benchmarks/fake_telegram.py. Нужен config.py, как и для бота.
+
+python -m pytest tests
+"""
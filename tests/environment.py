@@ -0,0 +1,72 @@
+"""
+Общее окружение тестов: поддельный Bot API, БД во временной папке и бот в TELEGRAM_BOT.
+Тесты импортируют этот модуль до плагинов: плагины открывают свои коллекции при импорте
+"""
+from typing import Any, Callable, Dict, List
+import itertools
+import tempfile
+import time
+from telebot import apihelper, types
+import database
+from utils import log
+from benchmarks.fake_telegram import FakeTelegram, make_update
+
+DIRECTORY = tempfile.mkdtemp(prefix='boris48bot-tests-')
+database.FILE_PATH = DIRECTORY + '/'
+log.LOG_FILE = DIRECTORY + '/logfile.log'
+log.LOG_ECHO = False
+FAKE = FakeTelegram().start()
+apihelper.API_URL = FAKE.api_url
+
+from config import BOT_OWNER_ID  # noqa: E402 -- после подмены FILE_PATH и API_URL
+from global_variables import TELEGRAM_BOT  # noqa: E402
+from telegram import Bot  # noqa: E402
+
+BOT = Bot('1:test')
+TELEGRAM_BOT.value = BOT
+_update_ids = itertools.count(1000)
+
+
+def feed(update: Dict[str, Any]) -> None:
+    """
+    Обрабатывает обновление так же, как polling и webhook: через process_new_updates
+    """
+    BOT.process_new_updates([types.Update.de_json(update)])
+
+
+def command_update(chat_id: int, text: str) -> Dict[str, Any]:
+    return make_update(next(_update_ids), chat_id, text)
+
+
+def callback_update(chat_id: int, data: str, message_id: int = 1, text: str = '') -> Dict[str, Any]:
+    """
+    :return: словарь обновления с нажатием inline-кнопки с callback_data data под сообщением бота message_id
+    """
+    update_id = next(_update_ids)
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'user{}'.format(chat_id), 'username': None}
+    message = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+               'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'}, 'text': text}
+    return {'update_id': update_id, 'callback_query': {'id': str(update_id), 'from': user, 'message': message,
+                                                       'chat_instance': '1', 'data': data}}
+
+
+def sent(method: str) -> List[Dict[str, str]]:
+    """
+    :return: параметры всех вызовов метода Bot API (например 'answerCallbackQuery'), по порядку
+    """
+    return [call['params'] for call in list(FAKE.sent) if call['method'] == method]
+
+
+def wait_for(condition: Callable[[], Any], timeout: float = 10.0) -> bool:
+    """
+    Обработчики telebot работают в пуле тредов, поэтому их результат ждем
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return bool(condition())
+
+
+__all__ = ['BOT', 'BOT_OWNER_ID', 'FAKE', 'feed', 'command_update', 'callback_update', 'sent', 'wait_for']
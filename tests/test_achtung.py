@@ -0,0 +1,73 @@
+"""
+/achtung: кнопка "Отменить" доходит до рассылки через process_new_updates, а рассылка, которой не удалось
+отправить владельцу ход, все равно заканчивается и не числится идущей
+"""
+import unittest
+from telebot import apihelper
+from tests.environment import BOT, BOT_OWNER_ID, feed, command_update, callback_update, sent, wait_for
+from plugins import achtung_plugin
+
+FIRST_RECIPIENT = 10000
+RECIPIENTS = 300  # При 30 сообщениях в секунду рассылка идет ~10 с, отменить ее успеваем
+
+
+class AchtungTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        for user_id in range(FIRST_RECIPIENT, FIRST_RECIPIENT + RECIPIENTS):
+            BOT.db.update_document(str(user_id), fields_with_content={'username': None, 'first_name': 'user',
+                                                                      'last_name': None, 'is_bot': False,
+                                                                      'access_level': 1})
+        BOT.db.save_and_update()
+        BOT.render_cache.invalidate('users')
+        BOT.load_command_plugins([{'commands': ['achtung'], 'handler': achtung_plugin.achtung.command,
+                                   'access_level': 2}])
+        BOT.load_callback_plugins([{'prefixes': ['achtung'], 'handler': achtung_plugin.achtung.callback,
+                                    'access_level': 2}])
+
+    def tearDown(self):
+        achtung_plugin.achtung._cancelled.set()
+        self.assertTrue(wait_for(lambda: not achtung_plugin.achtung.running, timeout=30))
+
+    @staticmethod
+    def _status() -> str:
+        return achtung_plugin.achtung._db.get_document('job')['status']
+
+    def test_cancel_button(self):
+        feed(command_update(BOT_OWNER_ID, '/achtung проверка отмены'))
+        self.assertTrue(wait_for(lambda: achtung_plugin.achtung.running))
+        self.assertTrue(wait_for(lambda: any('achtung:cancel' in call.get('reply_markup', '')
+                                             for call in sent('sendMessage'))))
+        feed(callback_update(BOT_OWNER_ID, 'achtung:cancel'))
+        self.assertTrue(wait_for(lambda: not achtung_plugin.achtung.running, timeout=30))
+        self.assertEqual(self._status(), achtung_plugin.CANCELLED)
+        self.assertIn('Останавливаю рассылку', [call.get('text') for call in sent('answerCallbackQuery')])
+        delivered = [call for call in sent('sendMessage') if 'проверка отмены' in call.get('text', '')]
+        self.assertLess(len(delivered), RECIPIENTS)
+
+    def test_progress_message_failure_finishes_job(self):
+        send_message = BOT.send_message
+
+        def blocked_by_owner(chat_id, *args, **kwargs):
+            if chat_id == BOT_OWNER_ID:
+                raise apihelper.ApiTelegramException('sendMessage', None, {
+                    'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'})
+            return send_message(chat_id, *args, **kwargs)
+
+        BOT.send_message = blocked_by_owner
+        try:
+            feed(command_update(BOT_OWNER_ID, '/achtung без владельца'))
+            self.assertTrue(wait_for(lambda: achtung_plugin.achtung.running))
+            self.assertTrue(wait_for(lambda: not achtung_plugin.achtung.running, timeout=60))
+        finally:
+            del BOT.send_message
+        self.assertEqual(self._status(), achtung_plugin.DONE)
+        delivered = [call for call in sent('sendMessage') if 'без владельца' in call.get('text', '')]
+        self.assertEqual(len(delivered), len(BOT.db.get_document_names()) - 1)
+        before = len(sent('sendMessage'))
+        feed(command_update(BOT_OWNER_ID, '/achtung снова'))
+        self.assertTrue(wait_for(lambda: any('Отправлено' in call.get('text', '')
+                                             for call in sent('sendMessage')[before:])))
+
+if __name__ == '__main__':
+    unittest.main()
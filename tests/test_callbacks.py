@@ -0,0 +1,33 @@
+"""
+Нажатия inline-кнопок проходят через middleware бота до обработчика по префиксу callback_data
+"""
+import unittest
+from tests.environment import BOT, feed, callback_update, wait_for
+
+FIRST_USER = 500
+
+
+class CallbackRoutingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.calls = []
+        BOT.load_callback_plugins([{'prefixes': ['test'], 'handler': cls.calls.append, 'access_level': 1}])
+
+    def test_callback_from_new_user_reaches_handler(self):
+        feed(callback_update(FIRST_USER, 'test:press'))
+        self.assertTrue(wait_for(lambda: any(call.data == 'test:press' for call in self.calls)))
+        self.assertEqual(BOT.get_user_access_level(FIRST_USER), 1)
+
+    def test_callback_without_access_is_ignored(self):
+        BOT.load_callback_plugins([{'prefixes': ['owner'], 'handler': self.calls.append, 'access_level': 2}])
+        feed(callback_update(FIRST_USER + 1, 'owner:press'))
+        feed(callback_update(FIRST_USER + 1, 'test:after'))
+        self.assertTrue(wait_for(lambda: any(call.data == 'test:after' for call in self.calls)))
+        self.assertFalse(any(call.data == 'owner:press' for call in self.calls))
+
+    def test_unknown_user_has_no_access(self):
+        self.assertEqual(BOT.get_user_access_level(FIRST_USER + 99), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
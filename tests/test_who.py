@@ -0,0 +1,56 @@
+"""
+/who: кнопки листания и фильтров под списком перерисовывают то же сообщение через process_new_updates
+"""
+import json
+import unittest
+from tests.environment import BOT, BOT_OWNER_ID, feed, command_update, callback_update, sent, wait_for
+from plugins import who_plugin
+
+FIRST_USER = 20000
+USERS = 2 * who_plugin.PAGE_SIZE
+
+
+class WhoPagingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        for user_id in range(FIRST_USER, FIRST_USER + USERS):
+            BOT.db.update_document(str(user_id), fields_with_content={'username': None, 'first_name': 'user',
+                                                                      'last_name': None, 'is_bot': user_id % 2 == 0,
+                                                                      'access_level': 0 if user_id % 2 == 0 else 1})
+        BOT.db.save_and_update()
+        BOT.render_cache.invalidate('users')
+        BOT.load_command_plugins([{'commands': ['who'], 'handler': who_plugin.who, 'access_level': 2}])
+        BOT.load_callback_plugins([{'prefixes': ['who'], 'handler': who_plugin.callback, 'access_level': 2}])
+
+    @staticmethod
+    def _buttons(call: dict) -> list:
+        keyboard = json.loads(call['reply_markup'])['inline_keyboard']
+        return [button['callback_data'] for row in keyboard for button in row]
+
+    def _press(self, data: str, message_text: str) -> dict:
+        before = len(sent('editMessageText'))
+        feed(callback_update(BOT_OWNER_ID, data, message_id=7, text=message_text))
+        self.assertTrue(wait_for(lambda: len(sent('editMessageText')) > before))
+        return sent('editMessageText')[-1]
+
+    def test_paging_and_filters(self):
+        before = len(sent('sendMessage'))
+        feed(command_update(BOT_OWNER_ID, '/who'))
+        self.assertTrue(wait_for(lambda: any('Вот кого я знаю' in call.get('text', '')
+                                             for call in sent('sendMessage')[before:])))
+        first = [call for call in sent('sendMessage')[before:] if 'Вот кого я знаю' in call.get('text', '')][-1]
+        self.assertIn('страница 1 из', first['text'])
+        self.assertIn('who:all:1', self._buttons(first))
+
+        second = self._press('who:all:1', first['text'])
+        self.assertIn('страница 2 из', second['text'])
+        self.assertEqual(second['message_id'], '7')
+        self.assertIn('who:all:0', self._buttons(second))
+
+        bots = self._press('who:bots:0', second['text'])
+        self.assertIn('боты', bots['text'])
+        self.assertNotIn('человек:', bots['text'])
+
+
+if __name__ == '__main__':
+    unittest.main()
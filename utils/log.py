@@ -1,21 +1,205 @@
 """
 Модуль логописательства.
 log -- написать сообщение в лог файл
+debug, info, warning, error -- то же с нужным уровнем
+flush -- дописать в файл все, что накопилось в буфере
+
+log не трогает ни файл, ни консоль: запись с временем, уровнем и полями контекста кладется в кольцевой буфер
+(LOG_BUFFER_SIZE записей), а фоновый тред раз в LOG_FLUSH_INTERVAL секунд или как только наберется
+LOG_BATCH_SIZE записей дописывает их в файл пачкой, по JSON на строку:
+{"time": "2021-01-01T00:00:00.000Z", "level": "error", "message": "...", <поля контекста>}
+и, если LOG_ECHO, печатает в консоль как раньше.
+Если буфер переполнен, самые старые записи выбрасываются (и об этом пишется в лог), так что log никогда
+не ждет диска. Файл ротируется, когда он вырастает больше LOG_MAX_BYTES или когда наступают новые сутки (UTC):
+logfile.log -> logfile.log.1 -> ... -> logfile.log.<LOG_BACKUPS>
 """
+from typing import Any, Dict, List, Optional, TextIO
+from collections import deque
+from threading import Thread, Condition, Lock
+import atexit
 import datetime
+import json
+import os
+import time
+
+try:
+    from config import LOG_LEVEL
+except ImportError:
+    LOG_LEVEL = 'info'
+try:
+    from config import LOG_ECHO
+except ImportError:
+    LOG_ECHO = True
+try:
+    from config import LOG_MAX_BYTES
+except ImportError:
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+try:
+    from config import LOG_BACKUPS
+except ImportError:
+    LOG_BACKUPS = 5
+
+LOG_FILE = 'logfile.log'
+LOG_BUFFER_SIZE = 10000
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 1.0  # секунды
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+_threshold = LEVELS.get(str(LOG_LEVEL).lower(), LEVELS['info'])  # неизвестный уровень -- см. конец модуля
+
 
+def _utc(moment: float) -> datetime.datetime:
+    return datetime.datetime.utcfromtimestamp(moment)
 
-def log(message: str, filename: str = 'logfile.log') -> None:
+
+class _Writer:
+    """
+    Буфер и фоновый тред одного лог-файла
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._buffer: deque = deque()
+        self._condition = Condition()
+        self._write_lock = Lock()  # flush из другого треда не должен писать вперемешку с фоновым
+        self._dropped = 0
+        self._file: Optional[TextIO] = None
+        self._day: Optional[datetime.date] = None
+        Thread(target=self._run, name='log', daemon=True).start()
+
+    def put(self, record: Dict[str, Any]) -> None:
+        with self._condition:
+            if len(self._buffer) >= LOG_BUFFER_SIZE:
+                self._buffer.popleft()
+                self._dropped += 1
+            self._buffer.append(record)
+            if len(self._buffer) >= LOG_BATCH_SIZE:
+                self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._buffer) >= LOG_BATCH_SIZE, timeout=LOG_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self) -> None:
+        with self._write_lock:
+            with self._condition:
+                batch = list(self._buffer)
+                self._buffer.clear()
+                dropped, self._dropped = self._dropped, 0
+            if dropped:
+                batch.insert(0, {'time': time.time(), 'level': 'warning',
+                                 'message': 'log: буфер переполнен, потеряно записей: {}'.format(dropped)})
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        lines = []
+        for record in batch:
+            moment = _utc(record['time'])
+            record['time'] = moment.isoformat(timespec='milliseconds') + 'Z'
+            lines.append(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+            if LOG_ECHO:
+                print('[{} + 00:00]: {}\n'.format(moment.isoformat(sep=' ', timespec='seconds'), record['message']))
+        data = ''.join(lines)
+        try:
+            self._open(len(data.encode()))
+            self._file.write(data)
+            self._file.flush()
+        except OSError as error:  # Писать об этом некуда, кроме консоли
+            print('log: не удалось записать в {}: {}'.format(self.filename, error))
+            self._close()
+
+    def _open(self, size: int) -> None:
+        today = datetime.datetime.utcnow().date()
+        if self._file is None:
+            if os.path.exists(self.filename):
+                self._day = _utc(os.path.getmtime(self.filename)).date()
+            else:
+                self._day = today
+        position = self._file.tell() if self._file is not None else (
+            os.path.getsize(self.filename) if os.path.exists(self.filename) else 0)
+        if position and (self._day != today or position + size > LOG_MAX_BYTES):
+            self._close()
+            self._rotate()
+            self._day = today
+        if self._file is None:
+            self._file = open(self.filename, 'a', encoding='utf-8')
+
+    def _rotate(self) -> None:
+        if LOG_BACKUPS <= 0:
+            os.remove(self.filename)
+            return
+        for number in range(LOG_BACKUPS - 1, 0, -1):
+            older = '{}.{}'.format(self.filename, number)
+            if os.path.exists(older):
+                os.replace(older, '{}.{}'.format(self.filename, number + 1))
+        os.replace(self.filename, self.filename + '.1')
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+_writers: Dict[str, _Writer] = {}
+_writers_lock = Lock()
+
+
+def _writer(filename: str) -> _Writer:
+    writer = _writers.get(filename)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(filename)
+            if writer is None:
+                writer = _writers[filename] = _Writer(filename)
+    return writer
+
+
+def log(message: str, filename: Optional[str] = None, level: str = 'info', **context: Any) -> None:
     """
     Добавить сообщение к лог-файлу
     :param message: собственно сообщение
-    :param filename: имя лог-файла
+    :param filename: имя лог-файла; по умолчанию -- LOG_FILE (у воркеров шардированного режима он свой)
+    :param level: 'debug', 'info', 'warning' или 'error'; записи ниже LOG_LEVEL из config.py отбрасываются
+    :param context: поля, которые попадут в запись рядом с сообщением, например chat_id=...
+    :return: None
+    """
+    if LEVELS[level] < _threshold:
+        return
+    record = {'time': time.time(), 'level': level, 'message': message}
+    for key, value in context.items():
+        record.setdefault(key, value)
+    _writer(filename or LOG_FILE).put(record)
+
+
+def debug(message: str, **context: Any) -> None:
+    log(message, level='debug', **context)
+
+
+def info(message: str, **context: Any) -> None:
+    log(message, level='info', **context)
+
+
+def warning(message: str, **context: Any) -> None:
+    log(message, level='warning', **context)
+
+
+def error(message: str, **context: Any) -> None:
+    log(message, level='error', **context)
+
+
+@atexit.register
+def flush() -> None:
+    """
+    Синхронно дописывает накопленное во все лог-файлы. Вызывается и при выходе из программы
     :return: None
     """
-    dt = datetime.datetime.utcnow()
-    dt = dt.isoformat(sep=' ', timespec='seconds')
-    message = '[{} + 00:00]: {}'.format(dt, message)
-    message += '\n'
-    print(message)
-    with open(filename, 'a') as logfile:
-        logfile.write(message)
+    for writer in list(_writers.values()):
+        writer.flush()
+
+
+if str(LOG_LEVEL).lower() not in LEVELS:
+    warning('log: неизвестный LOG_LEVEL {!r} в config.py, вместо него -- info'.format(LOG_LEVEL))
+
+__all__ = ['log', 'debug', 'info', 'warning', 'error', 'flush', 'LEVELS']
@@ -0,0 +1,278 @@
+"""
+Модуль метрик: счетчики, гистограммы и показатели, которые считаются в момент чтения.
+
+counter -- создает (или возвращает уже созданный) счетчик
+histogram -- то же для гистограммы; у гистограммы есть time() -- контекстный менеджер, меряющий время блока
+gauge -- показатель, значение которого возвращает функция, например глубина очереди
+timed -- декоратор, записывающий время работы функции в гистограмму
+render -- все метрики в текстовом формате Prometheus
+serve -- HTTP-сервер, отдающий render() по /metrics
+
+Метрики включаются METRICS_ENABLED = True в config.py. Пока они выключены, inc/observe возвращаются сразу,
+а time() отдает один и тот же пустой контекстный менеджер, так что на горячем пути остается одна проверка флага.
+У меток только строковые значения; набор меток метрики не фиксируется, но лучше не плодить их больше десятка
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+import functools
+import time
+
+try:
+    from config import METRICS_ENABLED
+except ImportError:
+    METRICS_ENABLED = False
+
+ENABLED = METRICS_ENABLED
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels_key(labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: Tuple[Tuple[str, str], ...], extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in key]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        if not ENABLED:
+            return
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> Dict[Tuple[Tuple[str, str], ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+        for key, value in sorted(self.values().items()):
+            lines.append('{}{} {}'.format(self.name, _format_labels(key), value))
+        return lines
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_labels', '_started')
+
+    def __init__(self, histogram: 'Histogram', labels: Dict[str, Any]):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # метки -> [счетчики по корзинам (последняя -- +Inf), сумма, количество, максимум]
+        self._values: Dict[Tuple[Tuple[str, str], ...], list] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        if not ENABLED:
+            return
+        key = _labels_key(labels)
+        index = len(self.buckets)
+        for number, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = number
+                break
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0, 0.0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+            state[3] = max(state[3], value)
+
+    def time(self, **labels: Any):
+        """
+        with histogram.time(method='send_message'):
+            ...
+        """
+        if not ENABLED:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def summary(self) -> Dict[Tuple[Tuple[str, str], ...], Dict[str, float]]:
+        """
+        :return: {метки: {'count', 'sum', 'avg', 'max', 'p50', 'p99'}}; перцентили -- верхние границы корзин
+        """
+        with self._lock:
+            values = {key: (list(state[0]), state[1], state[2], state[3]) for key, state in self._values.items()}
+        result = {}
+        for key, (counts, total, count, maximum) in values.items():
+            result[key] = {'count': count, 'sum': total, 'avg': total / count if count else 0.0, 'max': maximum,
+                           'p50': self._quantile(counts, count, 0.5, maximum),
+                           'p99': self._quantile(counts, count, 0.99, maximum)}
+        return result
+
+    def _quantile(self, counts: List[int], count: int, quantile: float, maximum: float) -> float:
+        seen = 0
+        for number, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= count * quantile:
+                return min(self.buckets[number], maximum) if number < len(self.buckets) else maximum
+        return maximum
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            values = {key: (list(state[0]), state[1], state[2]) for key, state in self._values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(key, 'le="{}"'.format(le)), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(key), total))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(key), count))
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self._function = function
+
+    def value(self) -> Optional[float]:
+        try:
+            return self._function()
+        except Exception:
+            return None
+
+    def render(self) -> List[str]:
+        value = self.value()
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} gauge'.format(self.name)]
+        if value is not None:
+            lines.append('{} {}'.format(self.name, value))
+        return lines
+
+
+_METRICS: Dict[str, Any] = {}
+_METRICS_LOCK = Lock()
+
+
+def _register(name: str, kind: type, build: Callable[[], Any]) -> Any:
+    with _METRICS_LOCK:
+        metric = _METRICS.get(name)
+        if metric is None:
+            metric = _METRICS[name] = build()
+        elif not isinstance(metric, kind):
+            raise ValueError('metrics: {} уже зарегистрирована как {}'.format(name, type(metric).__name__))
+        return metric
+
+
+def counter(name: str, documentation: str) -> Counter:
+    return _register(name, Counter, lambda: Counter(name, documentation))
+
+
+def histogram(name: str, documentation: str, buckets: Tuple[float, ...] = BUCKETS) -> Histogram:
+    return _register(name, Histogram, lambda: Histogram(name, documentation, buckets))
+
+
+def gauge(name: str, documentation: str, function: Callable[[], float]) -> Gauge:
+    """
+    Регистрирует показатель; повторная регистрация с тем же именем заменяет функцию
+    """
+    with _METRICS_LOCK:
+        metric = _METRICS[name] = Gauge(name, documentation, function)
+        return metric
+
+
+def timed(target: Histogram, **labels: Any) -> Callable:
+    """
+    Декоратор: время каждого вызова функции пишется в гистограмму target
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                target.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+def collect() -> List[Any]:
+    with _METRICS_LOCK:
+        return [_METRICS[name] for name in sorted(_METRICS)]
+
+
+def render() -> str:
+    lines = []
+    for metric in collect():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """
+    Запускает в фоновом треде HTTP-сервер, отдающий метрики по /metrics.
+    По умолчанию -- только на localhost: метрики не для всего интернета (METRICS_HOST в config.py)
+
+    :return: сервер (server.shutdown() его остановит)
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+__all__ = ['ENABLED', 'Counter', 'Histogram', 'Gauge', 'counter', 'histogram', 'gauge', 'timed', 'collect',
+           'render', 'serve']
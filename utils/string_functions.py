@@ -1,3 +1,6 @@
+from typing import Iterable, List, Optional, Tuple
+import bisect
+
 _MARKDOWN_CHARACTERS = '*`[_'
 
 
@@ -14,4 +17,147 @@ def de_markdown(string) -> str:
     return string
 
 
-__all__ = ['de_markdown']
+def de_markdown_shortened(string, limit: int) -> str:
+    """
+    Как de_markdown, но результат не длиннее limit: лишнее отрезается и заменяется многоточием
+    :param string:
+    :param limit: максимальная длина результата
+    :return:
+    """
+    string = de_markdown(string)
+    if len(string) <= limit:
+        return string
+    if limit < 1:
+        return ''
+    string = string[:limit - 1]
+    if string.endswith('\\'):  # не оставляем экранирующий слэш без символа
+        string = string[:-1]
+    return string + '…'
+
+
+def _find_unescaped(text: str, character: str, start: int) -> int:
+    position = text.find(character, start)
+    while position > 0 and text[position - 1] == '\\':
+        position = text.find(character, position + 1)
+    return position
+
+
+def _entities(text: str) -> List[Tuple[int, int, str, str]]:
+    """
+    Находит сущности маркдауна телеграма: *жирный*, _курсив_, `код`, ```блок кода``` и [ссылки](url).
+    Незакрытый символ разметки считается обычным символом
+    :param text:
+    :return: список (начало, конец, открывающая часть, закрывающая часть) по порядку
+    """
+    entities = []
+    position = 0
+    while position < len(text):
+        character = text[position]
+        if character == '\\':
+            position += 2
+            continue
+        end = -1
+        if text.startswith('```', position):
+            end = text.find('```', position + 3)
+            if end >= 0:
+                entities.append((position, end + 3, '```', '```'))
+                position = end + 3
+                continue
+        elif character == '`':
+            end = text.find('`', position + 1)
+            if end >= 0:
+                entities.append((position, end + 1, '`', '`'))
+        elif character in '*_':
+            end = _find_unescaped(text, character, position + 1)
+            if end >= 0:
+                entities.append((position, end + 1, character, character))
+        elif character == '[':
+            bracket = _find_unescaped(text, ']', position + 1)
+            if bracket >= 0 and text.startswith('(', bracket + 1):
+                end = text.find(')', bracket + 2)
+                if end >= 0:
+                    entities.append((position, end + 1, '[', text[bracket:end + 1]))
+        position = end + 1 if end >= 0 else position + 1
+    return entities
+
+
+def _entity_at(entities: List[Tuple[int, int, str, str]], starts: List[int],
+               position: int) -> Optional[Tuple[int, int, str, str]]:
+    """
+    :return: сущность, внутри которой (не на границе) находится позиция, или None
+    """
+    index = bisect.bisect_left(starts, position) - 1
+    if index >= 0 and position < entities[index][1]:
+        return entities[index]
+    return None
+
+
+def split_message(text: str, limit: int) -> List[str]:
+    """
+    Режет текст в маркдауне телеграма на куски не длиннее limit, по возможности по переводам строк
+    и только между сущностями разметки. Если одна сущность сама длиннее limit, она закрывается в конце куска
+    и открывается заново в начале следующего (ссылка -- с тем же url)
+    :param text:
+    :param limit: максимальная длина куска
+    :return: список кусков
+    """
+    parts = []
+    while len(text) > limit:
+        entities = _entities(text)
+        starts = [entity[0] for entity in entities]
+        cut = text.rfind('\n', 0, limit)
+        while cut > 0 and _entity_at(entities, starts, cut) is not None:
+            cut = text.rfind('\n', 0, cut)
+        if cut > 0:
+            parts.append(text[:cut])
+            text = text[cut:].lstrip('\n')
+            continue
+        entity = _entity_at(entities, starts, limit)
+        if entity is None or entity[0] > 0:
+            cut = entity[0] if entity is not None else limit
+            if text[cut - 1] == '\\':
+                cut -= 1
+            parts.append(text[:cut])
+            text = text[cut:]
+            continue
+        start, end, opening, closing = entity
+        cut = limit - len(closing)
+        if text[cut - 1] == '\\':
+            cut -= 1
+        if cut <= len(opening):  # даже кусок сущности не помещается (огромный url) -- оставляем только текст
+            text = text[len(opening):end - len(closing)] + text[end:]
+            continue
+        parts.append(text[:cut] + closing)
+        text = opening + text[cut:]
+    parts.append(text)
+    return parts
+
+
+def pack_messages(items: Iterable[str], limit: int, separator: str = '\n\n') -> List[str]:
+    """
+    Склеивает тексты по порядку в как можно меньшее число сообщений не длиннее limit.
+    Слишком длинные тексты режутся через split_message
+    :param items: тексты
+    :param limit: максимальная длина сообщения
+    :param separator: чем разделять тексты внутри одного сообщения
+    :return: список сообщений
+    """
+    messages = []
+    current: List[str] = []
+    length = 0
+    for item in items:
+        for part in split_message(item, limit):
+            if current and length + len(separator) + len(part) <= limit:
+                current.append(part)
+                length += len(separator) + len(part)
+            else:
+                if current:
+                    messages.append(separator.join(current))
+                current = [part]
+                length = len(part)
+    if current:
+        messages.append(separator.join(current))
+    return messages
+
+
+__all__ = ['de_markdown', 'de_markdown_shortened', 'split_message', 'pack_messages']
@@ -1,54 +1,37 @@
-from . import types
 from .types import Stats, Comments, Diff, User, Node, Tag
+from .http import BaseApi, get_json, SESSION, CACHE, TIMEOUT, POOL_SIZE
+from .async_api import AsyncApi
 from utils import log
-import requests
-import datetime
 
 TEST_URL = 'https://pig.staging.vault48.org/'
 MAIN_URL = 'https://pig.vault48.org/'
+FIRST_PAGE_SIZE = 10  # iter_comments начинает с маленьких страниц и удваивает их до MAX_PAGE_SIZE
+MAX_PAGE_SIZE = 100
 
 
-class Api:
-    def __init__(self, testing=False):
-        # Backend urls (example: https://pig.staging.vault48.org/node/696)
-        self._url = TEST_URL if testing else MAIN_URL
-        self._stats_url = self._url + 'stats/'
-        self._node_url = self._url + 'node/{}'
-        self._diff_url = self._url + 'flow/diff'
-        self._comments_url = self._url + 'node/{}/comment'
-        self._related_url = self._url + 'node/{}/related'
-        self._tags_url = self._url + 'tag/nodes'
+class ApiError(Exception):
+    pass
+
 
-        # Frontend urls (example: https://staging.vault48.org/post696)
-        self.url = self._url[:8] + self._url[12:]
-        self.post_url = self._url + 'post{}'
-        self.boris_node = 696
-        types.URL = self._url + 'static/'  # Forward backend static url in types
+class Api(BaseApi):
+    def __init__(self, testing=False):
+        super().__init__(TEST_URL if testing else MAIN_URL)
 
     def get_stats(self):
         try:
             return Stats(get_json(self._stats_url))
         except Exception as error:
             error_message = 'vault_api: Ошибка при попытке получить stats Убежища: ' + str(error)
-            log.log(error_message)
+            log.error(error_message)
 
     def get_diff(self, start=None, end=None, with_heroes=False,
                  with_updated=False, with_recent=False, with_valid=False):
-        if start is None or end is None:
-            time = datetime.datetime.utcnow().isoformat(timespec='milliseconds')[:-1] + 'Z'
-            start = time
-            end = time
-        params = {'start': start,
-                  'end': end,
-                  'with_heroes': str(with_heroes).lower(),
-                  'with_updated': str(with_updated).lower(),
-                  'with_recent': str(with_recent).lower(),
-                  'with_valid': str(with_valid).lower()}
+        params = self._diff_params(start, end, with_heroes, with_updated, with_recent, with_valid)
         try:
             return Diff(get_json(self._diff_url, params=params))
         except Exception as error:
             error_message = 'vault_api: Ошибка при попытке получить diff Убежища: ' + str(error)
-            log.log(error_message)
+            log.error(error_message)
 
     def get_recent(self):
         response = self.get_diff(with_recent=True)
@@ -67,33 +50,58 @@ class Api:
             return Comments(get_json(self._comments_url.format(node), params=params))
         except Exception as error:
             error_message = 'vault_api: Ошибка при попытке получить comments Убежища: ' + str(error)
-            log.log(error_message)
+            log.error(error_message)
+
+    def iter_comments(self, node, first_page=FIRST_PAGE_SIZE, max_page=MAX_PAGE_SIZE):
+        # Отдает комментарии ноды от новых к старым и запрашивает следующую страницу take/skip, только когда
+        # кончилась предыдущая, так что если перестать читать раньше, остальное не скачивается.
+        # Комментарии, которых новые сдвинули на следующую страницу, пропускаются по id.
+        # Если страницу получить не удалось -- ApiError
+        skip = 0
+        take = first_page
+        seen = set()
+        while True:
+            page = self.get_comments(node, take, skip)
+            if page is None:
+                raise ApiError('не удалось получить комментарии {} (skip={})'.format(node, skip))
+            comments = page.comments
+            for comment in comments:
+                if comment.id not in seen:
+                    seen.add(comment.id)
+                    yield comment
+            if len(comments) < take:
+                return
+            skip += take
+            take = min(take * 2, max_page)
+
+    def get_comments_since(self, node, timestamp, limit=None):
+        # Комментарии новее timestamp, от новых к старым; None, если не удалось получить страницы
+        comments = []
+        try:
+            for comment in self.iter_comments(node):
+                if comment.created_at <= timestamp:
+                    break
+                comments.append(comment)
+                if limit is not None and len(comments) >= limit:
+                    break
+        except ApiError as error:
+            log.error('vault_api: ' + str(error), node=node)
+            return None
+        return comments
 
     def get_boris(self, take, skip=0):
         return self.get_comments(self.boris_node, take, skip)
 
     def get_godnota(self):
-        params = {'name': '/годнота',
-                  'offset': 0,
-                  'limit': 25}
         try:
-            response = get_json(self._tags_url, params=params)
+            return self._parse_godnota(get_json(self._tags_url, params=self._godnota_params))
         except Exception as error:
             error_message = 'vault_api: Ошибка при попытке получить годноту Убежища' + str(error)
-            log.log(error_message)
-            return
-        nodes = response['nodes']
-        return {node['title']: node['id'] for node in nodes}
+            log.error(error_message)
 
     def get_node(self, node):
         try:
             return Node(get_json(self._node_url.format(node)))
         except Exception as error:
             error_message = 'vault_api: Ошибка при попытке получить node Убежища: ' + str(error)
-            log.log(error_message)
-
-
-def get_json(url, **params):
-    response = requests.get(url, **params)
-    if response.ok:
-        return response.json()
+            log.error(error_message)
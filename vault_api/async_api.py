@@ -0,0 +1,116 @@
+"""
+vault_api.Api для asyncio поверх aiohttp (необязательная зависимость).
+Те же методы, что у Api, только корутины, так что независимые запросы можно делать одновременно:
+
+async with AsyncApi(api.base_url) as async_api:
+    comments = await asyncio.gather(*[async_api.get_comments(node, 1) for node in nodes])
+"""
+import asyncio
+from .http import BaseApi, TIMEOUT, POOL_SIZE, REQUEST_SECONDS, RESPONSES
+from .types import Stats, Comments, Diff, Node
+from utils import log
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncApi(BaseApi):
+    def __init__(self, base_url, timeout=TIMEOUT, pool_size=POOL_SIZE):
+        """
+        :param base_url: адрес бэкенда Убежища, например Api(testing).base_url
+        :param timeout: (соединение, чтение) в секундах
+        :param pool_size: сколько соединений держать с бэкендом
+        """
+        if aiohttp is None:
+            raise ImportError('vault_api: для AsyncApi нужен aiohttp')
+        super().__init__(base_url)
+        connect, read = timeout
+        self._timeout = aiohttp.ClientTimeout(total=connect + read, connect=connect, sock_read=read)
+        self._pool_size = pool_size
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_json(self, url, params=None):
+        # Сессия создается при первом запросе, уже внутри работающего цикла событий
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit_per_host=self._pool_size)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        with REQUEST_SECONDS.time():
+            async with self._session.get(url, params=params) as response:
+                RESPONSES.inc(status=response.status)
+                if response.status == 200:
+                    return await response.json()
+
+    async def get_stats(self):
+        try:
+            return Stats(await self.get_json(self._stats_url))
+        except Exception as error:
+            error_message = 'vault_api: Ошибка при попытке получить stats Убежища: ' + _describe(error)
+            log.error(error_message)
+
+    async def get_diff(self, start=None, end=None, with_heroes=False,
+                       with_updated=False, with_recent=False, with_valid=False):
+        params = self._diff_params(start, end, with_heroes, with_updated, with_recent, with_valid)
+        try:
+            return Diff(await self.get_json(self._diff_url, params=params))
+        except Exception as error:
+            error_message = 'vault_api: Ошибка при попытке получить diff Убежища: ' + _describe(error)
+            log.error(error_message)
+
+    async def get_recent(self):
+        response = await self.get_diff(with_recent=True)
+        if response:
+            return response.recent
+
+    async def get_heroes(self):
+        response = await self.get_diff(with_heroes=True)
+        if response:
+            return response.heroes
+
+    async def get_comments(self, node, take, skip=0):
+        params = {'take': take,
+                  'skip': skip}
+        try:
+            return Comments(await self.get_json(self._comments_url.format(node), params=params))
+        except Exception as error:
+            error_message = 'vault_api: Ошибка при попытке получить comments Убежища: ' + _describe(error)
+            log.error(error_message)
+
+    async def get_boris(self, take, skip=0):
+        return await self.get_comments(self.boris_node, take, skip)
+
+    async def get_godnota(self):
+        try:
+            return self._parse_godnota(await self.get_json(self._tags_url, params=self._godnota_params))
+        except Exception as error:
+            error_message = 'vault_api: Ошибка при попытке получить годноту Убежища' + _describe(error)
+            log.error(error_message)
+
+    async def get_node(self, node):
+        try:
+            return Node(await self.get_json(self._node_url.format(node)))
+        except Exception as error:
+            error_message = 'vault_api: Ошибка при попытке получить node Убежища: ' + _describe(error)
+            log.error(error_message)
+
+
+def _describe(error):
+    # У asyncio.TimeoutError пустой str()
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    return str(error)
+
+
+__all__ = ['AsyncApi']
@@ -0,0 +1,129 @@
+"""
+HTTP-кэш под vault_api.get_json.
+
+Запоминает валидаторы (ETag / Last-Modified) каждого запроса (адрес + параметры) и отправляет их обратно
+в If-None-Match / If-Modified-Since. На 304 возвращается уже разобранный JSON, и ничего не скачивается.
+На 200 тело ответа хэшируется, и если такое тело уже разбиралось (хоть и для другого запроса -- flow/diff
+спрашивается каждую минуту с новым временем, но обычно отвечает то же самое), разбор JSON тоже пропускается.
+
+Разобранные значения общие для всех вызывающих, менять их нельзя.
+Счетчики пишутся в лог раз в сутки, а прочитать их можно через HttpCache.stats()
+"""
+from collections import OrderedDict
+from threading import Lock
+import datetime
+import hashlib
+import json
+import time
+from utils import log
+
+MAX_ENTRIES = 64
+
+
+class HttpCache:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self._max_entries = max_entries
+        self._validators = OrderedDict()  # ключ запроса -> (etag, last_modified, хэш тела)
+        self._bodies = OrderedDict()  # хэш тела -> (разобранный JSON, размер тела, секунды разбора)
+        self._lock = Lock()
+        self._day = datetime.datetime.utcnow().date()
+        self._stats = self._empty_stats()
+
+    @staticmethod
+    def _empty_stats():
+        return {'requests': 0, 'not_modified': 0, 'same_body': 0, 'misses': 0,
+                'bytes_downloaded': 0, 'bytes_saved': 0, 'parse_seconds': 0.0, 'parse_seconds_saved': 0.0}
+
+    @staticmethod
+    def key(url, params=None):
+        if not params:
+            return url
+        return url + '?' + '&'.join('{}={}'.format(name, params[name]) for name in sorted(params))
+
+    def conditional_headers(self, key):
+        with self._lock:
+            validators = self._validators.get(key)
+            if validators is None or validators[2] not in self._bodies:
+                return {}
+            etag, last_modified, _ = validators
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def not_modified(self, key):
+        # (True, разобранный JSON), если ответ есть в кэше, (False, None), если его вытеснили и надо запросить заново
+        with self._lock:
+            self._roll_day()
+            validators = self._validators.get(key)
+            body = self._bodies.get(validators[2]) if validators is not None else None
+            if body is None:
+                return False, None
+            self._validators.move_to_end(key)
+            self._bodies.move_to_end(validators[2])
+            value, size, parse_seconds = body
+            self._stats['requests'] += 1
+            self._stats['not_modified'] += 1
+            self._stats['bytes_saved'] += size
+            self._stats['parse_seconds_saved'] += parse_seconds
+            return True, value
+
+    def store(self, key, response):
+        content = response.content
+        digest = hashlib.sha1(content).digest()
+        with self._lock:
+            self._roll_day()
+            self._stats['requests'] += 1
+            self._stats['bytes_downloaded'] += len(content)
+            body = self._bodies.get(digest)
+            if body is not None:
+                self._bodies.move_to_end(digest)
+                self._stats['same_body'] += 1
+                self._stats['parse_seconds_saved'] += body[2]
+        if body is None:
+            started = time.perf_counter()
+            value = json.loads(content)
+            parse_seconds = time.perf_counter() - started
+            body = (value, len(content), parse_seconds)
+            with self._lock:
+                self._stats['misses'] += 1
+                self._stats['parse_seconds'] += parse_seconds
+                self._bodies[digest] = body
+                self._trim(self._bodies)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        with self._lock:
+            self._validators[key] = (etag, last_modified, digest)
+            self._validators.move_to_end(key)
+            self._trim(self._validators)
+        return body[0]
+
+    def _trim(self, entries):
+        while len(entries) > self._max_entries:
+            entries.popitem(last=False)
+
+    def _roll_day(self):
+        today = datetime.datetime.utcnow().date()
+        if today != self._day:
+            log.log('vault_api: кэш за {}: {}'.format(self._day.isoformat(), self._report(self._stats)))
+            self._day = today
+            self._stats = self._empty_stats()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def report(self):
+        return self._report(self.stats())
+
+    @staticmethod
+    def _report(stats):
+        template = ('запросов {requests}, 304: {not_modified}, тот же ответ: {same_body}, промахов: {misses}, '
+                    'скачано {bytes_downloaded} байт, сэкономлено {bytes_saved} байт, '
+                    'разбор JSON {parse_seconds:.3f} с, сэкономлено {parse_seconds_saved:.3f} с')
+        return template.format(**stats)
+
+
+__all__ = ['HttpCache']
@@ -0,0 +1,86 @@
+"""
+Общее для Api и AsyncApi: пул соединений, HTTP-кэш, метрики, get_json и BaseApi с адресами бэкенда Убежища.
+Отдельным модулем, чтобы vault_api и vault_api.async_api импортировали это, не импортируя друг друга
+"""
+from typing import Any, Dict, Optional
+import datetime
+import requests
+import requests.adapters
+from utils import metrics
+from . import types
+from .cache import HttpCache
+
+TIMEOUT = (5, 30)  # (соединение, чтение) в секундах для каждого запроса
+POOL_SIZE = 10  # Сколько keep-alive соединений держать с одним хостом
+
+# Одна сессия с пулом соединений на весь процесс: соединения с бэкендом переиспользуются,
+# а не открываются заново (TCP + TLS) на каждый запрос
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+# Условные запросы и уже разобранные ответы, см. vault_api.cache
+CACHE = HttpCache()
+REQUEST_SECONDS = metrics.histogram('vault_api_request_seconds', 'Время запросов к API Убежища, секунды')
+RESPONSES = metrics.counter('vault_api_responses_total', 'Ответы API Убежища по HTTP-статусам')
+
+
+class BaseApi:
+    """
+    Адреса бэкенда и разбор параметров, общие для Api и AsyncApi
+    """
+    def __init__(self, base_url: str):
+        # Адреса бэкенда (например, https://pig.staging.vault48.org/node/696)
+        self.base_url = base_url
+        self._stats_url = base_url + 'stats/'
+        self._node_url = base_url + 'node/{}'
+        self._diff_url = base_url + 'flow/diff'
+        self._comments_url = base_url + 'node/{}/comment'
+        self._related_url = base_url + 'node/{}/related'
+        self._tags_url = base_url + 'tag/nodes'
+
+        # Адреса фронтенда (например, https://staging.vault48.org/post696)
+        self.url = base_url[:8] + base_url[12:]
+        self.post_url = base_url + 'post{}'
+        self.boris_node = 696
+        types.URL = base_url + 'static/'  # Адрес статики бэкенда нужен в types
+
+    @staticmethod
+    def _diff_params(start, end, with_heroes, with_updated, with_recent, with_valid) -> Dict[str, str]:
+        if start is None or end is None:
+            time = datetime.datetime.utcnow().isoformat(timespec='milliseconds')[:-1] + 'Z'
+            start = time
+            end = time
+        params = {'start': start,
+                  'end': end,
+                  'with_heroes': str(with_heroes).lower(),
+                  'with_updated': str(with_updated).lower(),
+                  'with_recent': str(with_recent).lower(),
+                  'with_valid': str(with_valid).lower()}
+        return params
+
+    _godnota_params = {'name': '/годнота',
+                       'offset': 0,
+                       'limit': 25}
+
+    @staticmethod
+    def _parse_godnota(response):
+        nodes = response['nodes']
+        return {node['title']: node['id'] for node in nodes}
+
+
+@metrics.timed(REQUEST_SECONDS)
+def get_json(url: str, **params: Any) -> Optional[Any]:
+    params.setdefault('timeout', TIMEOUT)
+    key = CACHE.key(url, params.get('params'))
+    response = SESSION.get(url, headers=CACHE.conditional_headers(key), **params)
+    RESPONSES.inc(status=response.status_code)
+    if response.status_code == 304:
+        hit, value = CACHE.not_modified(key)
+        if hit:
+            return value
+        response = SESSION.get(url, **params)  # Сохраненный ответ успели вытеснить из кэша
+        RESPONSES.inc(status=response.status_code)
+    if response.ok:
+        return CACHE.store(key, response)
+
+
+__all__ = ['BaseApi', 'get_json', 'SESSION', 'CACHE', 'TIMEOUT', 'POOL_SIZE', 'REQUEST_SECONDS', 'RESPONSES']
@@ -1,7 +1,127 @@
 URL = ''
 
+# Модели держат ссылку на разобранный JSON и читают поля из него при обращении.
+# Вложенные объекты (файлы, пользователи, теги, списки постов) и подмена адресов собираются при первом
+# обращении и запоминаются в слоте, так что ответ, который в основном пропускается (старые комментарии,
+# ненужные файлы), стоит по одному маленькому объекту на элемент, а не полную копию.
+# Но наличие всех полей (и во вложенных объектах) проверяется сразу в конструкторе: кривой ответ должен
+# падать внутри try/except в Api.get_*, а не потом, при обращении к полю в vault_plugin.
+# Словари могут быть общими с vault_api.cache, поэтому модели их никогда не меняют.
+
+_NOT_PARSED = object()
+
+
+class _Field(property):
+    def __init__(self, key, if_none=None):
+        """
+        :param key: поле ответа
+        :param if_none: функция без аргументов, значение которой отдать вместо None
+        """
+        def getter(instance):
+            value = instance._data[key]
+            return if_none() if value is None and if_none is not None else value
+        super().__init__(getter, doc='поле "{}" ответа'.format(key))
+        self.key = key
+
+
+class _Lazy(property):
+    def __init__(self, slot, key, build=None, model=None, many=False):
+        """
+        :param slot: слот, в котором запоминается собранное значение
+        :param key: поле ответа
+        :param build: функция(словарь ответа), собирающая значение; по умолчанию -- модель (или список моделей)
+        поверх уже проверенного поля
+        :param model: модель вложенного объекта (или элементов списка), которую проверить в конструкторе
+        :param many: в поле лежит список таких объектов
+        """
+        if build is None:
+            def build(data):
+                value = data[key]
+                return [model._checked(item) for item in value] if many else model._checked(value)
+        def getter(instance):
+            value = getattr(instance, slot)
+            if value is _NOT_PARSED:
+                value = build(instance._data)
+                setattr(instance, slot, value)
+            return value
+        super().__init__(getter)
+        self.key = key
+        self.model = model
+        self.many = many
+
+
+def _validate(model, data) -> None:
+    """
+    Проверяет, что в ответе есть все поля модели, а вложенные объекты и списки -- нужной формы.
+    Вызывается на каждый элемент ответа, поэтому без лишних вызовов и форматирования, пока все в порядке
+
+    :raises KeyError, TypeError: если это не так
+    """
+    if type(data) is not dict:
+        raise TypeError('{}: ожидался объект, а не {}'.format(model.__name__, type(data).__name__))
+    if not data.keys() >= model._required:
+        raise KeyError('{}.{}'.format(model.__name__, ', '.join(sorted(model._required - data.keys()))))
+    for key, nested, many in model._nested:
+        value = data[key]
+        if not many:
+            _validate(nested, value)
+        elif type(value) is not list:
+            raise TypeError('{}.{}: ожидался список'.format(model.__name__, key))
+        elif nested._nested:
+            for item in value:
+                _validate(nested, item)
+        else:
+            required = nested._required
+            for item in value:
+                if type(item) is not dict or not item.keys() >= required:
+                    _validate(nested, item)  # бросит понятную ошибку
+
+
+def _static_url(url):
+    return url.replace('REMOTE_CURRENT://', URL)
+
+
+class _Model:
+    __slots__ = ('_data',)
+    _required = frozenset()  # поля ответа, которые читает модель (собираются из _Field и _Lazy)
+    _nested = ()  # (поле, модель, список ли) для проверки вложенных объектов
+    _lazy_slots = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        required, nested = set(), []
+        for klass in reversed(cls.__mro__):
+            for attribute in vars(klass).values():
+                if isinstance(attribute, (_Field, _Lazy)):
+                    required.add(attribute.key)
+                if isinstance(attribute, _Lazy) and attribute.model is not None:
+                    nested.append((attribute.key, attribute.model, attribute.many))
+        cls._required = frozenset(required)
+        cls._nested = tuple(nested)
+
+    def __init__(self, dictionary):
+        _validate(self.__class__, dictionary)
+        self._wrap(dictionary)
+
+    def _wrap(self, dictionary) -> None:
+        self._data = dictionary
+        for slot in self.__class__._lazy_slots:
+            setattr(self, slot, _NOT_PARSED)
+
+    @classmethod
+    def _checked(cls, dictionary):
+        """
+        Модель поверх уже проверенного словаря (вложенные объекты проверяет конструктор внешней модели)
+        """
+        model = cls.__new__(cls)
+        model._wrap(dictionary)
+        return model
+
 
 class Stats:
+    __slots__ = ('users_total', 'users_alive', 'nodes_images', 'nodes_audios', 'nodes_videos', 'nodes_texts',
+                 'nodes_total', 'comments_total', 'files_count', 'files_size', 'timestamps_boris', 'timestamps_flow')
+
     def __init__(self, dictionary):
         self.users_total = dictionary['users']['total']
         self.users_alive = dictionary['users']['alive']
@@ -17,108 +137,133 @@ class Stats:
         self.timestamps_flow = dictionary['timestamps']['flow_last_post']
 
 
-class Comments:
+class Tag:
+    __slots__ = ('id', 'title')
+    _required = frozenset(('ID', 'title'))
+    _nested = ()
+
     def __init__(self, dictionary):
-        self.comments = [Comment(comment) for comment in dictionary['comments']]
-        self.comment_count = dictionary['comment_count']
+        self.id = dictionary['ID']
+        self.title = dictionary['title']
 
 
-class Diff:
-    def __init__(self, dictionary):
-        self.before = [DiffPost(post) for post in dictionary['before']]
-        self.after = [DiffPost(post) for post in dictionary['after']]
-        self.recent = [DiffPost(post) for post in dictionary['recent']]
-        self.heroes = [DiffPost(hero) for hero in dictionary['heroes']]
-        # self.updated = dictionary['updated']
-        # self.valid = dictionary['valid']
+class File(_Model):
+    __slots__ = ('_url',)
+    _lazy_slots = __slots__
 
+    id = _Field('id')
+    name = _Field('name')
+    path = _Field('path')
+    url = _Lazy('_url', 'url', lambda data: _static_url(data['url']))
+    size = _Field('size')
+    type = _Field('type')
+    mime = _Field('mime')
+    metadata = _Field('metadata')
+    created_at = _Field('created_at')
+    updated_at = _Field('updated_at')
 
-class Comment:
-    def __init__(self, dictionary):
-        self.id = dictionary['id']
-        self.text = dictionary['text']
-        files_order = dictionary['files_order']
-        self.files_order = [] if files_order is None else files_order
-        self.created_at = dictionary['created_at']
-        self.updated_at = dictionary['updated_at']
-        self.files = [File(file) for file in dictionary['files']]
-        self.user = User(dictionary['user'])
 
+def _photo(data):
+    photo = data['photo']
+    photo = photo['url'] if isinstance(photo, dict) else photo
+    return _static_url(photo) if photo is not None else ''
 
-class File:
-    def __init__(self, dictionary):
-        self.id = dictionary['id']
-        self.name = dictionary['name']
-        self.path = dictionary['path']
-        self.url = dictionary['url'].replace('REMOTE_CURRENT://', URL)
-        self.size = dictionary['size']
-        self.type = dictionary['type']
-        self.mime = dictionary['mime']
-        self.metadata = dictionary['metadata']
-        self.created_at = dictionary['created_at']
-        self.updated_at = dictionary['updated_at']
-
-
-class BasicUser:
-    def __init__(self, dictionary):
-        self.id = dictionary['id']
-        photo = dictionary['photo']
-        photo = photo['url'] if isinstance(photo, dict) else photo
-        self.photo = photo.replace('REMOTE_CURRENT://', URL) if photo is not None else ''
-        self.username = dictionary['username']
+
+class BasicUser(_Model):
+    __slots__ = ('_photo',)
+    _lazy_slots = __slots__
+
+    id = _Field('id')
+    photo = _Lazy('_photo', 'photo', _photo)
+    username = _Field('username')
 
 
 class User(BasicUser):
-    def __init__(self, dictionary):
-        super().__init__(dictionary)
-        self.role = dictionary['role']
-        self.fullname = dictionary['fullname']
-        self.description = dictionary['description']
-        self.last_seen = dictionary['last_seen']
-        self.last_seen_messages = dictionary['last_seen_messages']
-        self.created_at = dictionary['created_at']
-        self.updated_at = dictionary['updated_at']
+    __slots__ = ()
 
+    role = _Field('role')
+    fullname = _Field('fullname')
+    description = _Field('description')
+    last_seen = _Field('last_seen')
+    last_seen_messages = _Field('last_seen_messages')
+    created_at = _Field('created_at')
+    updated_at = _Field('updated_at')
+
+
+class Comment(_Model):
+    __slots__ = ('_files', '_user')
+    _lazy_slots = __slots__
+
+    id = _Field('id')
+    text = _Field('text')
+    created_at = _Field('created_at')
+    updated_at = _Field('updated_at')
+    files = _Lazy('_files', 'files', model=File, many=True)
+    user = _Lazy('_user', 'user', model=User)
+
+    files_order = _Field('files_order', if_none=list)
+
+
+class Comments(_Model):
+    __slots__ = ('_comments',)
+    _lazy_slots = __slots__
+
+    comments = _Lazy('_comments', 'comments', model=Comment, many=True)
+    comment_count = _Field('comment_count')
 
-class BasicPost:
-    def __init__(self, dictionary):
-        self.id = dictionary['id']
-        self.title = dictionary['title']
-        self.type = dictionary['type']
-        self.created_at = dictionary['created_at']
-        self.commented_at = dictionary['commented_at']
-        self.thumbnail = dictionary['thumbnail'].replace('REMOTE_CURRENT://', URL) if dictionary['thumbnail'] else None
-        self.description = dictionary['description']
+
+class BasicPost(_Model):
+    __slots__ = ('_thumbnail',)
+    _lazy_slots = __slots__
+
+    id = _Field('id')
+    title = _Field('title')
+    type = _Field('type')
+    created_at = _Field('created_at')
+    commented_at = _Field('commented_at')
+    thumbnail = _Lazy('_thumbnail', 'thumbnail',
+                      lambda data: _static_url(data['thumbnail']) if data['thumbnail'] else None)
+    description = _Field('description')
 
 
 class DiffPost(BasicPost):
-    def __init__(self, dictionary):
-        super().__init__(dictionary)
-        self.user = BasicUser(dictionary['user'])
+    __slots__ = ('_user',)
+    _lazy_slots = BasicPost.__slots__ + __slots__
 
+    user = _Lazy('_user', 'user', model=BasicUser)
 
-class Node(BasicPost):
-    def __init__(self, dictionary):
-        dictionary = dictionary['node']
-        super().__init__(dictionary)
-        self.blocks = dictionary['blocks']
-        self.files_order = dictionary['files_order']
-        self.is_public = dictionary['is_public']
-        self.is_promoted = dictionary['is_promoted']
-        self.is_heroic = dictionary['is_heroic']
-        self.updated_at = dictionary['updated_at']
-        self.tags = [Tag(tag) for tag in dictionary['tags']]
-        self.files = [File(file) for file in dictionary['files']]
-        self.user = BasicUser(dictionary['user'])
-        self.cover = dictionary['cover']
-        self.is_liked = dictionary['is_liked']
-        self.like_count = dictionary['like_count']
 
+class Diff(_Model):
+    __slots__ = ('_before', '_after', '_recent', '_heroes')
+    _lazy_slots = __slots__
+
+    before = _Lazy('_before', 'before', model=DiffPost, many=True)
+    after = _Lazy('_after', 'after', model=DiffPost, many=True)
+    recent = _Lazy('_recent', 'recent', model=BasicPost, many=True)  # без автора
+    heroes = _Lazy('_heroes', 'heroes', model=BasicPost, many=True)
+    # updated = _Field('updated')
+    # valid = _Field('valid')
+
+
+class Node(BasicPost):
+    __slots__ = ('_tags', '_files', '_user')
+    _lazy_slots = BasicPost.__slots__ + __slots__
 
-class Tag:
     def __init__(self, dictionary):
-        self.id = dictionary['ID']
-        self.title = dictionary['title']
+        super().__init__(dictionary['node'])
+
+    blocks = _Field('blocks')
+    files_order = _Field('files_order')
+    is_public = _Field('is_public')
+    is_promoted = _Field('is_promoted')
+    is_heroic = _Field('is_heroic')
+    updated_at = _Field('updated_at')
+    tags = _Lazy('_tags', 'tags', lambda data: [Tag(tag) for tag in data['tags']], Tag, many=True)
+    files = _Lazy('_files', 'files', model=File, many=True)
+    user = _Lazy('_user', 'user', model=BasicUser)
+    cover = _Field('cover')
+    is_liked = _Field('is_liked')
+    like_count = _Field('like_count')
 
 
-__all__ = ['Stats', 'Comments', 'Diff', 'User', 'Node', 'Tag', 'Comment', 'BasicUser', 'DiffPost', 'Node']
\ No newline at end of file
+__all__ = ['Stats', 'Comments', 'Diff', 'User', 'Node', 'Tag', 'Comment', 'BasicUser', 'DiffPost', 'Node']